@@ -7,9 +7,10 @@ import json
 from urlparse import urljoin
 
 from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
 from django.contrib.sites.models import Site
-from django.core.cache import get_cache
 from django.core.urlresolvers import reverse
+from django.db.models import Q
 from piston.handler import AnonymousBaseHandler, BaseHandler
 from piston.utils import rc
 
@@ -383,6 +384,10 @@ class FragmentsHandler(BaseHandler, FragmentDetails):
 
 class CatalogueHandler(BaseHandler):
 
+    # objects are serialized in chunks of that many,
+    # with related data fetched in bulk for every chunk
+    CHUNK_SIZE = 500
+
     @staticmethod
     def fields(request, name):
         fields_str = request.GET.get(name) if request is not None else None
@@ -407,7 +412,13 @@ class CatalogueHandler(BaseHandler):
         return t.replace(microsecond=0)
 
     @staticmethod
-    def book_dict(book, fields=None):
+    def book_dict(book, fields=None, media=None, tags=None):
+        """ Serializes a book for the changes feed.
+
+            :param media: book's BookMedia objects, if already fetched
+            :param tags: book's (id, category, name) tag tuples, if already fetched
+
+        """
         all_fields = ['url', 'title', 'description',
                       'gazeta_link', 'wiki_link',
                       ] + Book.formats + BookMedia.formats + [
@@ -436,23 +447,31 @@ class CatalogueHandler(BaseHandler):
                     }
 
             elif field in BookMedia.formats:
-                media = []
-                for m in book.media.filter(type=field).iterator():
-                    media.append({
+                if media is None:
+                    field_media = book.media.filter(type=field).iterator()
+                else:
+                    field_media = (m for m in media if m.type == field)
+                field_media = [{
                         'url': m.file.url,
                         'size': m.file.size,
-                    })
-                if media:
-                    obj[field] = media
+                    } for m in field_media]
+                if field_media:
+                    obj[field] = field_media
 
             elif field == 'url':
                 obj[field] = book.get_absolute_url()
 
             elif field == 'tags':
-                obj[field] = [t.id for t in book.tags.exclude(category__in=('book', 'set')).iterator()]
+                if tags is None:
+                    obj[field] = [t.id for t in book.tags.exclude(category__in=('book', 'set')).iterator()]
+                else:
+                    obj[field] = [t[0] for t in tags]
 
             elif field == 'author':
-                obj[field] = ", ".join(t.name for t in book.tags.filter(category='author').iterator())
+                if tags is None:
+                    obj[field] = ", ".join(t.name for t in book.tags.filter(category='author').iterator())
+                else:
+                    obj[field] = ", ".join(t[2] for t in tags if t[1] == 'author')
 
             elif field == 'parent':
                 obj[field] = book.parent_id
@@ -472,7 +491,51 @@ class CatalogueHandler(BaseHandler):
         return obj
 
     @classmethod
-    def book_changes(cls, request=None, since=0, until=None, fields=None):
+    def book_dicts(cls, books, fields=None):
+        """ Serializes books, fetching their media and tags in bulk.
+
+            Yields dicts, as `book_dict` would return them.
+
+        """
+        if fields:
+            fields = list(fields)
+            need_media = any(f in BookMedia.formats for f in fields)
+            need_tags = 'tags' in fields or 'author' in fields
+        else:
+            need_media = need_tags = True
+        book_type = ContentType.objects.get_for_model(Book)
+
+        ids = list(books.order_by('pk').values_list('pk', flat=True))
+        for start in range(0, len(ids), cls.CHUNK_SIZE):
+            chunk = ids[start:start + cls.CHUNK_SIZE]
+            media = {}
+            if need_media:
+                for m in BookMedia.objects.filter(book__in=chunk).iterator():
+                    media.setdefault(m.book_id, []).append(m)
+            tags = {}
+            if need_tags:
+                for row in Tag.intermediary_table_model.objects.filter(
+                        content_type=book_type, object_id__in=chunk).exclude(
+                        tag__category__in=('book', 'set')).order_by(
+                        'tag__sort_key').values_list(
+                        'object_id', 'tag', 'tag__category', 'tag__name').iterator():
+                    tags.setdefault(row[0], []).append(row[1:])
+            chunk_books = Book.objects.in_bulk(chunk)
+            for pk in chunk:
+                if pk in chunk_books:
+                    yield cls.book_dict(chunk_books[pk], fields,
+                        media.get(pk, []) if need_media else None,
+                        tags.get(pk, []) if need_tags else None)
+
+    @classmethod
+    def book_changes(cls, request=None, since=0, until=None, fields=None,
+                     stream=False):
+        """ Changes in books between `since` and `until`.
+
+            With `stream`, updated books are generated while iterating,
+            instead of being kept in a list.
+
+        """
         since = datetime.fromtimestamp(int(since))
         until = cls.until(until)
 
@@ -483,17 +546,13 @@ class CatalogueHandler(BaseHandler):
         if not fields:
             fields = cls.fields(request, 'book_fields')
 
-        added = []
-        updated = []
         deleted = []
 
-        last_change = since
-        for book in Book.objects.filter(changed_at__gte=since,
-                    changed_at__lt=until).iterator():
-            book_d = cls.book_dict(book, fields)
-            updated.append(book_d)
-        if updated:
-            changes['updated'] = updated
+        books = Book.objects.filter(changed_at__gte=since,
+                    changed_at__lt=until)
+        if books.exists():
+            updated = cls.book_dicts(books, fields)
+            changes['updated'] = updated if stream else list(updated)
 
         for book in Deleted.objects.filter(content_type=Book, 
                     deleted_at__gte=since,
@@ -506,7 +565,12 @@ class CatalogueHandler(BaseHandler):
         return changes
 
     @staticmethod
-    def tag_dict(tag, fields=None):
+    def tag_dict(tag, fields=None, books=None):
+        """ Serializes a tag for the changes feed.
+
+            :param books: ids of top-level books with the tag, if already known
+
+        """
         all_fields = ('name', 'category', 'sort_key', 'description',
                       'gazeta_link', 'wiki_link',
                       'url', 'books',
@@ -524,7 +588,9 @@ class CatalogueHandler(BaseHandler):
                 obj[field] = tag.get_absolute_url()
 
             elif field == 'books':
-                obj[field] = [b.id for b in Book.tagged_top_level([tag]).iterator()]
+                if books is None:
+                    books = [b.id for b in Book.tagged_top_level([tag]).iterator()]
+                obj[field] = books
 
             elif field == 'sort_key':
                 obj[field] = tag.sort_key
@@ -538,7 +604,38 @@ class CatalogueHandler(BaseHandler):
         return obj
 
     @classmethod
-    def tag_changes(cls, request=None, since=0, until=None, fields=None, categories=None):
+    def tag_dicts(cls, tags, fields=None):
+        """ Serializes tags, finding their books in bulk.
+
+            Yields dicts, as `tag_dict` would return them.
+
+        """
+        if fields:
+            fields = list(fields)
+        need_books = not fields or 'books' in fields
+
+        ids = list(tags.order_by('pk').values_list('pk', flat=True))
+        for start in range(0, len(ids), cls.CHUNK_SIZE):
+            chunk = ids[start:start + cls.CHUNK_SIZE]
+            chunk_tags = Tag.objects.in_bulk(chunk)
+            books = {}
+            if need_books:
+                books = Tag.get_books(chunk, dict(
+                    (pk, tag.category) for pk, tag in chunk_tags.iteritems()))
+            for pk in chunk:
+                if pk in chunk_tags:
+                    yield cls.tag_dict(chunk_tags[pk], fields,
+                        books.get(pk, []) if need_books else None)
+
+    @classmethod
+    def tag_changes(cls, request=None, since=0, until=None, fields=None, categories=None,
+                    stream=False):
+        """ Changes in tags between `since` and `until`.
+
+            With `stream`, updated tags are generated while iterating,
+            instead of being kept in a list.
+
+        """
         since = datetime.fromtimestamp(int(since))
         until = cls.until(until)
 
@@ -553,24 +650,21 @@ class CatalogueHandler(BaseHandler):
 
         all_categories = ('author', 'epoch', 'kind', 'genre')
         if categories:
-            categories = (c for c in categories if c in all_categories)
+            categories = [c for c in categories if c in all_categories]
         else:
             categories = all_categories
 
-        updated = []
-        deleted = []
-
-        for tag in Tag.objects.filter(category__in=categories, 
+        tags = Tag.objects.filter(category__in=categories,
                     changed_at__gte=since,
-                    changed_at__lt=until).iterator():
-            # only serve non-empty tags
-            if tag.book_count:
-                tag_d = cls.tag_dict(tag, fields)
-                updated.append(tag_d)
-            elif tag.created_at < since:
-                deleted.append(tag.id)
-        if updated:
-            changes['updated'] = updated
+                    changed_at__lt=until)
+        # only serve non-empty tags
+        nonempty = tags.filter(book_count__gt=0)
+        if nonempty.exists():
+            updated = cls.tag_dicts(nonempty, fields)
+            changes['updated'] = updated if stream else list(updated)
+
+        deleted = list(tags.filter(Q(book_count=0) | Q(book_count=None),
+                created_at__lt=since).values_list('pk', flat=True))
 
         for tag in Deleted.objects.filter(category__in=categories,
                 content_type=Tag, 
@@ -585,26 +679,17 @@ class CatalogueHandler(BaseHandler):
 
     @classmethod
     def changes(cls, request=None, since=0, until=None, book_fields=None,
-                tag_fields=None, tag_categories=None):
+                tag_fields=None, tag_categories=None, stream=False):
         until = cls.until(until)
         since = int(since)
 
-        if not since:
-            cache = get_cache('api')
-            key = hash((book_fields, tag_fields, tag_categories,
-                    tuple(sorted(request.GET.items()))
-                  ))
-            value = cache.get(key)
-            if value is not None:
-                return value
-
         changes = {
             'time_checked': timestamp(until)
         }
 
         changes_by_type = {
-            'books': cls.book_changes(request, since, until, book_fields),
-            'tags': cls.tag_changes(request, since, until, tag_fields, tag_categories),
+            'books': cls.book_changes(request, since, until, book_fields, stream),
+            'tags': cls.tag_changes(request, since, until, tag_fields, tag_categories, stream),
         }
 
         for model in changes_by_type:
@@ -613,9 +698,6 @@ class CatalogueHandler(BaseHandler):
                     continue
                 changes.setdefault(field, {})[model] = changes_by_type[model][field]
 
-        if not since:
-            cache.set(key, changes)
-
         return changes
 
 
@@ -0,0 +1,15 @@
+# -*- coding: utf-8 -*-
+# This file is part of Wolnelektury, licensed under GNU Affero GPLv3 or later.
+# Copyright © Fundacja Nowoczesna Polska. See NOTICE for more information.
+#
+from django.core.management.base import BaseCommand
+
+from api import snapshots
+
+
+class Command(BaseCommand):
+    help = 'Makes a new snapshot of the changes feed. Run it periodically.'
+
+    def handle(self, **options):
+        time = snapshots.make_snapshot()
+        print "Snapshot %d in %s." % (time, snapshots.SNAPSHOT_DIR)
@@ -3,13 +3,19 @@
 # Copyright © Fundacja Nowoczesna Polska. See NOTICE for more information.
 #
 from datetime import datetime
+from optparse import make_option
 import os
 import os.path
 import re
+import shutil
 import sqlite3
+from time import time
+from django.contrib.contenttypes.models import ContentType
 from django.core.management.base import BaseCommand
 
+from api.handlers import CatalogueHandler
 from api.helpers import timestamp
+from api.models import Deleted
 from api.settings import MOBILE_INIT_DB
 from catalogue.models import Book, Tag
 
@@ -17,19 +23,49 @@ from catalogue.models import Book, Tag
 class Command(BaseCommand):
     help = 'Creates an initial SQLite file for the mobile app.'
 
+    option_list = BaseCommand.option_list + (
+        make_option('-f', '--full', action='store_true', dest='full', default=False,
+            help='build the database from scratch instead of updating the current one'),
+    )
+
     def handle(self, **options):
-        # those should be versioned
-        last_checked = timestamp(datetime.now())
-        db = init_db(last_checked)
-        for b in Book.objects.all():
-            add_book(db, b)
-        for t in Tag.objects.exclude(
-                category__in=('book', 'set', 'theme')).exclude(book_count=0):
-            # only add non-empty tags
-            add_tag(db, t)
+        start = time()
+        until = CatalogueHandler.until()
+        last_checked = timestamp(until)
+
+        previous = None if options['full'] else current_db()
+        if previous is not None:
+            since = last_checked_in(previous)
+            if since >= last_checked:
+                print "initial.db-%d is up to date." % since
+                return
+        else:
+            since = 0
+
+        path = db_path(last_checked)
+        tmp_path = path + '.tmp'
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        if previous is not None:
+            shutil.copyfile(previous, tmp_path)
+            db = sqlite3.connect(tmp_path)
+        else:
+            db = init_db(tmp_path)
+        # the file is only put in place when complete
+        db.execute("PRAGMA synchronous=OFF")
+
+        counts = update_db(db, datetime.fromtimestamp(since), until)
+        db.execute("UPDATE state SET last_checked=?", (last_checked,))
         db.commit()
+        if any(counts):
+            db.execute("VACUUM")
+            db.execute("ANALYZE")
         db.close()
-        current(last_checked)
+
+        os.rename(tmp_path, path)
+        set_current(last_checked)
+        print "initial.db-%d %s in %.2fs: %d books updated, %d tags updated, %d objects deleted." % (
+            last_checked, 'updated' if previous else 'built', time() - start, counts[0], counts[1], counts[2])
 
 
 def pretty_size(size):
@@ -63,10 +99,30 @@ def pretty_size(size):
 
 
 
-def init_db(last_checked):
+def db_path(last_checked):
+    return os.path.join(MOBILE_INIT_DB, 'initial.db-%d' % last_checked)
+
+
+def current_db():
+    """Path to the current database, or None."""
+    target = os.path.join(MOBILE_INIT_DB, 'initial.db')
+    if os.path.exists(target):
+        return os.path.realpath(target)
+    return None
+
+
+def last_checked_in(path):
+    db = sqlite3.connect(path)
+    try:
+        return db.execute("SELECT last_checked FROM state").fetchone()[0]
+    finally:
+        db.close()
+
+
+def init_db(path):
     if not os.path.isdir(MOBILE_INIT_DB):
         os.makedirs(MOBILE_INIT_DB)
-    db = sqlite3.connect(os.path.join(MOBILE_INIT_DB, 'initial.db-%d' % last_checked))
+    db = sqlite3.connect(path)
 
     schema = """
 CREATE TABLE book (
@@ -100,30 +156,31 @@ CREATE TABLE state (last_checked INTEGER);
 """
 
     db.executescript(schema)
-    db.execute("INSERT INTO state VALUES (:last_checked)", locals())
+    db.execute("INSERT INTO state VALUES (0)")
     return db
 
 
-def current(last_checked):
+def set_current(last_checked):
     target = os.path.join(MOBILE_INIT_DB, 'initial.db')
-    if os.path.lexists(target):
-        os.unlink(target)
+    tmp_target = target + '.tmp'
+    if os.path.lexists(tmp_target):
+        os.unlink(tmp_target)
     os.symlink(
         'initial.db-%d' % last_checked,
-        target,
+        tmp_target,
     )
-    
+    # replaces the old link atomically
+    os.rename(tmp_target, target)
 
 
 book_sql = """
-    INSERT INTO book 
+    INSERT OR REPLACE INTO book
         (id, title, html_file,  html_file_size, parent, parent_number, sort_key, pretty_size, authors) 
     VALUES 
         (:id, :title, :html_file, :html_file_size, :parent, :parent_number, :sort_key, :size_str, :authors);
 """
-book_tag_sql = "INSERT INTO book_tag (book, tag) VALUES (:book, :tag);"
 tag_sql = """
-    INSERT INTO tag
+    INSERT OR REPLACE INTO tag
         (id, category, name, sort_key, books)
     VALUES
         (:id, :category, :name, :sort_key, :book_ids);
@@ -135,29 +192,88 @@ categories = {'author': 'autor',
               'theme': 'motyw'
               }
 
+# objects are read from the database in chunks of that many
+CHUNK_SIZE = 500
+
+
+def chunks(ids):
+    ids = list(ids)
+    for start in range(0, len(ids), CHUNK_SIZE):
+        yield ids[start:start + CHUNK_SIZE]
+
+
+def update_db(db, since, until):
+    """Applies changes between `since` and `until` to the database.
+
+    Returns numbers of updated books, updated tags and deleted objects.
+
+    """
+    book_type = ContentType.objects.get_for_model(Book)
+    tag_type = ContentType.objects.get_for_model(Tag)
+
+    tags = Tag.objects.exclude(category__in=('book', 'set', 'theme')).filter(
+        changed_at__gte=since, changed_at__lt=until)
+    # only add non-empty tags
+    tag_ids = set(tags.exclude(book_count=0).values_list('pk', flat=True))
+    deleted_tag_ids = set(tags.values_list('pk', flat=True)) - tag_ids
+    deleted_tag_ids.update(Deleted.objects.filter(content_type=tag_type,
+        deleted_at__gte=since, deleted_at__lt=until).values_list('object_id', flat=True))
+
+    book_ids = set(Book.objects.filter(changed_at__gte=since,
+        changed_at__lt=until).values_list('pk', flat=True))
+    if since > datetime.fromtimestamp(0):
+        # author names are copied into books
+        changed_authors = tags.filter(category='author').values_list('pk', flat=True)
+        book_ids.update(Tag.intermediary_table_model.objects.filter(
+            content_type=book_type, tag__in=list(changed_authors)
+            ).values_list('object_id', flat=True))
+    deleted_book_ids = set(Deleted.objects.filter(content_type=book_type,
+        deleted_at__gte=since, deleted_at__lt=until).values_list('object_id', flat=True))
+    book_ids -= deleted_book_ids
+
+    for chunk in chunks(book_ids):
+        db.executemany(book_sql, book_rows(chunk))
+    for chunk in chunks(tag_ids):
+        db.executemany(tag_sql, tag_rows(chunk))
+    db.executemany("DELETE FROM book WHERE id=?", ((pk,) for pk in deleted_book_ids))
+    db.executemany("DELETE FROM tag WHERE id=?", ((pk,) for pk in deleted_tag_ids))
+    return len(book_ids), len(tag_ids), len(deleted_book_ids) + len(deleted_tag_ids)
+
+
+def book_rows(book_ids):
+    authors = {}
+    for book_id, name in Tag.intermediary_table_model.objects.filter(
+            content_type=ContentType.objects.get_for_model(Book),
+            object_id__in=book_ids, tag__category='author').order_by(
+            'tag__sort_key').values_list('object_id', 'tag__name').iterator():
+        authors.setdefault(book_id, []).append(name)
+
+    for book in Book.objects.filter(pk__in=book_ids).iterator():
+        if book.html_file:
+            html_file = book.html_file.url
+            html_file_size = book.html_file.size
+        else:
+            html_file = html_file_size = None
+        yield {
+            'id': book.id,
+            'title': book.title,
+            'html_file': html_file,
+            'html_file_size': html_file_size,
+            'parent': book.parent_id,
+            'parent_number': book.parent_number,
+            'sort_key': book.sort_key,
+            'size_str': pretty_size(html_file_size),
+            'authors': ", ".join(authors.get(book.id, ())),
+        }
+
 
-def add_book(db, book):
-    id = book.id
-    title = book.title
-    if book.html_file:
-        html_file = book.html_file.url
-        html_file_size = book.html_file.size
-    else:
-        html_file = html_file_size = None
-    parent = book.parent_id
-    parent_number = book.parent_number
-    sort_key = book.sort_key
-    size_str = pretty_size(html_file_size)
-    authors = ", ".join(t.name for t in book.tags.filter(category='author'))
-    db.execute(book_sql, locals())
-
-
-def add_tag(db, tag):
-    id = tag.id
-    category = categories[tag.category]
-    name = tag.name
-    sort_key = tag.sort_key
-
-    books = Book.tagged_top_level([tag])
-    book_ids = ','.join(str(b.id) for b in books)
-    db.execute(tag_sql, locals())
+def tag_rows(tag_ids):
+    books = Tag.get_books(tag_ids)
+    for tag in Tag.objects.filter(pk__in=tag_ids).iterator():
+        yield {
+            'id': tag.id,
+            'category': categories[tag.category],
+            'name': tag.name,
+            'sort_key': tag.sort_key,
+            'book_ids': ','.join(str(pk) for pk in books.get(tag.id, ())),
+        }
@@ -6,3 +6,14 @@ try:
     MOBILE_INIT_DB = settings.API_MOBILE_INIT_DB
 except AttributeError:
     MOBILE_INIT_DB = os.path.abspath(os.path.join(settings.MEDIA_ROOT, 'api/mobile/initial/'))
+
+try:
+    CHANGES_SNAPSHOT_DIR = settings.API_CHANGES_SNAPSHOT_DIR
+except AttributeError:
+    CHANGES_SNAPSHOT_DIR = os.path.abspath(os.path.join(settings.MEDIA_ROOT, 'api/changes/'))
+
+# Query strings of changes requests to keep snapshots for, see api.snapshots.
+try:
+    CHANGES_SNAPSHOT_VARIANTS = settings.API_CHANGES_SNAPSHOT_VARIANTS
+except AttributeError:
+    CHANGES_SNAPSHOT_VARIANTS = ['']
@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+# This file is part of Wolnelektury, licensed under GNU Affero GPLv3 or later.
+# Copyright © Fundacja Nowoczesna Polska. See NOTICE for more information.
+#
+"""Snapshots of the full catalogue changes feed.
+
+A snapshot is a full dump of changes since 0 up to its time, serialized
+in every emitter format and gzipped, for each configured variant of the
+request (see CHANGES_SNAPSHOT_VARIANTS). Snapshots are made periodically
+with the `changessnapshot` command and stored in directories named after
+their times, so the current one is replaced atomically.
+
+Lists of updated objects are serialized as they are generated (see
+`CatalogueHandler.changes` with `stream`), so the whole feed is never
+kept in memory.
+
+Changes since a given time are then computed up to the time of the current
+snapshot, not up to now, so that they are the same for every client
+with the same `since` and can be cached until the next snapshot.
+
+"""
+from datetime import datetime
+import gzip
+import hashlib
+import json
+import os
+import shutil
+from StringIO import StringIO
+from types import GeneratorType
+from urllib import urlencode
+
+from django.core.cache import get_cache
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import HttpRequest, QueryDict
+from django.utils.encoding import smart_unicode
+from django.utils.xmlutils import SimplerXMLGenerator
+from piston.emitters import Emitter
+from piston.handler import typemapper
+
+from api.handlers import CatalogueHandler
+from api.helpers import timestamp
+from api.settings import CHANGES_SNAPSHOT_DIR, CHANGES_SNAPSHOT_VARIANTS
+from catalogue import cache_versions
+
+
+FORMATS = ('json', 'xml', 'yaml')
+# request parameters changing the content of the feed
+PARAMS = ('book_fields', 'tag_fields', 'tag_categories')
+# older snapshots are removed, but may still be in use by running requests
+KEEP = 2
+
+SNAPSHOT_DIR = CHANGES_SNAPSHOT_DIR
+
+
+def variant(query):
+    """Normalized query string of a changes request."""
+    return urlencode(sorted((k, query[k]) for k in PARAMS if query.get(k)))
+
+
+def variant_name(query_string):
+    if not query_string:
+        return 'default'
+    return hashlib.md5(query_string).hexdigest()
+
+
+def has_variant(query):
+    """Checks if there are snapshots for a request with given GET parameters."""
+    return set(query) <= set(PARAMS) and variant(query) in [
+        variant(QueryDict(v)) for v in CHANGES_SNAPSHOT_VARIANTS]
+
+
+def decompress(content):
+    return gzip.GzipFile(fileobj=StringIO(content)).read()
+
+
+def materialize(data):
+    """Turns generated lists in `data` into real ones."""
+    if isinstance(data, dict):
+        return dict((k, materialize(v)) for k, v in data.iteritems())
+    elif isinstance(data, GeneratorType):
+        return list(data)
+    return data
+
+
+def _json(data):
+    content = json.dumps(data, cls=DjangoJSONEncoder, ensure_ascii=False)
+    if isinstance(content, unicode):
+        content = content.encode('utf-8')
+    return content
+
+
+def write_json(data, f):
+    if isinstance(data, dict):
+        f.write('{')
+        for i, (k, v) in enumerate(data.iteritems()):
+            if i:
+                f.write(', ')
+            f.write(_json(k) + ': ')
+            write_json(v, f)
+        f.write('}')
+    elif isinstance(data, GeneratorType):
+        f.write('[')
+        for i, item in enumerate(data):
+            if i:
+                f.write(',\n')
+            f.write(_json(item))
+        f.write(']')
+    else:
+        f.write(_json(data))
+
+
+def _to_xml(xml, data):
+    # same output as piston's XMLEmitter
+    if isinstance(data, (list, tuple, GeneratorType)):
+        for item in data:
+            xml.startElement("resource", {})
+            _to_xml(xml, item)
+            xml.endElement("resource")
+    elif isinstance(data, dict):
+        for key, value in data.iteritems():
+            xml.startElement(key, {})
+            _to_xml(xml, value)
+            xml.endElement(key)
+    else:
+        xml.characters(smart_unicode(data))
+
+
+def write_xml(data, f):
+    xml = SimplerXMLGenerator(f, "utf-8")
+    xml.startDocument()
+    xml.startElement("response", {})
+    _to_xml(xml, data)
+    xml.endElement("response")
+    xml.endDocument()
+
+
+def write(changes, emitter_format, f):
+    """Writes serialized `changes` to a file, streaming generated lists."""
+    if emitter_format == 'json':
+        write_json(changes, f)
+    elif emitter_format == 'xml':
+        write_xml(changes, f)
+    else:
+        f.write(render(materialize(changes), emitter_format)[0])
+
+
+def compressed(changes, emitter_format):
+    buf = StringIO()
+    f = gzip.GzipFile(fileobj=buf, mode='wb', mtime=0)
+    write(changes, emitter_format, f)
+    f.close()
+    return buf.getvalue()
+
+
+def render(changes, emitter_format):
+    """Serializes `changes`, as piston would. Returns content and its type."""
+    emitter, content_type = Emitter.get(emitter_format)
+    content = emitter(changes, typemapper, CatalogueHandler(), (), True).render(HttpRequest())
+    if isinstance(content, unicode):
+        content = content.encode('utf-8')
+    return content, content_type
+
+
+def content_type(emitter_format):
+    return Emitter.get(emitter_format)[1]
+
+
+def changes_request(query_string):
+    request = HttpRequest()
+    request.GET = QueryDict(query_string)
+    return request
+
+
+def snapshot_times():
+    try:
+        names = os.listdir(SNAPSHOT_DIR)
+    except OSError:
+        return []
+    return sorted(int(name) for name in names if name.isdigit())
+
+
+def current():
+    """Time of the current snapshot, or None."""
+    times = snapshot_times()
+    return times[-1] if times else None
+
+
+def snapshot_path(time, query_string, emitter_format):
+    return os.path.join(SNAPSHOT_DIR, str(time),
+                        '%s.%s.gz' % (variant_name(variant(QueryDict(query_string))), emitter_format))
+
+
+def make_snapshot(until=None):
+    """Makes a new snapshot and removes old ones. Returns its time."""
+    until = CatalogueHandler.until(until)
+    time = timestamp(until)
+    path = os.path.join(SNAPSHOT_DIR, str(time))
+    if os.path.isdir(path):
+        return time
+    tmp_path = path + '.tmp'
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+
+    for query_string in CHANGES_SNAPSHOT_VARIANTS:
+        for emitter_format in FORMATS:
+            changes = CatalogueHandler.changes(changes_request(query_string), 0, until,
+                                               stream=True)
+            name = os.path.basename(snapshot_path(time, query_string, emitter_format))
+            f = gzip.GzipFile(os.path.join(tmp_path, name), mode='wb', mtime=0)
+            try:
+                write(changes, emitter_format, f)
+            finally:
+                f.close()
+    os.rename(tmp_path, path)
+
+    for old in snapshot_times()[:-KEEP]:
+        shutil.rmtree(os.path.join(SNAPSHOT_DIR, str(old)), ignore_errors=True)
+    return time
+
+
+def full(time, query_string, emitter_format):
+    """Compressed full dump from the snapshot made at `time`."""
+    with open(snapshot_path(time, query_string, emitter_format), 'rb') as f:
+        return f.read()
+
+
+def delta(time, since, query_string, emitter_format):
+    """Compressed changes from `since` up to the snapshot made at `time`."""
+    if since >= time:
+        # up to date, no need to look into the database
+        return compressed({'time_checked': time}, emitter_format)
+
+    cache = get_cache('api')
+    key = 'api.snapshots.delta/%d/%d/%s/%s' % (
+        time, since, variant_name(variant(QueryDict(query_string))), emitter_format)
+    content = cache.get(key)
+    if content is None:
+        changes = CatalogueHandler.changes(changes_request(query_string), since,
+                                           datetime.fromtimestamp(time), stream=True)
+        content = compressed(changes, emitter_format)
+        cache.set(key, content)
+    return content
+
+
+def live(query_string, emitter_format):
+    """Compressed full dump made now, for requests not served from snapshots.
+
+    Cached until the catalogue changes. Returns its generation, time
+    and content.
+
+    """
+    generation = cache_versions.generation(cache_versions.CATALOGUE)
+    cache = get_cache('api')
+    key = 'api.snapshots.live/%d/%s/%s' % (
+        generation, variant_name(variant(QueryDict(query_string))), emitter_format)
+    value = cache.get(key)
+    if value is None:
+        changes = CatalogueHandler.changes(changes_request(query_string), 0, stream=True)
+        value = changes['time_checked'], compressed(changes, emitter_format)
+        cache.set(key, value)
+    time, content = value
+    return generation, time, content
@@ -6,6 +6,9 @@ from django.test import TestCase
 from django.utils import simplejson as json
 from django.conf import settings
 
+from api import snapshots
+from api.handlers import CatalogueHandler
+from api.management.commands import mobileinit
 from api.helpers import timestamp
 from catalogue.models import Book, Tag
 from picture.forms import PictureImportForm
@@ -15,6 +18,8 @@ from django.core.files.uploadedfile import SimpleUploadedFile
 
  
 from os import path
+import shutil
+import tempfile
 
 
 class ApiTest(TestCase):
@@ -44,6 +49,39 @@ class ChangesTest(ApiTest):
                          [{'id': tag.id, 'name': tag.name}],
                          'Invalid tag format in changes')
 
+        # the cached full dump is dropped when the catalogue changes
+        book.title = 'Another Title'
+        book.save()
+        changes = json.loads(self.client.get('/api/changes/0.json?tag_fields=name&book_fields=title').content)
+        self.assertEqual(changes['updated']['books'],
+                         [{'id': book.id, 'title': 'Another Title'}])
+
+    def test_bulk(self):
+        author = Tag.objects.create(category='author', name='Author', slug='author')
+        epoch = Tag.objects.create(category='epoch', name='Epoch', slug='epoch')
+        # titles sort in reverse order of pks
+        books = []
+        for i in range(3):
+            book = Book.objects.create(title='Book %d' % (2 - i), slug='book-%d' % i)
+            book.tags = [author, epoch][:i]
+            book.save()
+            books.append(book)
+        self.assertEqual(Tag.get_books([author.pk])[author.pk], [books[2].pk, books[1].pk])
+
+        books = Book.objects.all()
+        self.assertEqual(list(CatalogueHandler.book_dicts(books)),
+                         [CatalogueHandler.book_dict(b) for b in books.order_by('pk')])
+        tags = Tag.objects.filter(pk__in=[author.pk, epoch.pk])
+        self.assertEqual(list(CatalogueHandler.tag_dicts(tags)),
+                         [CatalogueHandler.tag_dict(t) for t in tags.order_by('pk')])
+
+        # streamed output is the same as piston's
+        streamed = CatalogueHandler.changes(since=0, stream=True)
+        time = streamed['time_checked']
+        self.assertEqual(json.loads(snapshots.decompress(snapshots.compressed(streamed, 'json'))),
+                         json.loads(snapshots.render(CatalogueHandler.changes(since=0,
+                            until=datetime.fromtimestamp(time)), 'json')[0]))
+
 
 class BookChangesTests(ApiTest):
 
@@ -98,6 +136,75 @@ class TagChangesTests(ApiTest):
                          'Empty or deleted tag should disappear.')
 
 
+class ChangesSnapshotTests(ApiTest):
+
+    def setUp(self):
+        super(ChangesSnapshotTests, self).setUp()
+        self.old_snapshot_dir = snapshots.SNAPSHOT_DIR
+        snapshots.SNAPSHOT_DIR = tempfile.mkdtemp(prefix='djangotest_')
+        self.book = Book.objects.create(slug='slug', title='A Book')
+
+    def tearDown(self):
+        shutil.rmtree(snapshots.SNAPSHOT_DIR, True)
+        snapshots.SNAPSHOT_DIR = self.old_snapshot_dir
+        super(ChangesSnapshotTests, self).tearDown()
+
+    def test_snapshot(self):
+        time = snapshots.make_snapshot()
+        response = self.client.get('/api/changes/0.json')
+        changes = json.loads(response.content)
+        self.assertEqual(changes['time_checked'], time)
+        self.assertEqual([b['id'] for b in changes['updated']['books']],
+                         [self.book.id])
+
+        response = self.client.get('/api/changes/0.json',
+                                   HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+        response = self.client.get('/api/changes/0.json',
+                                   HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+
+        # up to date with the snapshot
+        changes = json.loads(self.client.get('/api/changes/%d.json' % time).content)
+        self.assertEqual(changes, {'time_checked': time})
+
+        # not served from snapshots
+        changes = json.loads(self.client.get('/api/changes/0.json?book_fields=title').content)
+        self.assertEqual(changes['updated']['books'],
+                         [{'id': self.book.id, 'title': self.book.title}])
+
+
+class MobileInitTests(ApiTest):
+
+    def setUp(self):
+        super(MobileInitTests, self).setUp()
+        self.old_init_db = mobileinit.MOBILE_INIT_DB
+        mobileinit.MOBILE_INIT_DB = tempfile.mkdtemp(prefix='djangotest_')
+
+    def tearDown(self):
+        shutil.rmtree(mobileinit.MOBILE_INIT_DB, True)
+        mobileinit.MOBILE_INIT_DB = self.old_init_db
+        super(MobileInitTests, self).tearDown()
+
+    def test_update(self):
+        author = Tag.objects.create(category='author', name='Author', slug='author')
+        book = Book.objects.create(title='A Book', slug='a-book')
+        book.tags = [author]
+        book.save()
+
+        db = mobileinit.init_db(path.join(mobileinit.MOBILE_INIT_DB, 'test.db'))
+        mobileinit.update_db(db, datetime.fromtimestamp(0), CatalogueHandler.until())
+        self.assertEqual(db.execute("SELECT id, title, authors FROM book").fetchall(),
+                         [(book.id, u'A Book', u'Author')])
+        self.assertEqual(db.execute("SELECT id, books FROM tag").fetchall(),
+                         [(author.id, unicode(book.id))])
+
+        book.delete()
+        mobileinit.update_db(db, datetime.fromtimestamp(0), CatalogueHandler.until())
+        self.assertEqual(db.execute("SELECT id FROM book").fetchall(), [])
+        db.close()
+
 
 class BookTests(TestCase):
 
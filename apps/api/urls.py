@@ -10,7 +10,6 @@ auth = OAuthAuthentication(realm="Wolne Lektury")
 
 book_changes_resource = Resource(handler=handlers.BookChangesHandler)
 tag_changes_resource = Resource(handler=handlers.TagChangesHandler)
-changes_resource = Resource(handler=handlers.ChangesHandler)
 
 book_list_resource = Resource(handler=handlers.BooksHandler, authentication=auth)
 #book_list_resource = Resource(handler=handlers.BooksHandler)
@@ -39,7 +38,7 @@ urlpatterns = patterns(
     url(r'^book_changes/(?P<since>\d*?)\.(?P<emitter_format>xml|json|yaml)$', book_changes_resource),
     url(r'^tag_changes/(?P<since>\d*?)\.(?P<emitter_format>xml|json|yaml)$', tag_changes_resource),
     # used by mobile app
-    url(r'^changes/(?P<since>\d*?)\.(?P<emitter_format>xml|json|yaml)$', changes_resource),
+    url(r'^changes/(?P<since>\d*?)\.(?P<emitter_format>xml|json|yaml)$', 'api.views.changes'),
 
     # info boxes (used by mobile app)
     url(r'book/(?P<id>\d*?)/info\.html$', 'catalogue.views.book_info'),
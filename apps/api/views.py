@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+# This file is part of Wolnelektury, licensed under GNU Affero GPLv3 or later.
+# Copyright © Fundacja Nowoczesna Polska. See NOTICE for more information.
+#
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.http import http_date, parse_http_date_safe
+from piston.resource import Resource
+
+from api import handlers, snapshots
+from stats.utils import piwik_track
+
+
+changes_resource = Resource(handler=handlers.ChangesHandler)
+
+
+def compressed_response(request, content, content_type, etag, last_modified):
+    """ serves gzipped content, with support for conditional requests """
+    if request.META.get('HTTP_IF_NONE_MATCH') == etag:
+        return HttpResponseNotModified()
+    if_modified_since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+    if if_modified_since is not None and if_modified_since >= last_modified:
+        return HttpResponseNotModified()
+
+    if 'gzip' in request.META.get('HTTP_ACCEPT_ENCODING', ''):
+        response = HttpResponse(content, content_type=content_type)
+        response['Content-Encoding'] = 'gzip'
+    else:
+        response = HttpResponse(snapshots.decompress(content), content_type=content_type)
+    response['Content-Length'] = str(len(response.content))
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    response['Vary'] = 'Accept-Encoding'
+    return response
+
+
+@piwik_track
+class SnapshotChanges(object):
+    """ serves the changes feed from a snapshot """
+
+    def __call__(self, request, since, emitter_format, time):
+        since = int(since or 0)
+        query_string = snapshots.variant(request.GET)
+        if since:
+            content = snapshots.delta(time, since, query_string, emitter_format)
+        else:
+            content = snapshots.full(time, query_string, emitter_format)
+        etag = '"%d-%d-%s-%s"' % (time, since, snapshots.variant_name(query_string), emitter_format)
+        return compressed_response(request, content, snapshots.content_type(emitter_format),
+                                   etag, time)
+
+snapshot_changes = SnapshotChanges()
+
+
+@piwik_track
+class LiveChanges(object):
+    """ serves the full changes feed when there's no snapshot for it """
+
+    def __call__(self, request, emitter_format):
+        query_string = snapshots.variant(request.GET)
+        generation, time, content = snapshots.live(query_string, emitter_format)
+        etag = '"live-%d-%s-%s"' % (generation, snapshots.variant_name(query_string), emitter_format)
+        return compressed_response(request, content, snapshots.content_type(emitter_format),
+                                   etag, time)
+
+live_changes = LiveChanges()
+
+
+def changes(request, since, emitter_format):
+    if request.method != 'GET':
+        return changes_resource(request, since=since, emitter_format=emitter_format)
+    time = snapshots.current()
+    if time is None or not snapshots.has_variant(request.GET):
+        if not int(since or 0) and emitter_format in snapshots.FORMATS:
+            return live_changes(request, emitter_format)
+        return changes_resource(request, since=since, emitter_format=emitter_format)
+    return snapshot_changes(request, since, emitter_format, time)
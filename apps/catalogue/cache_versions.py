@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+# This file is part of Wolnelektury, licensed under GNU Affero GPLv3 or later.
+# Copyright © Fundacja Nowoczesna Polska. See NOTICE for more information.
+#
+"""Dependency-tracked cache invalidation.
+
+Every object a cached value depends on has a generation counter in the
+permanent cache. A dependency is a tuple like ``('book', 12)`` or
+``('catalogue',)``. Cached values are stored under keys including current
+generations of all their dependencies, so invalidating everything that
+depends on an object is just bumping its counter -- stale entries are
+never read again and expire on their own.
+
+"""
+from time import time
+
+from django.core.cache import get_cache
+
+
+permanent_cache = get_cache('permanent')
+
+GENERATION_KEY = 'cache_versions/%s'
+
+# The catalogue as a whole: changes whenever any book or tag changes.
+CATALOGUE = ('catalogue',)
+
+
+def _generation_key(dep):
+    return GENERATION_KEY % "/".join(str(part) for part in dep)
+
+
+def generations(deps):
+    """Returns a dict of current generations of given dependencies."""
+    keys = dict((_generation_key(dep), dep) for dep in deps)
+    found = permanent_cache.get_many(keys.keys())
+    missing = [key for key in keys if found.get(key) is None]
+    if missing:
+        # Start from a fresh value, not to run into old cache entries.
+        # Only add, not to overwrite a concurrent bump, and read back
+        # what's there; this only happens on a cold cache.
+        fresh = int(time())
+        for key in missing:
+            permanent_cache.add(key, fresh)
+        found.update(permanent_cache.get_many(missing))
+    return dict((dep, found.get(key) or 0) for key, dep in keys.iteritems())
+
+
+def generation(dep):
+    return generations([dep])[dep]
+
+
+def bump(*deps):
+    """Invalidates everything cached with any of `deps`."""
+    for dep in deps:
+        key = _generation_key(dep)
+        try:
+            permanent_cache.incr(key)
+        except ValueError:
+            permanent_cache.set(key, int(time()))
+
+
+def versioned_keys(entries):
+    """Maps keys to versioned keys.
+
+    `entries` is a dict mapping cache keys to lists of their dependencies.
+    Generations of all the dependencies are fetched at once.
+
+    """
+    all_deps = set()
+    for deps in entries.itervalues():
+        all_deps.update(deps)
+    gens = generations(all_deps)
+    return dict((key, "%s@%s" % (key, ".".join(str(gens[dep]) for dep in deps)))
+                for key, deps in entries.iteritems())
+
+
+def versioned_key(key, deps):
+    return versioned_keys({key: deps})[key]
+
+
+def get_cached(key, deps, default=None):
+    return permanent_cache.get(versioned_key(key, deps), default)
+
+
+def set_cached(key, value, deps, timeout=None):
+    permanent_cache.set(versioned_key(key, deps), value, timeout)
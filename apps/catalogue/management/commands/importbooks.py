@@ -6,15 +6,58 @@ import os
 import sys
 import time
 from optparse import make_option
+from traceback import format_exc
 from django.conf import settings
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 from django.core.management.color import color_style
 from django.core.files import File
 
 from catalogue.models import Book
 from picture.models import Picture
 
-from search import Index
+from search import Index, ReusableIndex
+
+
+def _import_worker(file_path, options):
+    """Imports a book in a worker process.
+
+    Returns a tuple of: file path, book id (or None on failure),
+    list of rebuilt things, an error tuple (kind, message) and data
+    for the search index (see `Index.extract_book`), if it's needed.
+
+    """
+    from django.db import transaction, IntegrityError
+
+    try:
+        with transaction.commit_on_success():
+            book = Command().import_book(file_path, options)
+    except Book.AlreadyExists:
+        return file_path, None, [], ('exists', None), None
+    except IntegrityError:
+        # Probably a race with another worker creating the same tag.
+        return file_path, None, [], ('retry', format_exc()), None
+    except Exception:
+        return file_path, None, [], ('error', format_exc()), None
+
+    extracted = None
+    if options.get('extract_search') and \
+            book.built_hashes.get('search') != book.search_hash():
+        try:
+            extracted = Index.extract_book(book.xml_file.path)
+        except Exception:
+            # the main process will try again
+            pass
+    return file_path, book.pk, book.rebuilt, None, extracted
+
+
+def _import_process(conn, file_path, options):
+    """Runs `_import_worker` in a child process, sends the result back."""
+    # Don't use (or close) the database connection inherited from parent.
+    from django.db import connection
+    connection.connection = None
+    conn.send(_import_worker(file_path, options))
+    conn.close()
+
 
 class Command(BaseCommand):
     option_list = BaseCommand.option_list + (
@@ -36,10 +79,27 @@ class Command(BaseCommand):
             help='Wait until specified time (Y-M-D h:m:s)'),
         make_option('-p', '--picture', action='store_true', dest='import_picture', default=False,
             help='Import pictures'),
+        make_option('-c', '--changed-only', action='store_true', dest='changed_only', default=False,
+            help='Skip books whose XML has not changed since last import'),
+        make_option('-j', '--jobs', dest='jobs', type='int', default=1, metavar='N',
+            help='Import books in N worker processes'),
+        make_option('-t', '--timeout', dest='timeout', type='int', default=3600, metavar='SECONDS',
+            help='With --jobs, kill the import of a book if it takes longer'),
     )
     help = 'Imports books from the specified directories.'
     args = 'directory [directory ...]'
 
+    def unchanged(self, file_path):
+        """Checks if the book was already imported from identical source."""
+        from librarian import dcparser
+
+        slug = dcparser.parse(file_path).url.slug
+        try:
+            book = Book.objects.get(slug=slug)
+        except Book.DoesNotExist:
+            return False
+        return book.built_hashes.get('xml') == book.source_hash(file_path)
+
     def import_book(self, file_path, options):
         verbose = options.get('verbose')
         file_base, ext = os.path.splitext(file_path)
@@ -53,26 +113,274 @@ class Command(BaseCommand):
         for ebook_format in Book.ebook_formats:
             if os.path.isfile(file_base + '.' + ebook_format):
                 getattr(book, '%s_file' % ebook_format).save(
-                    '%s.%s' % (book.slug, ebook_format), 
+                    '%s.%s' % (book.slug, ebook_format),
                     File(file(file_base + '.' + ebook_format)))
                 if verbose:
                     print "Importing %s.%s" % (file_base, ebook_format)
 
         book.save()
+        return book
 
     def import_picture(self, file_path, options):
         picture = Picture.from_xml_file(file_path, overwrite=options.get('force'))
         return picture
 
+    def scan(self, file_paths):
+        """Reads headers of all the files to find out about their parts.
+
+        Returns a dict: file path -> set of paths of its parts' files.
+        Parts not found in `file_paths` must be already imported.
+
+        """
+        from librarian import dcparser, ParseError
+
+        slugs = {}
+        parts = {}
+        for file_path in file_paths:
+            try:
+                info = dcparser.parse(file_path)
+            except ParseError, e:
+                print self.style.ERROR("%s: %s. Skipping." % (file_path, e))
+                self.files_skipped += 1
+                continue
+            slug = info.url.slug
+            if slug in slugs:
+                print self.style.ERROR("%s: Same slug as in %s. Skipping." % (file_path, slugs[slug]))
+                self.files_skipped += 1
+                continue
+            slugs[slug] = file_path
+            parts[file_path] = [part.slug for part in getattr(info, 'parts', [])]
+        return dict((file_path, set(slugs[slug] for slug in part_slugs if slug in slugs))
+                    for file_path, part_slugs in parts.iteritems())
+
+    @staticmethod
+    def dependents(dependencies):
+        """Reverses the dependencies: file path -> files containing it."""
+        dependents = {}
+        for key, value in dependencies.iteritems():
+            for dependency in value:
+                dependents.setdefault(dependency, []).append(key)
+        return dependents
+
+    @classmethod
+    def topological_order(cls, dependencies):
+        """Orders files so that parts come before the books containing them."""
+        waiting = dict((key, set(value)) for key, value in dependencies.iteritems())
+        dependents = cls.dependents(dependencies)
+        order = []
+        ready = sorted(key for key, value in waiting.iteritems() if not value)
+        while ready:
+            current = ready.pop(0)
+            del waiting[current]
+            order.append(current)
+            for key in dependents.get(current, ()):
+                waiting[key].remove(current)
+                if not waiting[key]:
+                    ready.append(key)
+        if waiting:
+            raise CommandError("Circular parts dependency in: %s" % ", ".join(sorted(waiting)))
+        return order
+
+    def report_progress(self, file_path):
+        if self.verbose > 0:
+            print "Parsing '%s'" % file_path
+        else:
+            sys.stdout.write('.')
+            sys.stdout.flush()
+
+    def book_imported(self, rebuilt):
+        self.files_imported += 1
+        if self.verbose > 0:
+            print "Rebuilt: %s" % (", ".join(rebuilt) or "nothing")
+        for what in rebuilt:
+            self.rebuilt[what] = self.rebuilt.get(what, 0) + 1
+
+    def import_sequential(self, file_paths, options):
+        from django.db import transaction
+
+        import_picture = options.get('import_picture')
+        for file_path in file_paths:
+            self.report_progress(file_path)
+
+            if (options.get('changed_only') and not import_picture
+                    and self.unchanged(file_path)):
+                if self.verbose > 0:
+                    print "Unchanged, skipping."
+                self.files_unchanged += 1
+                continue
+
+            # Import book files
+            try:
+                if import_picture:
+                    self.import_picture(file_path, options)
+                    self.files_imported += 1
+                else:
+                    book = self.import_book(file_path, options)
+                    self.book_imported(book.rebuilt)
+                transaction.commit()
+
+            except (Book.AlreadyExists, Picture.AlreadyExists):
+                print self.style.ERROR('%s: Book or Picture already imported. Skipping. To overwrite use --force.' %
+                    file_path)
+                self.files_skipped += 1
+
+            except Book.DoesNotExist, e:
+                # parts are always imported first, so it's really missing
+                transaction.rollback()
+                print self.style.ERROR('%s: %s Skipping.' % (file_path, e))
+                self.files_skipped += 1
+
+    def import_parallel(self, dependencies, options, jobs):
+        """Imports books in worker processes, each one after all its parts.
+
+        Every book is imported in its own process, so that one taking longer
+        than --timeout can be killed. The workers also parse the books for
+        the search index; the index is written here, in the main process,
+        with a single index writer, as the books get imported.
+
+        """
+        from collections import deque
+        from multiprocessing import Pipe, Process
+        from select import select
+        from django.db import transaction
+
+        search_index = options.get('search_index') and not settings.NO_SEARCH_INDEX
+        # workers parse the books for the index, the main process writes it
+        worker_options = dict(options, search_index=False, extract_search=search_index)
+        timeout = options.get('timeout')
+
+        waiting = dict((key, set(value)) for key, value in dependencies.iteritems())
+        dependents = self.dependents(dependencies)
+        retried = set()
+        ready = deque()
+        # file path -> (process, connection, start time)
+        running = {}
+
+        def submit(file_path):
+            ready.append(file_path)
+
+        def run(file_path):
+            self.report_progress(file_path)
+            conn, child_conn = Pipe(duplex=False)
+            process = Process(target=_import_process,
+                              args=(child_conn, file_path, worker_options))
+            process.daemon = True
+            process.start()
+            child_conn.close()
+            running[file_path] = process, conn, time.time()
+
+        def stop(file_path):
+            process, conn, started = running.pop(file_path)
+            if process.is_alive():
+                process.terminate()
+            process.join()
+            conn.close()
+
+        def results():
+            """Waits for results of running imports and yields them.
+
+            An import which takes too long is killed, so it can't be
+            committed after being reported as skipped.
+
+            """
+            conns = dict((conn, file_path) for file_path, (process, conn, started)
+                         in running.iteritems())
+            readable = select(conns.keys(), [], [], 1)[0]
+            for conn in readable:
+                file_path = conns[conn]
+                try:
+                    result = conn.recv()
+                except EOFError:
+                    # the worker died
+                    result = file_path, None, [], ('error', 'Worker process died.'), None
+                stop(file_path)
+                yield result
+            now = time.time()
+            for file_path, (process, conn, started) in running.items():
+                if timeout and now - started > timeout:
+                    stop(file_path)
+                    yield file_path, None, [], ('timeout', None), None
+
+        def done(file_path):
+            """Releases books waiting for this one."""
+            for key in dependents.get(file_path, ()):
+                waiting[key].remove(file_path)
+                if not waiting[key]:
+                    start(key)
+
+        def failed(file_path):
+            """Gives up on books containing this one."""
+            for key in dependents.get(file_path, ()):
+                if key in waiting:
+                    del waiting[key]
+                    print self.style.ERROR('%s: Part %s not imported. Skipping.' % (key, file_path))
+                    self.files_skipped += 1
+                    failed(key)
+
+        def start(file_path):
+            del waiting[file_path]
+            if options.get('changed_only'):
+                # see changes made by the workers
+                transaction.commit()
+                if self.unchanged(file_path):
+                    if self.verbose > 0:
+                        print "%s unchanged, skipping." % file_path
+                    self.files_unchanged += 1
+                    done(file_path)
+                    return
+            submit(file_path)
+
+        try:
+            for file_path in sorted(key for key, value in waiting.items() if not value):
+                start(file_path)
+
+            while ready or running:
+                while ready and len(running) < jobs:
+                    run(ready.popleft())
+                for file_path, book_id, rebuilt, error, extracted in results():
+                    if error is None:
+                        transaction.commit()
+                        if search_index:
+                            book = Book.objects.get(pk=book_id)
+                            search_hash = book.search_hash()
+                            if book.built_hashes.get('search') != search_hash:
+                                book.search_index(reuse_index=True, index_tags=False,
+                                                  extracted=extracted)
+                                book.built_hashes['search'] = search_hash
+                                book.save()
+                                transaction.commit()
+                                rebuilt = rebuilt + ['search']
+                        self.book_imported(rebuilt)
+                        done(file_path)
+                    elif error[0] == 'retry' and file_path not in retried:
+                        retried.add(file_path)
+                        submit(file_path)
+                    else:
+                        if error[0] == 'exists':
+                            print self.style.ERROR('%s: Book already imported. Skipping. To overwrite use --force.' %
+                                file_path)
+                        elif error[0] == 'timeout':
+                            print self.style.ERROR('%s: Import timed out. Skipping.' % file_path)
+                        else:
+                            print self.style.ERROR('%s: Import failed. Skipping.\n%s' % (file_path, error[1]))
+                        self.files_skipped += 1
+                        failed(file_path)
+        finally:
+            for file_path in running.keys():
+                stop(file_path)
+            if search_index:
+                ReusableIndex.close_reusable()
+
     def handle(self, *directories, **options):
         from django.db import transaction
 
         self.style = color_style()
 
-        verbose = options.get('verbose')
+        verbose = self.verbose = options.get('verbose')
         force = options.get('force')
         show_traceback = options.get('traceback', False)
         import_picture = options.get('import_picture')
+        jobs = options.get('jobs') or 1
 
         wait_until = None
         if options.get('wait_until'):
@@ -95,60 +403,41 @@ class Command(BaseCommand):
         transaction.enter_transaction_management()
         transaction.managed(True)
 
-        files_imported = 0
-        files_skipped = 0
-        
+        self.files_imported = 0
+        self.files_skipped = 0
+        self.files_unchanged = 0
+        self.rebuilt = {}
+
+        file_paths = []
         for dir_name in directories:
             if not os.path.isdir(dir_name):
                 print self.style.ERROR("%s: Not a directory. Skipping." % dir_name)
             else:
-                # files queue
-                files = sorted(os.listdir(dir_name))
-                postponed = {}
-                while files:
-                    file_name = files.pop(0)
-                    file_path = os.path.join(dir_name, file_name)
-                    file_base, ext = os.path.splitext(file_path)
-
-                    # Skip files that are not XML files
-                    if not ext == '.xml':
-                        continue
-
-                    if verbose > 0:
-                        print "Parsing '%s'" % file_path
-                    else:
-                        sys.stdout.write('.')
-                        sys.stdout.flush()
+                # Skip files that are not XML files
+                file_paths.extend(os.path.join(dir_name, file_name)
+                    for file_name in sorted(os.listdir(dir_name))
+                    if os.path.splitext(file_name)[1] == '.xml')
 
-                    # Import book files
-                    try:
-                        if import_picture:
-                            self.import_picture(file_path, options)
-                        else:
-                            self.import_book(file_path, options)
-                        files_imported += 1
-                        transaction.commit()
-                        
-                    except (Book.AlreadyExists, Picture.AlreadyExists):
-                        print self.style.ERROR('%s: Book or Picture already imported. Skipping. To overwrite use --force.' %
-                            file_path)
-                        files_skipped += 1
-
-                    except Book.DoesNotExist, e:
-                        if file_name not in postponed or postponed[file_name] < files_imported:
-                            # push it back into the queue, maybe the missing child will show up
-                            if verbose:
-                                print self.style.NOTICE('Waiting for missing children')
-                            files.append(file_name)
-                            postponed[file_name] = files_imported
-                        else:
-                            # we're in a loop, nothing's being imported - some child is really missing
-                            raise e
+        if import_picture:
+            self.import_sequential(file_paths, options)
+        else:
+            # Scan all the files first, so that parts are imported before
+            # the books containing them.
+            dependencies = self.scan(file_paths)
+            order = self.topological_order(dependencies)
+            if jobs > 1:
+                transaction.commit()
+                self.import_parallel(dependencies, options, jobs)
+            else:
+                self.import_sequential(order, options)
 
         # Print results
         print
-        print "Results: %d files imported, %d skipped, %d total." % (
-            files_imported, files_skipped, files_imported + files_skipped)
+        print "Results: %d files imported, %d skipped, %d unchanged, %d total." % (
+            self.files_imported, self.files_skipped, self.files_unchanged,
+            self.files_imported + self.files_skipped + self.files_unchanged)
+        if self.rebuilt:
+            print "Rebuilt: %s." % ", ".join("%s: %d" % item for item in sorted(self.rebuilt.items()))
         print
 
         if wait_until:
@@ -160,4 +449,3 @@ class Command(BaseCommand):
 
         transaction.commit()
         transaction.leave_transaction_management()
-
@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+# This file is part of Wolnelektury, licensed under GNU Affero GPLv3 or later.
+# Copyright © Fundacja Nowoczesna Polska. See NOTICE for more information.
+#
+from time import time
+
+from django.core.management.base import NoArgsCommand
+
+from catalogue.models import Book
+
+
+class Command(NoArgsCommand):
+    help = 'Computes and caches tag and theme counters for all books.'
+
+    def handle_noargs(self, **options):
+        verbose = int(options.get('verbosity'))
+
+        start = time()
+        count = Book.warm_counters()
+        if verbose >= 1:
+            print "Counters for %d books cached in %.1fs." % (count, time() - start)
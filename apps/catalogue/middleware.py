@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+# This file is part of Wolnelektury, licensed under GNU Affero GPLv3 or later.
+# Copyright © Fundacja Nowoczesna Polska. See NOTICE for more information.
+#
+from threading import local
+
+from django.middleware import cache
+
+from catalogue import cache_versions
+
+
+class CatalogueVersionMixin(object):
+    """Makes whole-page cache keys include the catalogue version.
+
+    Any change to books or tags then invalidates all cached pages at once,
+    so they can be kept for a long time.
+
+    The version is read once per request, when looking the page up, and
+    the response is stored under the same one: a page rendered from data
+    older than a bump made meanwhile mustn't be stored under the new key.
+    Middleware instances are shared, so the version for the request being
+    handled is kept in a thread-local.
+
+    """
+    _local = local()
+
+    def _get_key_prefix(self):
+        return "%s.%s" % (self._key_prefix, self._local.generation)
+
+    def _set_key_prefix(self, value):
+        self._key_prefix = value
+
+    key_prefix = property(_get_key_prefix, _set_key_prefix)
+
+
+class UpdateCacheMiddleware(CatalogueVersionMixin, cache.UpdateCacheMiddleware):
+    def process_response(self, request, response):
+        generation = getattr(request, 'catalogue_generation', None)
+        if generation is None:
+            generation = cache_versions.generation(cache_versions.CATALOGUE)
+        self._local.generation = generation
+        return super(UpdateCacheMiddleware, self).process_response(request, response)
+
+
+class FetchFromCacheMiddleware(CatalogueVersionMixin, cache.FetchFromCacheMiddleware):
+    def process_request(self, request):
+        request.catalogue_generation = self._local.generation = \
+            cache_versions.generation(cache_versions.CATALOGUE)
+        return super(FetchFromCacheMiddleware, self).process_request(request)
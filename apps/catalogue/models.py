@@ -15,7 +15,11 @@ from django.utils.datastructures import SortedDict
 from django.utils.safestring import mark_safe
 from django.utils.translation import get_language
 from django.core.urlresolvers import reverse
+from django.core.signals import request_started, request_finished
 from django.db.models.signals import post_save, pre_delete, post_delete
+from django.db.models.sql import DeleteQuery
+from django.contrib.contenttypes.models import ContentType
+from celery.signals import task_prerun, task_postrun
 import jsonfield
 
 from django.conf import settings
@@ -23,9 +27,14 @@ from django.conf import settings
 from newtagging.models import TagBase, tags_updated
 from newtagging import managers
 from catalogue.fields import OverwritingFileField
-from catalogue.utils import create_zip, split_tags, truncate_html_words
+from catalogue.utils import create_zip, split_tags, truncate_html_words, chunks
 from catalogue import tasks
+from catalogue import tag_index
+from catalogue import cache_versions
+from catalogue import prefix_index
 import re
+import hashlib
+import json
 
 
 # Those are hard-coded here so that makemessages sees them.
@@ -43,6 +52,15 @@ TAG_CATEGORIES = (
 permanent_cache = get_cache('permanent')
 
 
+def catalogue_version():
+    """Version of the catalogue, changing whenever any book or tag changes."""
+    return cache_versions.generation(cache_versions.CATALOGUE)
+
+
+def bump_catalogue_version():
+    cache_versions.bump(cache_versions.CATALOGUE)
+
+
 class TagSubcategoryManager(models.Manager):
     def __init__(self, subcategory):
         super(TagSubcategoryManager, self).__init__()
@@ -124,6 +142,89 @@ class Tag(TagBase):
                     objects = objects.exclude(pk__in=descendants_keys)
         return objects.count()
 
+    @classmethod
+    def get_counts(cls, tag_ids):
+        """Same as `get_count`, for many tags at once.
+
+        Uses one query for themes, one for other tags, and one for the
+        book hierarchy to eliminate descendants.
+
+        """
+        from django.db.models import Count
+
+        categories = dict(cls.objects.filter(pk__in=tag_ids).values_list('pk', 'category'))
+        counts = dict((pk, 0) for pk in categories)
+        relations = cls.intermediary_table_model.objects.order_by()
+
+        theme_ids = [pk for pk, category in categories.iteritems() if category == 'theme']
+        if theme_ids:
+            for row in relations.filter(tag__in=theme_ids,
+                    content_type=ContentType.objects.get_for_model(Fragment)
+                    ).values('tag').annotate(count=Count('pk')):
+                counts[row['tag']] = row['count']
+
+        book_tag_ids = [pk for pk, category in categories.iteritems()
+                        if category not in ('theme', 'book')]
+        if book_tag_ids:
+            for tag_id, book_ids in cls.get_books(book_tag_ids, categories,
+                                                  ordered=False).iteritems():
+                counts[tag_id] = len(book_ids)
+        return counts
+
+    @classmethod
+    def get_books(cls, tag_ids, categories=None, ordered=True):
+        """Ids of books tagged with each of given tags, at once.
+
+        Like `Book.tagged_top_level`, books with an ancestor tagged with
+        the same tag are left out, except for user sets. Uses one query
+        for the tags and one for the book hierarchy (unless all the tags
+        are sets). If `ordered`, books are in `sort_key` order, like in
+        `tagged_top_level`, which takes one more query per 1000 books.
+        Tags without books are left out.
+
+        """
+        if categories is None:
+            categories = dict(cls.objects.filter(pk__in=tag_ids).values_list('pk', 'category'))
+        tag_books = {}
+        for tag_id, book_id in cls.intermediary_table_model.objects.filter(
+                tag__in=tag_ids,
+                content_type=ContentType.objects.get_for_model(Book)
+                ).order_by().values_list('tag', 'object_id').iterator():
+            tag_books.setdefault(tag_id, set()).add(book_id)
+        parents = {}
+        if any(categories[tag_id] != 'set' for tag_id in tag_books):
+            parents = dict(Book.objects.exclude(parent=None).values_list(
+                    'pk', 'parent').iterator())
+
+        def has_ancestor_in(book_id, book_ids):
+            parent = parents.get(book_id)
+            while parent is not None:
+                if parent in book_ids:
+                    return True
+                parent = parents.get(parent)
+            return False
+
+        books = {}
+        for tag_id, book_ids in tag_books.iteritems():
+            if categories[tag_id] == 'set':
+                books[tag_id] = list(book_ids)
+            else:
+                # eliminate descendants
+                books[tag_id] = [pk for pk in book_ids
+                                 if not has_ancestor_in(pk, book_ids)]
+
+        if ordered and books:
+            all_ids = set()
+            for book_ids in books.itervalues():
+                all_ids.update(book_ids)
+            sort_keys = {}
+            for chunk in chunks(list(all_ids), 1000):
+                sort_keys.update(Book.objects.filter(pk__in=chunk).values_list(
+                    'pk', 'sort_key').iterator())
+            for book_ids in books.itervalues():
+                book_ids.sort(key=lambda pk: (sort_keys.get(pk), pk))
+        return books
+
     @staticmethod
     def get_tag_list(tags):
         if isinstance(tags, basestring):
@@ -352,6 +453,8 @@ class Book(models.Model):
     parent        = models.ForeignKey('self', blank=True, null=True, related_name='children')
 
     _related_info = jsonfield.JSONField(blank=True, null=True, editable=False)
+    # source hashes of built files, by format
+    built_hashes = jsonfield.JSONField(default='{}', editable=False)
 
     objects  = models.Manager()
     tagged   = managers.ModelTaggedItemManager(Tag)
@@ -432,9 +535,8 @@ class Book(models.Model):
             return
 
         type(self).objects.filter(pk=self.pk).update(_related_info=None)
-        # Fragment.short_html relies on book's tags, so reset it here too
-        for fragm in self.fragments.all().iterator():
-            fragm.reset_short_html()
+        # Fragment.short_html relies on book's tags, so it depends on the book
+        cache_versions.bump(('book', self.pk))
 
     def has_description(self):
         return len(self.description) > 0
@@ -465,6 +567,48 @@ class Book(models.Model):
                 provider=ORMDocProvider(self),
                 parse_dublincore=parse_dublincore)
 
+    @staticmethod
+    def build_environment():
+        """Describes things other than XML source which affect built files."""
+        from pkg_resources import get_distribution, DistributionNotFound
+        try:
+            librarian_version = get_distribution('librarian').version
+        except DistributionNotFound:
+            librarian_version = None
+        return repr((librarian_version, settings.LIBRARIAN_PDF_MOREFLOATS))
+
+    def source_hash(self, xml_path=None):
+        """Hash of the book's XML source, including all descendants.
+
+        Includes the `build_environment`, so changing librarian version
+        or build settings invalidates all the hashes.
+
+        """
+        source_hash = hashlib.sha1(self.build_environment())
+        with open(xml_path or self.xml_file.path) as f:
+            source_hash.update(f.read())
+        for child in self.children.all().order_by('parent_number').iterator():
+            source_hash.update(child.source_hash())
+        return source_hash.hexdigest()
+
+    def publish_hash(self, source_hash=None):
+        """Hash of everything the HTML, cover and search index depend on."""
+        if source_hash is None:
+            source_hash = self.source_hash()
+        return hashlib.sha1(source_hash + json.dumps(
+                self.extra_info, sort_keys=True)).hexdigest()
+
+    def search_hash(self, publish_hash=None):
+        """Like `publish_hash`, but also identifies the current search index.
+
+        Rebuilding or replacing the index makes the stored hashes stale.
+
+        """
+        from search.index import index_id
+        if publish_hash is None:
+            publish_hash = self.publish_hash()
+        return "%s/%s" % (index_id(), publish_hash)
+
     def build_cover(self, book_info=None):
         """(Re)builds the cover image."""
         from StringIO import StringIO
@@ -479,7 +623,26 @@ class Book(models.Model):
         cover.save(imgstr, 'png')
         self.cover.save(None, ContentFile(imgstr.getvalue()))
 
-    def build_html(self):
+    def delete_fragments(self):
+        """Deletes all fragments of the book along with their tag relations.
+
+        Doesn't send pre_delete for every single object, so that's much
+        faster than `self.fragments.all().delete()`. Returns ids of the
+        themes which were used.
+
+        """
+        relations = Tag.intermediary_table_model.objects.filter(
+            content_type=ContentType.objects.get_for_model(Fragment),
+            object_id__in=self.fragments.values_list('pk', flat=True))
+        affected_themes = set(relations.filter(tag__category='theme').order_by(
+            ).values_list('tag', flat=True).distinct())
+        DeleteQuery(Tag.intermediary_table_model).delete_batch(
+            list(relations.values_list('pk', flat=True)), relations.db)
+        DeleteQuery(Fragment).delete_batch(
+            list(self.fragments.values_list('pk', flat=True)), relations.db)
+        return affected_themes
+
+    def build_html(self, wldoc=None):
         from django.core.files.base import ContentFile
         from slughifi import slughifi
         from librarian import html
@@ -488,7 +651,9 @@ class Book(models.Model):
             category__in=('author', 'epoch', 'genre', 'kind')))
         book_tag = self.book_tag()
 
-        html_output = self.wldocument(parse_dublincore=False).as_html()
+        if wldoc is None:
+            wldoc = self.wldocument(parse_dublincore=False)
+        html_output = wldoc.as_html()
         if html_output:
             self.html_file.save('%s.html' % self.slug,
                     ContentFile(html_output.get_string()))
@@ -501,36 +666,67 @@ class Book(models.Model):
                 p = p.parent
 
             # Delete old fragments and create them from scratch
-            self.fragments.all().delete()
+            fragment_ct = ContentType.objects.get_for_model(Fragment)
+            affected_themes = self.delete_fragments()
+
             # Extract fragments
             closed_fragments, open_fragments = html.extract_fragments(self.html_file.path)
+            fragments_data = []
+            theme_names = {}
             for fragment in closed_fragments.values():
                 try:
-                    theme_names = [s.strip() for s in fragment.themes.split(',')]
+                    fragment_theme_names = [s.strip() for s in fragment.themes.split(',')]
                 except AttributeError:
                     continue
-                themes = []
-                for theme_name in theme_names:
+                theme_slugs = []
+                for theme_name in fragment_theme_names:
                     if not theme_name:
                         continue
-                    tag, created = Tag.objects.get_or_create(slug=slughifi(theme_name), category='theme')
-                    if created:
-                        tag.name = theme_name
-                        tag.sort_key = theme_name.lower()
-                        tag.save()
-                    themes.append(tag)
-                if not themes:
+                    theme_slug = slughifi(theme_name)
+                    theme_names.setdefault(theme_slug, theme_name)
+                    theme_slugs.append(theme_slug)
+                if not theme_slugs:
                     continue
 
                 text = fragment.to_string()
                 short_text = truncate_html_words(text, 15)
                 if text == short_text:
                     short_text = ''
-                new_fragment = Fragment.objects.create(anchor=fragment.id, book=self,
-                    text=text, short_text=short_text)
-
-                new_fragment.save()
-                new_fragment.tags = set(meta_tags + themes + [book_tag] + ancestor_tags)
+                fragments_data.append((fragment.id, text, short_text, theme_slugs))
+
+            # Get all the themes, creating missing ones
+            themes = dict((tag.slug, tag) for tag in
+                Tag.objects.filter(category='theme', slug__in=theme_names.keys()))
+            missing = [slug for slug in theme_names if slug not in themes]
+            if missing:
+                Tag.objects.bulk_create([
+                    Tag(slug=slug, category='theme', name=theme_names[slug],
+                        sort_key=theme_names[slug].lower())
+                    for slug in missing])
+                themes.update((tag.slug, tag) for tag in
+                    Tag.objects.filter(category='theme', slug__in=missing))
+
+            for chunk in chunks(fragments_data, 100):
+                Fragment.objects.bulk_create([
+                    Fragment(anchor=anchor, book=self, text=text, short_text=short_text)
+                    for anchor, text, short_text, theme_slugs in chunk])
+            fragment_keys = dict(self.fragments.values_list('anchor', 'pk'))
+
+            common_tags = set(meta_tags + [book_tag] + ancestor_tags)
+            relations_data = []
+            for anchor, text, short_text, theme_slugs in fragments_data:
+                fragment_tags = common_tags.union(themes[slug] for slug in theme_slugs)
+                relations_data.extend(
+                    Tag.intermediary_table_model(tag=tag,
+                        content_type=fragment_ct, object_id=fragment_keys[anchor])
+                    for tag in fragment_tags)
+            for chunk in chunks(relations_data, 300):
+                Tag.intermediary_table_model.objects.bulk_create(chunk)
+
+            affected_themes.update(tag.pk for tag in themes.values())
+            tag_index.object_changed('fragments', self.pk)
+            tags_updated.send(sender=self,
+                affected_tags=list(Tag.objects.filter(pk__in=affected_themes)))
             self.save()
             self.html_built.send(sender=self)
             return True
@@ -549,6 +745,9 @@ class Book(models.Model):
     def build_txt(self, *args, **kwargs):
         """(Re)builds TXT."""
         return tasks.build_txt.delay(self.pk, *args, **kwargs)
+    def build_formats(self, *args, **kwargs):
+        """(Re)builds many formats at once."""
+        return tasks.build_formats.delay(self.pk, *args, **kwargs)
 
     @staticmethod
     def zip_format(format_):
@@ -570,7 +769,8 @@ class Book(models.Model):
         paths = map(lambda bm: (None, bm.file.path), bm)
         return create_zip(paths, "%s_%s" % (self.slug, format_))
 
-    def search_index(self, book_info=None, reuse_index=False, index_tags=True):
+    def search_index(self, book_info=None, reuse_index=False, index_tags=True, wldoc=None,
+                     extracted=None):
         import search
         if reuse_index:
             idx = search.ReusableIndex()
@@ -579,12 +779,24 @@ class Book(models.Model):
             
         idx.open()
         try:
-            idx.index_book(self, book_info)
+            idx.index_book(self, book_info, wldoc=wldoc, extracted=extracted)
             if index_tags:
-                idx.index_tags()
+                tags = list(self.indexed_tags())
+                if tags:
+                    idx.index_tags(*tags)
         finally:
             idx.close()
 
+    def indexed_tags(self):
+        """Tags of the book and its fragments, as stored in search index."""
+        relations = Tag.intermediary_table_model.objects.filter(
+                models.Q(content_type=ContentType.objects.get_for_model(Book),
+                         object_id=self.pk) |
+                models.Q(content_type=ContentType.objects.get_for_model(Fragment),
+                         object_id__in=self.fragments.values_list('pk', flat=True)))
+        return Tag.objects.filter(pk__in=relations.values_list('tag', flat=True)
+                ).exclude(category='set')
+
     @classmethod
     def from_xml_file(cls, xml_file, **kwargs):
         from django.core.files import File
@@ -602,7 +814,13 @@ class Book(models.Model):
             xml_file.close()
 
     @classmethod
-    def from_text_and_meta(cls, raw_file, book_info, overwrite=False,
+    def from_text_and_meta(cls, raw_file, book_info, **kwargs):
+        # recount all the tags touched by the import together
+        with tasks.deferred_recount():
+            return cls._from_text_and_meta(raw_file, book_info, **kwargs)
+
+    @classmethod
+    def _from_text_and_meta(cls, raw_file, book_info, overwrite=False,
             build_epub=True, build_txt=True, build_pdf=True, build_mobi=True,
             search_index=True, search_index_tags=True, search_index_reuse=False):
 
@@ -655,26 +873,59 @@ class Book(models.Model):
         # Save XML and HTML files
         book.xml_file.save('%s.xml' % book.slug, raw_file, save=False)
 
-        # delete old fragments when overwriting
-        book.fragments.all().delete()
-
-        if book.build_html():
-            if not settings.NO_BUILD_TXT and build_txt:
-                book.build_txt()
-
-        book.build_cover(book_info)
-
+        # Skip whatever was already built from the very same input.
+        source_hash = book.source_hash()
+        publish_hash = book.publish_hash(source_hash)
+        book.built_hashes['xml'] = source_hash
+        # what was rebuilt (or queued to be rebuilt), for reporting
+        book.rebuilt = []
+        def up_to_date(what):
+            return book.built_hashes.get(what) == publish_hash
+
+        # parse once for HTML and search index
+        wldoc = None
+        html_ok = up_to_date('html') and bool(book.html_file)
+        if not html_ok:
+            # delete old fragments when overwriting
+            affected_themes = book.delete_fragments()
+            if affected_themes:
+                tag_index.object_changed('fragments', book.pk)
+                tags_updated.send(sender=book,
+                    affected_tags=list(Tag.objects.filter(pk__in=affected_themes)))
+
+            wldoc = book.wldocument(parse_dublincore=False)
+            html_ok = book.build_html(wldoc)
+            if html_ok:
+                book.built_hashes['html'] = publish_hash
+                book.rebuilt.append('html')
+
+        if not (up_to_date('cover') and book.cover):
+            book.build_cover(book_info)
+            book.built_hashes['cover'] = publish_hash
+            book.rebuilt.append('cover')
+
+        formats = []
+        if html_ok and not settings.NO_BUILD_TXT and build_txt:
+            formats.append('txt')
         if not settings.NO_BUILD_EPUB and build_epub:
-            book.build_epub()
-
+            formats.append('epub')
         if not settings.NO_BUILD_PDF and build_pdf:
-            book.build_pdf()
-
+            formats.append('pdf')
         if not settings.NO_BUILD_MOBI and build_mobi:
-            book.build_mobi()
-
-        if not settings.NO_SEARCH_INDEX and search_index:
-            book.search_index(index_tags=search_index_tags, reuse_index=search_index_reuse)
+            formats.append('mobi')
+        formats = [format_ for format_ in formats
+                   if book.built_hashes.get(format_) != source_hash
+                   or not getattr(book, '%s_file' % format_)]
+        book.rebuilt.extend(formats)
+
+        if not settings.NO_SEARCH_INDEX and search_index and \
+                book.built_hashes.get('search') != book.search_hash(publish_hash):
+            if wldoc is None:
+                wldoc = book.wldocument(parse_dublincore=False)
+            book.search_index(index_tags=search_index_tags, reuse_index=search_index_reuse,
+                wldoc=wldoc)
+            book.built_hashes['search'] = book.search_hash(publish_hash)
+            book.rebuilt.append('search')
             #index_book.delay(book.id, book_info)
 
         book_descendants = list(book.children.all())
@@ -693,6 +944,12 @@ class Book(models.Model):
             tasks.touch_tag(tag)
 
         book.save()
+        tasks.flush_dirty_tags()
+
+        # The tasks save the files in fresh instances, so start them
+        # after saving this one.
+        if formats:
+            book.build_formats(formats)
 
         # refresh cache
         book.reset_tag_counter()
@@ -742,8 +999,7 @@ class Book(models.Model):
         if self.id is None:
             return
 
-        cache_key = "Book.tag_counter/%d" % self.id
-        permanent_cache.delete(cache_key)
+        cache_versions.bump(('Book.tag_counter', self.id))
         if self.parent:
             self.parent.reset_tag_counter()
 
@@ -751,7 +1007,8 @@ class Book(models.Model):
     def tag_counter(self):
         if self.id:
             cache_key = "Book.tag_counter/%d" % self.id
-            tags = permanent_cache.get(cache_key)
+            cache_deps = [('Book.tag_counter', self.id)]
+            tags = cache_versions.get_cached(cache_key, cache_deps)
         else:
             tags = None
 
@@ -764,15 +1021,107 @@ class Book(models.Model):
                 tags[tag.pk] = 1
 
             if self.id:
-                permanent_cache.set(cache_key, tags)
+                cache_versions.set_cached(cache_key, tags, cache_deps)
         return tags
 
+    @classmethod
+    def tag_counters_for(cls, book_ids):
+        """Returns a dict of `tag_counter`s for many books at once.
+
+        Cached counters are fetched in one go, missing ones are computed
+        with one query per level of book hierarchy and one query for tags.
+
+        """
+        keys = cls._counter_keys('Book.tag_counter', book_ids)
+        counters = cls._get_counters(keys)
+        missing = [pk for pk in keys if pk not in counters]
+        if missing:
+            computed = cls._tag_counters_uncached(missing)
+            permanent_cache.set_many(dict(
+                (keys[pk], computed[pk]) for pk in computed))
+            counters.update(computed)
+        return counters
+
+    @staticmethod
+    def _counter_keys(name, book_ids):
+        """Maps book ids to versioned cache keys of their counters."""
+        keys = dict((pk, "%s/%d" % (name, pk)) for pk in book_ids)
+        versioned = cache_versions.versioned_keys(dict(
+            (key, [(name, pk)]) for pk, key in keys.iteritems()))
+        return dict((pk, versioned[key]) for pk, key in keys.iteritems())
+
+    @staticmethod
+    def _get_counters(keys):
+        found = permanent_cache.get_many(keys.values())
+        return dict((pk, found[key]) for pk, key in keys.iteritems() if key in found)
+
+    @classmethod
+    def warm_counters(cls):
+        """Computes and caches tag and theme counters of all books."""
+        tag_counters = cls._tag_counters_uncached()
+        theme_counters = cls._theme_counters_uncached()
+        cache_data = {}
+        keys = cls._counter_keys('Book.tag_counter', tag_counters)
+        for pk in tag_counters:
+            cache_data[keys[pk]] = tag_counters[pk]
+        keys = cls._counter_keys('Book.theme_counter', theme_counters)
+        for pk in theme_counters:
+            cache_data[keys[pk]] = theme_counters[pk]
+        permanent_cache.set_many(cache_data)
+        return len(tag_counters)
+
+    @classmethod
+    def _tag_counters_uncached(cls, book_ids=None):
+        """Computes `tag_counter`s of given books (or all books)."""
+        relations = Tag.intermediary_table_model.objects.filter(
+                content_type=ContentType.objects.get_for_model(cls)).exclude(
+                tag__category__in=('book', 'theme', 'set')).order_by()
+        children = {}
+        if book_ids is None:
+            book_ids = []
+            for pk, parent_id in cls.objects.order_by().values_list(
+                    'pk', 'parent').iterator():
+                book_ids.append(pk)
+                if parent_id is not None:
+                    children.setdefault(parent_id, []).append(pk)
+        else:
+            # collect the whole subtrees
+            all_ids = set(book_ids)
+            level = list(book_ids)
+            while level:
+                next_level = []
+                for pk, parent_id in cls.objects.filter(parent__in=level).order_by(
+                        ).values_list('pk', 'parent').iterator():
+                    children.setdefault(parent_id, []).append(pk)
+                    if pk not in all_ids:
+                        all_ids.add(pk)
+                        next_level.append(pk)
+                level = next_level
+            relations = relations.filter(object_id__in=all_ids)
+
+        own_tags = {}
+        for object_id, tag_id in relations.values_list('object_id', 'tag').iterator():
+            own_tags.setdefault(object_id, []).append(tag_id)
+
+        counters = {}
+        def counter(pk):
+            if pk not in counters:
+                tags = {}
+                for child in children.get(pk, ()):
+                    for tag_pk, value in counter(child).iteritems():
+                        tags[tag_pk] = tags.get(tag_pk, 0) + value
+                for tag_pk in own_tags.get(pk, ()):
+                    tags[tag_pk] = 1
+                counters[pk] = tags
+            return counters[pk]
+
+        return dict((pk, counter(pk)) for pk in book_ids)
+
     def reset_theme_counter(self):
         if self.id is None:
             return
 
-        cache_key = "Book.theme_counter/%d" % self.id
-        permanent_cache.delete(cache_key)
+        cache_versions.bump(('Book.theme_counter', self.id))
         if self.parent:
             self.parent.reset_theme_counter()
 
@@ -780,20 +1129,91 @@ class Book(models.Model):
     def theme_counter(self):
         if self.id:
             cache_key = "Book.theme_counter/%d" % self.id
-            tags = permanent_cache.get(cache_key)
+            cache_deps = [('Book.theme_counter', self.id)]
+            tags = cache_versions.get_cached(cache_key, cache_deps)
         else:
             tags = None
 
         if tags is None:
-            tags = {}
-            for fragment in Fragment.tagged.with_any([self.book_tag()]).order_by().iterator():
-                for tag in fragment.tags.filter(category='theme').order_by().iterator():
-                    tags[tag.pk] = tags.get(tag.pk, 0) + 1
-
+            tags = self._theme_counter_uncached()
             if self.id:
-                permanent_cache.set(cache_key, tags)
+                cache_versions.set_cached(cache_key, tags, cache_deps)
         return tags
 
+    def _theme_counter_uncached(self):
+        return type(self)._theme_counters_uncached([self])[self.pk]
+
+    @classmethod
+    def _theme_counters_uncached(cls, books=None):
+        """Counts themes in fragments of given books (or all books).
+
+        Fragments of a book and its descendants share the book's l-tag,
+        so it's just one query over the tag relation table, grouped
+        by the l-tag and the theme.
+
+        """
+        from django.db import connection
+
+        qn = connection.ops.quote_name
+        relation_table = qn(Tag.intermediary_table_model._meta.db_table)
+        tag_table = qn(Tag._meta.db_table)
+
+        all_books = books is None
+        if all_books:
+            books = cls.objects.all().only('slug')
+            l_tags = Tag.objects.filter(category='book')
+        else:
+            l_tags = Tag.objects.filter(category='book',
+                slug__in=[book.book_tag_slug() for book in books])
+        books = list(books)
+        counters = dict((book.pk, {}) for book in books)
+        l_tags = dict(l_tags.values_list('slug', 'pk'))
+        book_for_tag = dict((l_tags[book.book_tag_slug()], book.pk)
+                for book in books if book.book_tag_slug() in l_tags)
+        if not book_for_tag:
+            return counters
+
+        query = """
+            SELECT l.tag_id, t.tag_id, COUNT(*)
+            FROM %(relation)s l
+            JOIN %(relation)s t
+                ON t.object_id = l.object_id AND t.content_type_id = l.content_type_id
+            JOIN %(tag)s theme ON theme.id = t.tag_id
+            JOIN %(tag)s l_tag ON l_tag.id = l.tag_id
+            WHERE l.content_type_id = %%s AND theme.category = 'theme'
+                AND l_tag.category = 'book'
+            %(book_filter)s
+            GROUP BY l.tag_id, t.tag_id
+            """ % {
+                'relation': relation_table,
+                'tag': tag_table,
+                'book_filter': "" if all_books else "AND l.tag_id IN (%s)" % ", ".join(
+                        "%s" for pk in book_for_tag),
+            }
+        params = [ContentType.objects.get_for_model(Fragment).pk]
+        if not all_books:
+            params += book_for_tag.keys()
+        cursor = connection.cursor()
+        cursor.execute(query, params)
+        for l_tag_id, theme_id, count in cursor.fetchall():
+            if l_tag_id in book_for_tag:
+                counters[book_for_tag[l_tag_id]][theme_id] = count
+        return counters
+
+    @classmethod
+    def theme_counters_for(cls, book_ids):
+        """Returns a dict of `theme_counter`s for many books at once."""
+        keys = cls._counter_keys('Book.theme_counter', book_ids)
+        counters = cls._get_counters(keys)
+        missing = [pk for pk in keys if pk not in counters]
+        if missing:
+            computed = cls._theme_counters_uncached(
+                cls.objects.filter(pk__in=missing).only('slug'))
+            permanent_cache.set_many(dict(
+                (keys[pk], computed[pk]) for pk in computed))
+            counters.update(computed)
+        return counters
+
     def pretty_title(self, html_links=False):
         book = self
         names = list(book.tags.filter(category='author'))
@@ -830,6 +1250,33 @@ class Book(models.Model):
 
         return objects
 
+    @classmethod
+    def book_list_snapshot(cls):
+        """Gets basic data of all books and their authors, for `book_list`.
+
+        Snapshot is kept in permanent cache until anything in the
+        catalogue changes.
+
+        """
+        cache_key = "Book.book_list_snapshot/%d" % catalogue_version()
+        snapshot = permanent_cache.get(cache_key)
+        if snapshot is None:
+            books = list(cls.objects.all().order_by('parent_number', 'sort_key'
+                ).values_list(*cls._book_list_fields).iterator())
+            authors = list(Tag.objects.filter(category='author').values_list(
+                'pk', flat=True).iterator())
+            book_authors = {}
+            for book_id, tag_id in Tag.intermediary_table_model.objects.filter(
+                    content_type=ContentType.objects.get_for_model(cls),
+                    tag__category='author').order_by('tag__sort_key'
+                    ).values_list('object_id', 'tag').iterator():
+                book_authors.setdefault(book_id, []).append(tag_id)
+            snapshot = books, authors, book_authors
+            permanent_cache.set(cache_key, snapshot)
+        return snapshot
+
+    _book_list_fields = ('id', 'title', 'slug', 'parent_id')
+
     @classmethod
     def book_list(cls, filter=None):
         """Generates a hierarchical listing of all books.
@@ -837,33 +1284,43 @@ class Book(models.Model):
         Books are optionally filtered with a test function.
 
         """
+        from django.db.models.query_utils import deferred_class_factory
+
+        books, authors, book_authors = cls.book_list_snapshot()
+
+        # Instances with just the listed fields, like from `only()`.
+        book_class = deferred_class_factory(cls, set(f.attname
+            for f in cls._meta.fields if f.attname not in cls._book_list_fields))
 
         books_by_parent = {}
-        books = cls.objects.all().order_by('parent_number', 'sort_key').only(
-                'title', 'parent', 'slug')
         if filter:
-            books = books.filter(filter).distinct()
-            
-            book_ids = set(b['pk'] for b in books.values("pk").iterator())
-            for book in books.iterator():
+            book_ids = set(cls.objects.filter(filter).values_list('pk', flat=True))
+            for row in books:
+                if row[0] not in book_ids:
+                    continue
+                book = book_class(**dict(zip(cls._book_list_fields, row)))
                 parent = book.parent_id
                 if parent not in book_ids:
                     parent = None
                 books_by_parent.setdefault(parent, []).append(book)
         else:
-            for book in books.iterator():
+            for row in books:
+                book = book_class(**dict(zip(cls._book_list_fields, row)))
                 books_by_parent.setdefault(book.parent_id, []).append(book)
 
         orphans = []
         books_by_author = SortedDict()
-        for tag in Tag.objects.filter(category='author').iterator():
-            books_by_author[tag] = []
+        author_tags = Tag.objects.in_bulk(authors)
+        for author_id in authors:
+            if author_id in author_tags:
+                books_by_author[author_tags[author_id]] = []
 
         for book in books_by_parent.get(None,()):
-            authors = list(book.tags.filter(category='author'))
-            if authors:
-                for author in authors:
-                    books_by_author[author].append(book)
+            author_ids = [author_id for author_id in book_authors.get(book.pk, ())
+                          if author_id in author_tags]
+            if author_ids:
+                for author_id in author_ids:
+                    books_by_author[author_tags[author_id]].append(book)
             else:
                 orphans.append(book)
 
@@ -935,9 +1392,7 @@ class Fragment(models.Model):
         if self.id is None:
             return
 
-        cache_key = "Fragment.short_html/%d/%s"
-        for lang, langname in settings.LANGUAGES:
-            permanent_cache.delete(cache_key % (self.id, lang))
+        cache_versions.bump(('fragment', self.id))
 
     def get_short_text(self):
         """Returns short version of the fragment."""
@@ -946,7 +1401,8 @@ class Fragment(models.Model):
     def short_html(self):
         if self.id:
             cache_key = "Fragment.short_html/%d/%s" % (self.id, get_language())
-            short_html = permanent_cache.get(cache_key)
+            cache_deps = [('fragment', self.id), ('book', self.book_id)]
+            short_html = cache_versions.get_cached(cache_key, cache_deps)
         else:
             short_html = None
 
@@ -956,7 +1412,7 @@ class Fragment(models.Model):
             short_html = unicode(render_to_string('catalogue/fragment_short.html',
                 {'fragment': self}))
             if self.id:
-                permanent_cache.set(cache_key, short_html)
+                cache_versions.set_cached(cache_key, short_html, cache_deps)
             return mark_safe(short_html)
 
 
@@ -986,16 +1442,28 @@ class Collection(models.Model):
 
 
 def _tags_updated_handler(sender, affected_tags, **kwargs):
-    # reset tag global counter
+    # keep in-process tag index up to date
+    if isinstance(sender, Book):
+        tag_index.object_changed('book', sender.pk)
+    elif isinstance(sender, Fragment):
+        tag_index.object_changed('fragment', sender.pk)
+
+    # mark tags for recounting global counter
     # we want Tag.changed_at updated for API to know the tag was touched
-    for tag in affected_tags:
-        tasks.touch_tag(tag)
+    with tasks.deferred_recount():
+        for tag in affected_tags:
+            tasks.touch_tag(tag)
 
     # if book tags changed, reset book tag counter
     if isinstance(sender, Book) and \
                 Tag.objects.filter(pk__in=(tag.pk for tag in affected_tags)).\
                     exclude(category__in=('book', 'theme', 'set')).count():
         sender.reset_tag_counter()
+    # if themes of book fragments changed in bulk, reset book theme counter
+    if isinstance(sender, Book) and \
+                Tag.objects.filter(pk__in=(tag.pk for tag in affected_tags)).\
+                    filter(category='theme').count():
+        sender.reset_theme_counter()
     # if fragment theme changed, reset book theme counter
     elif isinstance(sender, Fragment) and \
                 Tag.objects.filter(pk__in=(tag.pk for tag in affected_tags)).\
@@ -1004,6 +1472,20 @@ def _tags_updated_handler(sender, affected_tags, **kwargs):
 tags_updated.connect(_tags_updated_handler)
 
 
+@django.dispatch.receiver(request_started)
+@django.dispatch.receiver(task_prerun)
+def _defer_recount_handler(sender, **kwargs):
+    """ recount tags touched while handling a request or task at its end """
+    tasks.start_deferring()
+
+
+@django.dispatch.receiver(request_finished)
+@django.dispatch.receiver(task_postrun)
+def _flush_dirty_tags_handler(sender, **kwargs):
+    """ recount tags touched while handling a request or task """
+    tasks.stop_deferring()
+
+
 def _pre_delete_handler(sender, instance, **kwargs):
     """ refresh Book on BookMedia delete """
     if sender == BookMedia:
@@ -1018,6 +1500,40 @@ def _post_save_handler(sender, instance, **kwargs):
 post_save.connect(_post_save_handler)
 
 
+@django.dispatch.receiver(post_save, sender=Book)
+@django.dispatch.receiver(post_delete, sender=Book)
+def _book_changed_tag_index_handler(sender, instance, **kwargs):
+    """ book hierarchy is a part of tag index """
+    tag_index.object_changed('book', instance.pk)
+
+
+@django.dispatch.receiver(post_delete, sender=Tag)
+def _tag_deleted_tag_index_handler(sender, instance, **kwargs):
+    """ relations to a deleted tag are gone without notice """
+    tag_index.object_changed('tag', instance.pk)
+
+
+@django.dispatch.receiver(Book.published)
+@django.dispatch.receiver(post_save, sender=Book)
+@django.dispatch.receiver(post_delete, sender=Book)
+@django.dispatch.receiver(post_save, sender=Tag)
+@django.dispatch.receiver(post_delete, sender=Tag)
+def _catalogue_changed_handler(sender, **kwargs):
+    # user shelves aren't a part of the public catalogue
+    instance = kwargs.get('instance')
+    if not (isinstance(instance, Tag) and instance.category == 'set'):
+        bump_catalogue_version()
+    if instance is not None:
+        prefix_index.object_changed('book' if sender is Book else 'tag', instance.pk)
+
+
+def _book_tags_updated_handler(sender, affected_tags, **kwargs):
+    if isinstance(sender, Book) and any(
+            tag.category != 'set' for tag in affected_tags):
+        bump_catalogue_version()
+tags_updated.connect(_book_tags_updated_handler)
+
+
 if not settings.NO_SEARCH_INDEX:
     @django.dispatch.receiver(post_delete, sender=Book)
     def _remove_book_from_index_handler(sender, instance, **kwargs):
@@ -0,0 +1,370 @@
+# -*- coding: utf-8 -*-
+# This file is part of Wolnelektury, licensed under GNU Affero GPLv3 or later.
+# Copyright © Fundacja Nowoczesna Polska. See NOTICE for more information.
+#
+"""In-process index of names of books, tags and pdcounter entries.
+
+Serves autocompletion: finds everything with a word in its name starting
+with a given prefix. Names are normalized (lowercased, with runs of non-word
+characters replaced by single spaces) and folded to their diacritic-less
+form, character by character. Folded suffixes of names starting at word
+boundaries are kept in a sorted array, so a lookup is a binary search.
+
+A prefix without diacritics matches names both with and without them,
+but a prefix with diacritics matches only names having them too.
+
+The index is kept in sync incrementally, like `tag_index`: every change
+of a named object is logged in the permanent cache under a generation
+counter, and processes patch their indexes with just the changed entries.
+A process which missed too many changes rebuilds its index in a background
+thread, and keeps using the old one meanwhile.
+
+"""
+from array import array
+from bisect import bisect_left
+import logging
+import re
+from threading import RLock, Thread
+
+from slughifi import char_map
+from sortify import sortify
+
+from django.core.cache import get_cache
+
+logger = logging.getLogger(__name__)
+
+permanent_cache = get_cache('permanent')
+
+GENERATION_KEY = 'catalogue.PrefixIndex.generation'
+CHANGE_KEY = 'catalogue.PrefixIndex.change/%d'
+# when lagging more than that, rebuild everything
+MAX_CATCH_UP = 200
+
+_WORD_RE = re.compile(r'\w+', re.UNICODE)
+_FOLD = dict((ord(c), unicode(f[0].lower())) for c, f in char_map.items() if f)
+
+# kinds of entries, in order of presentation
+KINDS = ('book', 'tag', 'pd_book', 'pd_author')
+
+_lock = RLock()
+_index = None
+_rebuilding = False
+
+
+def normalize(text):
+    return u" ".join(_WORD_RE.findall(text.lower()))
+
+
+def fold(text):
+    """Removes diacritics from normalized text, keeping its length."""
+    return text.translate(_FOLD)
+
+
+def word_starts(text):
+    """Positions of word starts in normalized text."""
+    yield 0
+    pos = text.find(u' ')
+    while pos != -1:
+        yield pos + 1
+        pos = text.find(u' ', pos + 1)
+
+
+def _diacritics_match(text, prefix, folded_prefix, pos):
+    """Checks that diacritics used in prefix are in text at `pos`, too."""
+    if prefix == folded_prefix:
+        return True
+    for p, f, t in zip(prefix, folded_prefix, text[pos:]):
+        if p != f and p != t:
+            return False
+    return True
+
+
+def word_starts_with(name, prefix):
+    """Checks if a word in name starts with the prefix, like the index does."""
+    prefix = normalize(prefix)
+    if not prefix:
+        return False
+    folded_prefix = fold(prefix)
+    text = normalize(name)
+    folded = fold(text)
+    for pos in word_starts(text):
+        if folded.startswith(folded_prefix, pos) and _diacritics_match(
+                text, prefix, folded_prefix, pos):
+            return True
+    return False
+
+
+class Entry(object):
+    """A named object in the index."""
+    __slots__ = ('kind', 'pk', 'name', 'slug', 'sort_key', 'category', 'user_id', 'text')
+
+    def __init__(self, kind, pk, name, slug, sort_key, category, user_id=None):
+        self.kind = kind
+        self.pk = pk
+        self.name = name
+        self.slug = slug
+        self.sort_key = sort_key
+        self.category = category
+        self.user_id = user_id
+        self.text = normalize(name)
+
+    def __repr__(self):
+        return "Entry(%s, %d)" % (self.kind, self.pk)
+
+    def model(self):
+        from catalogue.models import Book, Tag
+        from pdcounter.models import Author, BookStub
+        return {'book': Book, 'tag': Tag, 'pd_book': BookStub, 'pd_author': Author}[self.kind]
+
+    def get_absolute_url(self):
+        if self.kind == 'tag':
+            obj = self.model()(pk=self.pk, slug=self.slug, category=self.category)
+        else:
+            obj = self.model()(pk=self.pk, slug=self.slug)
+        return obj.get_absolute_url()
+
+
+def load_objects(entries):
+    """Replaces entries with their objects, skipping ones gone from database.
+
+    Anything else than an Entry is left as it is.
+
+    """
+    ids = {}
+    for entry in entries:
+        if isinstance(entry, Entry):
+            ids.setdefault(entry.kind, []).append(entry.pk)
+    objects = {}
+    for entry in entries:
+        if isinstance(entry, Entry) and entry.kind not in objects:
+            objects[entry.kind] = entry.model().objects.in_bulk(ids[entry.kind])
+    result = []
+    for entry in entries:
+        if isinstance(entry, Entry):
+            obj = objects[entry.kind].get(entry.pk)
+            if obj is not None:
+                result.append(obj)
+        else:
+            result.append(entry)
+    return result
+
+
+def load_entries(kind, pks=None):
+    """Entries of the given kind, from database (all, or with given pks)."""
+    from catalogue.models import Book, Tag
+    from pdcounter.models import Author, BookStub
+
+    if kind == 'book':
+        rows = Book.objects.values_list('pk', 'title', 'slug', 'sort_key')
+        make = lambda pk, title, slug, sort_key: Entry(
+            'book', pk, title, slug, sort_key, 'book')
+    elif kind == 'tag':
+        rows = Tag.objects.exclude(category='book').values_list(
+            'pk', 'name', 'slug', 'sort_key', 'category', 'user')
+        make = lambda pk, name, slug, sort_key, category, user_id: Entry(
+            'tag', pk, name, slug, sort_key, category, user_id)
+    elif kind == 'pd_book':
+        rows = BookStub.objects.values_list('pk', 'title', 'slug')
+        make = lambda pk, title, slug: Entry(
+            'pd_book', pk, title, slug, sortify(title), 'pd_book')
+    else:
+        rows = Author.objects.values_list('pk', 'name', 'slug', 'sort_key')
+        make = lambda pk, name, slug, sort_key: Entry(
+            'pd_author', pk, name, slug, sort_key, 'pd_author')
+    if pks is not None:
+        rows = rows.filter(pk__in=pks)
+    return [make(*row) for row in rows.iterator()]
+
+
+class PrefixIndex(object):
+    def __init__(self, entries):
+        self.generation = None
+        self.entries = entries
+        # (kind, pk) -> position in entries
+        self.slots = dict(((entry.kind, entry.pk), i) for i, entry in enumerate(entries))
+        suffixes = []
+        for i, entry in enumerate(entries):
+            folded = fold(entry.text)
+            for pos in word_starts(entry.text):
+                suffixes.append((folded[pos:].encode('utf-8'), i, pos))
+        suffixes.sort()
+        self.keys = [key for key, i, pos in suffixes]
+        self.refs = array('i', (i for key, i, pos in suffixes))
+        self.positions = array('H', (pos for key, i, pos in suffixes))
+
+    @classmethod
+    def build(cls):
+        entries = []
+        for kind in KINDS:
+            entries.extend(load_entries(kind))
+        return cls(entries)
+
+    def patched(self, changes):
+        """Returns a copy of the index with changed objects reloaded.
+
+        `changes` is a list of (kind, pk). Entries of changed objects are
+        left in place as None (with their suffixes), new entries are added
+        at the end. The index itself is left intact for lookups running
+        in other threads.
+
+        """
+        index = object.__new__(type(self))
+        index.generation = self.generation
+        index.entries = list(self.entries)
+        index.slots = dict(self.slots)
+        index.keys = list(self.keys)
+        index.refs = array('i', self.refs)
+        index.positions = array('H', self.positions)
+
+        by_kind = {}
+        for kind, pk in changes:
+            by_kind.setdefault(kind, set()).add(pk)
+        for kind, pks in by_kind.iteritems():
+            for pk in pks:
+                slot = index.slots.pop((kind, pk), None)
+                if slot is not None:
+                    index.entries[slot] = None
+            for entry in load_entries(kind, pks):
+                index._add(entry)
+        return index
+
+    def _add(self, entry):
+        i = len(self.entries)
+        self.entries.append(entry)
+        self.slots[entry.kind, entry.pk] = i
+        folded = fold(entry.text)
+        for pos in word_starts(entry.text):
+            key = folded[pos:].encode('utf-8')
+            at = bisect_left(self.keys, key)
+            self.keys.insert(at, key)
+            self.refs.insert(at, i)
+            self.positions.insert(at, pos)
+
+    def starting_with(self, prefix, user=None, kinds=KINDS, limit=None):
+        """Finds entries with a word in name starting with the prefix.
+
+        User's own sets are included for authenticated users. Entries are
+        ordered by kind (in order of `kinds`), then by sort key.
+
+        """
+        prefix = normalize(prefix)
+        if not prefix:
+            return []
+        folded_prefix = fold(prefix)
+        key = folded_prefix.encode('utf-8')
+        if user is not None and user.is_authenticated():
+            user_id = user.pk
+        else:
+            user_id = None
+
+        found = set()
+        keys, entries = self.keys, self.entries
+        i = bisect_left(keys, key)
+        while i < len(keys) and keys[i].startswith(key):
+            ref = self.refs[i]
+            entry = entries[ref]
+            if (entry is not None and ref not in found and entry.kind in kinds
+                    and (entry.category != 'set' or (user_id is not None and entry.user_id == user_id))
+                    and _diacritics_match(entry.text, prefix, folded_prefix, self.positions[i])):
+                found.add(ref)
+            i += 1
+
+        result = [entries[ref] for ref in found]
+        result.sort(key=lambda entry: (kinds.index(entry.kind), entry.sort_key))
+        if limit is not None:
+            result = result[:limit]
+        return result
+
+
+def _current_generation():
+    permanent_cache.add(GENERATION_KEY, 0)
+    return permanent_cache.get(GENERATION_KEY)
+
+
+def _changes(since, generation):
+    """Logged changes after `since`, up to `generation`, or None if lost."""
+    if since is None or generation is None or generation < since \
+            or generation - since > MAX_CATCH_UP:
+        return None
+    keys = [CHANGE_KEY % g for g in range(since + 1, generation + 1)]
+    changes = permanent_cache.get_many(keys)
+    if len(changes) != len(keys):
+        return None
+    return changes.values()
+
+
+def _build():
+    generation = _current_generation()
+    index = PrefixIndex.build()
+    index.generation = generation
+    return index
+
+
+def _rebuild():
+    global _index, _rebuilding
+    from django.db import connection
+    try:
+        index = _build()
+        with _lock:
+            # changes may have been applied meanwhile
+            if _index is None or index.generation >= _index.generation:
+                _index = index
+    except Exception:
+        logger.exception("Can't rebuild the prefix index.")
+    finally:
+        with _lock:
+            _rebuilding = False
+        # the thread has its own database connection
+        connection.close()
+
+
+def get_index():
+    """Returns the index for this process.
+
+    Only the first lookup waits for building. Changes logged by other
+    processes are applied to a copy of the index; if too many of them
+    are missed, the index is rebuilt in the background and the current
+    one is returned meanwhile.
+
+    """
+    global _index, _rebuilding
+    with _lock:
+        generation = _current_generation()
+        if _index is None:
+            _index = _build()
+        elif _index.generation != generation:
+            changes = _changes(_index.generation, generation)
+            if changes is not None:
+                _index = _index.patched(changes)
+                _index.generation = generation
+            elif not _rebuilding:
+                _rebuilding = True
+                thread = Thread(target=_rebuild, name='prefix-index')
+                thread.daemon = True
+                thread.start()
+        return _index
+
+
+def object_changed(kind, pk):
+    """Logs a change of a named object, for all processes to pick up.
+
+    `kind` is one of `KINDS`. The index of this process is updated
+    right away, if it's up to date.
+
+    """
+    global _index
+    with _lock:
+        try:
+            generation = permanent_cache.incr(GENERATION_KEY)
+        except ValueError:
+            generation = None
+        if generation is not None:
+            permanent_cache.set(CHANGE_KEY % generation, (kind, pk))
+        if _index is None:
+            return
+        if generation is None:
+            # no log, at least keep this process up to date
+            _index = _index.patched([(kind, pk)])
+        elif _index.generation == generation - 1:
+            _index = _index.patched([(kind, pk)])
+            _index.generation = generation
@@ -0,0 +1,368 @@
+# -*- coding: utf-8 -*-
+# This file is part of Wolnelektury, licensed under GNU Affero GPLv3 or later.
+# Copyright © Fundacja Nowoczesna Polska. See NOTICE for more information.
+#
+"""In-process index of book and fragment tagging.
+
+Keeps the whole tag relation table for books and fragments in memory,
+so that tag intersections, top-level book elimination and related tag
+counts in `tagged_object_list` don't need to hit the database.
+
+The index is kept in sync incrementally: every change of tagging
+(the `tags_updated` signal) bumps a generation counter in the permanent
+cache and logs the changed object, so that other processes can catch up
+by reloading just the changed objects.
+
+"""
+from threading import RLock
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import get_cache
+
+
+permanent_cache = get_cache('permanent')
+
+GENERATION_KEY = 'catalogue.TagIndex.generation'
+CHANGE_KEY = 'catalogue.TagIndex.change/%d'
+# when lagging more than that, just reload everything
+MAX_CATCH_UP = 200
+
+_lock = RLock()
+_index = None
+
+
+def enabled():
+    try:
+        return settings.CATALOGUE_TAG_INDEX
+    except AttributeError:
+        return True
+
+
+class TagIndex(object):
+    """Tag relations of books and fragments, kept as sets of ids."""
+
+    def __init__(self):
+        self.generation = None
+        self.categories = {}        # tag id -> category
+        self.book_slugs = {}        # book slug -> book id
+        self.parents = {}           # book id -> parent id
+        self.children = {}          # book id -> set of children ids
+        self.l_tags = {}            # book id -> its l-tag id
+        self.l_tag_books = {}       # l-tag id -> book id
+        self.l_tag_slugs = {}       # l-tag slug -> l-tag id
+        self.book_tags = {}         # book id -> set of tag ids
+        self.fragment_tags = {}     # fragment id -> set of tag ids
+        self.tag_books = {}         # tag id -> set of book ids
+        self.tag_fragments = {}     # tag id -> set of fragment ids
+        self._tag_counters = {}
+        self._theme_counters = {}
+
+    @classmethod
+    def build(cls):
+        from catalogue.models import Book, Fragment, Tag
+
+        index = cls()
+        for pk, slug, parent_id in Book.objects.values_list(
+                'pk', 'slug', 'parent').iterator():
+            index._set_book(pk, slug, parent_id)
+        for pk, category, slug in Tag.objects.values_list(
+                'pk', 'category', 'slug').iterator():
+            index._set_tag(pk, category, slug)
+
+        book_ct = ContentType.objects.get_for_model(Book)
+        fragment_ct = ContentType.objects.get_for_model(Fragment)
+        relations = Tag.intermediary_table_model.objects.filter(
+                content_type__in=(book_ct, fragment_ct)).values_list(
+                'content_type', 'object_id', 'tag').order_by().iterator()
+        book_tags, fragment_tags = index.book_tags, index.fragment_tags
+        unknown_tags = set()
+        for ct_id, object_id, tag_id in relations:
+            if ct_id == book_ct.pk:
+                book_tags.setdefault(object_id, set()).add(tag_id)
+                index.tag_books.setdefault(tag_id, set()).add(object_id)
+            else:
+                fragment_tags.setdefault(object_id, set()).add(tag_id)
+                index.tag_fragments.setdefault(tag_id, set()).add(object_id)
+            if tag_id not in index.categories:
+                unknown_tags.add(tag_id)
+        index._load_tags(unknown_tags)
+        return index
+
+    def _set_book(self, pk, slug, parent_id):
+        old_parent = self.parents.get(pk)
+        if old_parent is not None:
+            self.children.get(old_parent, set()).discard(pk)
+        self.book_slugs[slug] = pk
+        self.parents[pk] = parent_id
+        if parent_id is not None:
+            self.children.setdefault(parent_id, set()).add(pk)
+        l_tag = self.l_tag_slugs.get(('l-' + slug)[:120])
+        if l_tag is not None:
+            self.l_tags[pk] = l_tag
+            self.l_tag_books[l_tag] = pk
+
+    def _set_tag(self, pk, category, slug):
+        self.categories[pk] = category
+        if category == 'book':
+            self.l_tag_slugs[slug] = pk
+            book_id = self.book_slugs.get(slug[2:])
+            if book_id is not None:
+                self.l_tags[book_id] = pk
+                self.l_tag_books[pk] = book_id
+
+    def _load_tags(self, tag_ids):
+        from catalogue.models import Tag
+
+        if tag_ids:
+            for pk, category, slug in Tag.objects.filter(pk__in=tag_ids).values_list(
+                    'pk', 'category', 'slug').iterator():
+                self._set_tag(pk, category, slug)
+
+    def _replace_tags(self, object_tags, tag_objects, object_id, tag_ids):
+        for tag_id in object_tags.pop(object_id, ()):
+            tag_objects.get(tag_id, set()).discard(object_id)
+        if tag_ids:
+            object_tags[object_id] = tag_ids
+            for tag_id in tag_ids:
+                tag_objects.setdefault(tag_id, set()).add(object_id)
+
+    def refresh(self, book_ids=(), fragment_ids=(), fragments_of=()):
+        """Reloads tagging of the given books and fragments from database.
+
+        For books in `fragments_of`, all their fragments are reloaded.
+
+        """
+        from catalogue.models import Book, Fragment, Tag
+
+        if fragments_of:
+            fragment_ids = set(fragment_ids)
+            fragment_ids.update(self.fragments_of_books(fragments_of))
+            fragment_ids.update(Fragment.objects.filter(
+                book__in=fragments_of).values_list('pk', flat=True))
+
+        self._tag_counters = {}
+        self._theme_counters = {}
+        relation_model = Tag.intermediary_table_model
+        unknown_tags = set()
+
+        for model, ids, object_tags, tag_objects in (
+                (Book, book_ids, self.book_tags, self.tag_books),
+                (Fragment, fragment_ids, self.fragment_tags, self.tag_fragments)):
+            if not ids:
+                continue
+            ct = ContentType.objects.get_for_model(model)
+            new_tags = dict((object_id, set()) for object_id in ids)
+            for object_id, tag_id in relation_model.objects.filter(
+                    content_type=ct, object_id__in=ids).values_list(
+                    'object_id', 'tag').order_by().iterator():
+                new_tags[object_id].add(tag_id)
+                if tag_id not in self.categories:
+                    unknown_tags.add(tag_id)
+            for object_id, tag_ids in new_tags.iteritems():
+                self._replace_tags(object_tags, tag_objects, object_id, tag_ids)
+
+        if book_ids:
+            existing = set()
+            for pk, slug, parent_id in Book.objects.filter(pk__in=book_ids).values_list(
+                    'pk', 'slug', 'parent').iterator():
+                existing.add(pk)
+                self._set_book(pk, slug, parent_id)
+            for pk in set(book_ids) - existing:
+                self._remove_book(pk)
+        self._load_tags(unknown_tags)
+
+    def _remove_book(self, pk):
+        parent_id = self.parents.pop(pk, None)
+        if parent_id is not None:
+            self.children.get(parent_id, set()).discard(pk)
+        for slug, book_id in self.book_slugs.items():
+            if book_id == pk:
+                del self.book_slugs[slug]
+        l_tag = self.l_tags.pop(pk, None)
+        if l_tag is not None:
+            del self.l_tag_books[l_tag]
+
+    def remove_tag(self, pk):
+        """Forgets a deleted tag and its relations."""
+        self._tag_counters = {}
+        self._theme_counters = {}
+        for object_id in self.tag_books.pop(pk, ()):
+            self.book_tags.get(object_id, set()).discard(pk)
+        for object_id in self.tag_fragments.pop(pk, ()):
+            self.fragment_tags.get(object_id, set()).discard(pk)
+        self.categories.pop(pk, None)
+        book_id = self.l_tag_books.pop(pk, None)
+        if book_id is not None and self.l_tags.get(book_id) == pk:
+            del self.l_tags[book_id]
+        for slug, tag_id in self.l_tag_slugs.items():
+            if tag_id == pk:
+                del self.l_tag_slugs[slug]
+
+    # Queries
+
+    def _intersection(self, tag_objects, tags):
+        sets = sorted((tag_objects.get(tag.pk, ()) for tag in tags), key=len)
+        if not sets:
+            return set()
+        result = set(sets[0])
+        for other in sets[1:]:
+            if not result:
+                break
+            result.intersection_update(other)
+        return result
+
+    def books_with_all(self, tags):
+        """Ids of books tagged with all of `tags`."""
+        return self._intersection(self.tag_books, tags)
+
+    def fragments_with_all(self, tags):
+        """Ids of fragments tagged with all of `tags`."""
+        return self._intersection(self.tag_fragments, tags)
+
+    def has_ancestor_in(self, book_id, book_ids):
+        parent = self.parents.get(book_id)
+        while parent is not None:
+            if parent in book_ids:
+                return True
+            parent = self.parents.get(parent)
+        return False
+
+    def top_level(self, book_ids):
+        """Drops books which have an ancestor in `book_ids`."""
+        return set(pk for pk in book_ids if not self.has_ancestor_in(pk, book_ids))
+
+    def books_tagged_top_level(self, tags):
+        """Same as `Book.tagged_top_level`, but returns ids."""
+        return self.top_level(self.books_with_all(tags))
+
+    def fragments_of_books(self, book_ids):
+        """Ids of fragments of given books and all their descendants."""
+        fragments = set()
+        for book_id in book_ids:
+            fragments.update(self.tag_fragments.get(self.l_tags.get(book_id), ()))
+        return fragments
+
+    def tag_counter(self, book_id):
+        """Same as `Book.tag_counter`."""
+        try:
+            return self._tag_counters[book_id]
+        except KeyError:
+            pass
+        tags = {}
+        for child in self.children.get(book_id, ()):
+            for tag_pk, value in self.tag_counter(child).iteritems():
+                tags[tag_pk] = tags.get(tag_pk, 0) + value
+        for tag_pk in self.book_tags.get(book_id, ()):
+            if self.categories.get(tag_pk) not in ('book', 'theme', 'set', None):
+                tags[tag_pk] = 1
+        self._tag_counters[book_id] = tags
+        return tags
+
+    def theme_counter(self, book_id):
+        """Same as `Book.theme_counter`."""
+        try:
+            return self._theme_counters[book_id]
+        except KeyError:
+            pass
+        tags = {}
+        for fragment_id in self.fragments_of_books([book_id]):
+            for tag_pk in self.fragment_tags.get(fragment_id, ()):
+                if self.categories.get(tag_pk) == 'theme':
+                    tags[tag_pk] = tags.get(tag_pk, 0) + 1
+        self._theme_counters[book_id] = tags
+        return tags
+
+    def related_book_counts(self, book_ids):
+        """Sums up tag and theme counters over the given books."""
+        counts = {}
+        for book_id in book_ids:
+            for counter in self.tag_counter(book_id), self.theme_counter(book_id):
+                for tag_pk, value in counter.iteritems():
+                    counts[tag_pk] = counts.get(tag_pk, 0) + value
+        return counts
+
+    def related_fragment_counts(self, fragment_ids):
+        """Counts usage of non-book tags over the given fragments."""
+        counts = {}
+        for fragment_id in fragment_ids:
+            for tag_pk in self.fragment_tags.get(fragment_id, ()):
+                if self.categories.get(tag_pk) != 'book':
+                    counts[tag_pk] = counts.get(tag_pk, 0) + 1
+        return counts
+
+
+def _current_generation():
+    permanent_cache.add(GENERATION_KEY, 0)
+    return permanent_cache.get(GENERATION_KEY)
+
+
+def _catch_up(index, generation):
+    """Applies logged changes to `index`, or returns False if impossible."""
+    if index is None or index.generation is None or generation is None:
+        return False
+    if generation < index.generation or generation - index.generation > MAX_CATCH_UP:
+        return False
+    if generation == index.generation:
+        return True
+    keys = [CHANGE_KEY % g for g in range(index.generation + 1, generation + 1)]
+    changes = permanent_cache.get_many(keys)
+    if len(changes) != len(keys):
+        return False
+    book_ids, fragment_ids, fragments_of, tag_ids = set(), set(), set(), set()
+    for kind, pk in changes.values():
+        if kind == 'book':
+            book_ids.add(pk)
+        elif kind == 'fragment':
+            fragment_ids.add(pk)
+        elif kind == 'fragments':
+            fragments_of.add(pk)
+        elif kind == 'tag':
+            tag_ids.add(pk)
+        else:
+            return False
+    for pk in tag_ids:
+        index.remove_tag(pk)
+    index.refresh(book_ids, fragment_ids, fragments_of)
+    index.generation = generation
+    return True
+
+
+def get_index():
+    """Returns the up-to-date index for this process."""
+    global _index
+    with _lock:
+        generation = _current_generation()
+        if not _catch_up(_index, generation):
+            _index = TagIndex.build()
+            _index.generation = generation
+        return _index
+
+
+def object_changed(kind, pk):
+    """Logs a change of tagging.
+
+    `kind` is one of 'book', 'fragment', 'fragments' (meaning all fragments
+    of a book) or 'tag' (meaning the tag was deleted).
+
+    """
+    with _lock:
+        try:
+            generation = permanent_cache.incr(GENERATION_KEY)
+        except ValueError:
+            generation = None
+        if generation is None:
+            return
+        permanent_cache.set(CHANGE_KEY % generation, (kind, pk))
+        if _index is not None and _index.generation == generation - 1:
+            if kind == 'book':
+                _index.refresh(book_ids=[pk])
+            elif kind == 'fragment':
+                _index.refresh(fragment_ids=[pk])
+            elif kind == 'fragments':
+                _index.refresh(fragments_of=[pk])
+            elif kind == 'tag':
+                _index.remove_tag(pk)
+            else:
+                return
+            _index.generation = generation
@@ -2,20 +2,102 @@
 # This file is part of Wolnelektury, licensed under GNU Affero GPLv3 or later.
 # Copyright © Fundacja Nowoczesna Polska. See NOTICE for more information.
 #
+from contextlib import contextmanager
 from datetime import datetime
+import os
+from threading import local
 from traceback import print_exc
 from celery.task import task
 from django.conf import settings
 
+_dirty = local()
+
+
+def _dirty_tags():
+    try:
+        return _dirty.tags
+    except AttributeError:
+        _dirty.tags = set()
+        return _dirty.tags
+
+
+def _deferring():
+    return getattr(_dirty, 'depth', 0)
+
+
+def start_deferring():
+    """Starts deferring tag recounts in this thread, see `deferred_recount`."""
+    _dirty.depth = _deferring() + 1
+
+
+def stop_deferring(delay=None):
+    """Ends a `start_deferring`, recounting touched tags if it's the last one."""
+    _dirty.depth = max(_deferring() - 1, 0)
+    if not _dirty.depth:
+        flush_dirty_tags(delay)
+
+
+@contextmanager
+def deferred_recount(delay=None):
+    """Recounts all tags touched in the block together, at its end.
+
+    Requests and celery tasks are run as such blocks.
+
+    """
+    start_deferring()
+    try:
+        yield
+    finally:
+        stop_deferring(delay)
+
 
-# TODO: move to model?
 def touch_tag(tag):
-    update_dict = {
-        'book_count': tag.get_count(),
-        'changed_at': datetime.now(),
-    }
+    """Marks the tag for recounting.
+
+    Inside a `deferred_recount` block, tags are recounted together at its
+    end (or by an explicit `flush_dirty_tags`). Outside of any, the tag
+    is recounted right away.
+
+    """
+    _dirty_tags().add(tag.pk)
+    if not _deferring():
+        flush_dirty_tags()
 
-    type(tag).objects.filter(pk=tag.pk).update(**update_dict)
+
+def flush_dirty_tags(delay=None):
+    """Recounts all tags touched so far in this thread.
+
+    If `delay` is true, recounting is deferred to a celery task.
+    Defaults to settings.CATALOGUE_RECOUNT_TAGS_DELAY.
+
+    """
+    tags = _dirty_tags()
+    if not tags:
+        return
+    tag_ids = list(tags)
+    tags.clear()
+    if delay is None:
+        delay = getattr(settings, 'CATALOGUE_RECOUNT_TAGS_DELAY', False)
+    if delay:
+        recount_tags.delay(tag_ids)
+    else:
+        recount_tags(tag_ids)
+
+
+@task(ignore_result=True)
+def recount_tags(tag_ids):
+    """Updates book counts of given tags, with one update per count value."""
+    from catalogue.models import Tag
+    from catalogue.utils import chunks
+
+    by_count = {}
+    for pk, count in Tag.get_counts(tag_ids).iteritems():
+        by_count.setdefault(count, []).append(pk)
+    now = datetime.now()
+    for count, pks in by_count.iteritems():
+        for pks_chunk in chunks(pks, 1000):
+            Tag.objects.filter(pk__in=pks_chunk).update(
+                book_count=count, changed_at=now)
 
 
 @task
@@ -29,76 +111,111 @@ def index_book(book_id, book_info=None):
         raise e
 
 
-@task(ignore_result=True)
-def build_txt(book_id):
-    """(Re)builds the TXT file for a book."""
-    from django.core.files.base import ContentFile
-    from catalogue.models import Book
+def _build_output(wldoc, format_):
+    """Builds a format from a parsed document, returns the OutputFile."""
+    if format_ == 'txt':
+        return wldoc.as_text()
+    elif format_ == 'pdf':
+        return wldoc.as_pdf(morefloats=settings.LIBRARIAN_PDF_MOREFLOATS)
+    elif format_ == 'epub':
+        return wldoc.as_epub()
+    elif format_ == 'mobi':
+        return wldoc.as_mobi()
+    raise ValueError('Unknown format: %s' % format_)
 
-    text = Book.objects.get(pk=book_id).wldocument().as_text()
 
-    # Save the file in new instance. Building TXT takes time and we don't want
-    # to overwrite any interim changes.
-    book = Book.objects.get(id=book_id)
-    book.txt_file.save('%s.txt' % book.slug, ContentFile(text.get_string()))
+def save_format(book_id, format_, file_name, source_hash=None):
+    """Saves a built file in the book and cleans up after it.
 
+    The built file is removed afterwards.
 
-@task(ignore_result=True, rate_limit=settings.CATALOGUE_PDF_RATE_LIMIT)
-def build_pdf(book_id):
-    """(Re)builds the pdf file for a book."""
+    """
     from django.core.files import File
     from catalogue.models import Book
     from catalogue.utils import remove_zip
     from waiter.utils import clear_cache
 
-    pdf = Book.objects.get(pk=book_id).wldocument().as_pdf(
-            morefloats=settings.LIBRARIAN_PDF_MOREFLOATS)
-
-    # Save the file in new instance. Building PDF takes time and we don't want
+    # Save the file in new instance. Building takes time and we don't want
     # to overwrite any interim changes.
-    book = Book.objects.get(id=book_id)
-    book.pdf_file.save('%s.pdf' % book.slug,
-             File(open(pdf.get_filename())))
+    try:
+        book = Book.objects.get(id=book_id)
+        if source_hash is not None:
+            book.built_hashes[format_] = source_hash
+        with open(file_name) as f:
+            getattr(book, '%s_file' % format_).save('%s.%s' % (book.slug, format_),
+                     File(f))
+    finally:
+        os.unlink(file_name)
 
     # Remove cached downloadables
-    remove_zip(settings.ALL_PDF_ZIP)
-    clear_cache(book.slug)
+    if format_ != 'txt':
+        remove_zip(getattr(settings, 'ALL_%s_ZIP' % format_.upper()))
+    if format_ == 'pdf':
+        clear_cache(book.slug)
 
 
-@task(ignore_result=True, rate_limit=settings.CATALOGUE_EPUB_RATE_LIMIT)
-def build_epub(book_id):
-    """(Re)builds the EPUB file for a book."""
-    from django.core.files import File
+def build_format(book_id, format_):
     from catalogue.models import Book
-    from catalogue.utils import remove_zip
 
-    epub = Book.objects.get(pk=book_id).wldocument().as_epub()
-    # Save the file in new instance. Building MOBI takes time and we don't want
-    # to overwrite any interim changes.
-    book = Book.objects.get(id=book_id)
-    book.epub_file.save('%s.epub' % book.slug,
-             File(open(epub.get_filename())))
+    book = Book.objects.get(pk=book_id)
+    source_hash = book.source_hash()
+    output = _build_output(book.wldocument(), format_)
+    save_format(book_id, format_, output.get_filename(), source_hash)
+
+
+@task(ignore_result=True)
+def build_txt(book_id):
+    """(Re)builds the TXT file for a book."""
+    build_format(book_id, 'txt')
+
+
+@task(ignore_result=True, rate_limit=settings.CATALOGUE_PDF_RATE_LIMIT)
+def build_pdf(book_id):
+    """(Re)builds the pdf file for a book."""
+    build_format(book_id, 'pdf')
+
 
-    # remove zip with all epub files
-    remove_zip(settings.ALL_EPUB_ZIP)
+@task(ignore_result=True, rate_limit=settings.CATALOGUE_EPUB_RATE_LIMIT)
+def build_epub(book_id):
+    """(Re)builds the EPUB file for a book."""
+    build_format(book_id, 'epub')
 
 
 @task(ignore_result=True, rate_limit=settings.CATALOGUE_MOBI_RATE_LIMIT)
 def build_mobi(book_id):
     """(Re)builds the MOBI file for a book."""
-    from django.core.files import File
-    from catalogue.models import Book
-    from catalogue.utils import remove_zip
+    build_format(book_id, 'mobi')
 
-    mobi = Book.objects.get(pk=book_id).wldocument().as_mobi()
-    # Save the file in new instance. Building MOBI takes time and we don't want
-    # to overwrite any interim changes.
-    book = Book.objects.get(id=book_id)
-    book.mobi_file.save('%s.mobi' % book.slug,
-             File(open(mobi.get_filename())))
 
-    # remove zip with all mobi files
-    remove_zip(settings.ALL_MOBI_ZIP)
+_build_tasks = {
+    'txt': build_txt,
+    'pdf': build_pdf,
+    'epub': build_epub,
+    'mobi': build_mobi,
+}
+
+
+@task(ignore_result=True)
+def build_formats(book_id, formats, force=False):
+    """(Re)builds many formats of a book.
+
+    Each format is built by its own task, so they run in parallel on
+    the workers, with their own rate limits. Formats already built from
+    identical source are skipped, unless `force` is set. Returns the list
+    of formats sent for building.
+
+    """
+    from catalogue.models import Book
+
+    book = Book.objects.get(pk=book_id)
+    if not force:
+        source_hash = book.source_hash()
+        formats = [format_ for format_ in formats
+                   if book.built_hashes.get(format_) != source_hash
+                   or not getattr(book, '%s_file' % format_)]
+    for format_ in formats:
+        _build_tasks[format_].delay(book_id)
+    return formats
 
 
 @task(rate_limit=settings.CATALOGUE_CUSTOMPDF_RATE_LIMIT)
@@ -7,11 +7,11 @@ import feedparser
 
 from django import template
 from django.template import Node, Variable, Template, Context
-from django.core.cache import cache
 from django.core.urlresolvers import reverse
 from django.contrib.auth.forms import UserCreationForm, AuthenticationForm
 from django.utils.translation import ugettext as _
 
+from catalogue import cache_versions
 from catalogue import forms
 from catalogue.utils import split_tags
 from catalogue.models import Book, Fragment, Tag
@@ -353,8 +353,11 @@ def fragment_promo(arg=None):
 
 @register.inclusion_tag('catalogue/related_books.html')
 def related_books(book, limit=6, random=1):
+    # Relatedness depends on tags of all the books, so this gets
+    # invalidated by any change in the catalogue.
     cache_key = "catalogue.related_books.%d.%d" % (book.id, limit - random)
-    related = cache.get(cache_key)
+    cache_deps = [cache_versions.CATALOGUE]
+    related = cache_versions.get_cached(cache_key, cache_deps)
     if related is None:
         related = list(Book.objects.filter(
             common_slug=book.common_slug).exclude(pk=book.pk)[:limit])
@@ -363,7 +366,7 @@ def related_books(book, limit=6, random=1):
             related += Book.tagged.related_to(book,
                     Book.objects.exclude(common_slug=book.common_slug),
                     ignore_by_tag=book.book_tag())[:limit-random]
-        cache.set(cache_key, related, 1800)
+        cache_versions.set_cached(cache_key, related, cache_deps)
     if random:
         related += list(Book.objects.exclude(
                         pk__in=[b.pk for b in related] + [book.pk]
@@ -2,11 +2,13 @@
 from __future__ import with_statement
 
 from django.core.files.base import ContentFile, File
+from django.core.management.base import CommandError
 from catalogue.test_utils import *
 from catalogue import models
 from librarian import WLURI
 
 from nose.tools import raises
+import os
 from os import path, makedirs
 
 class BookImportLogicTests(WLTestCase):
@@ -84,6 +86,22 @@ class BookImportLogicTests(WLTestCase):
 
         self.assert_(('theme', 'love') in [ (tag.category, tag.slug) for tag in book.fragments.all()[0].tags ])
 
+    def test_fragment_short_html_reset_with_book(self):
+        BOOK_TEXT = """<utwor>
+        <opowiadanie>
+            <akap><begin id="m01" /><motyw id="m01">Love</motyw>Ala ma kota<end id="m01" /></akap>
+        </opowiadanie></utwor>
+        """
+
+        book = models.Book.from_text_and_meta(ContentFile(BOOK_TEXT), self.book_info)
+        fragment = book.fragments.all()[0]
+        self.assertTrue(u"Default Book" in fragment.short_html())
+
+        book.title = u"Extraordinary"
+        book.save()
+        fragment = models.Fragment.objects.get(pk=fragment.pk)
+        self.assertTrue(u"Extraordinary" in fragment.short_html())
+
     def test_book_with_empty_theme(self):
         """ empty themes should be ignored """
 
@@ -168,6 +186,23 @@ class BookImportLogicTests(WLTestCase):
         self.assertEqual(book.fragments.count(), 2)
         book = models.Book.from_text_and_meta(ContentFile(BOOK_TEXT_AFTER), self.book_info, overwrite=True)
         self.assertEqual(book.fragments.count(), 1)
+        self.assertEqual(models.Tag.objects.get(slug='hatred', category='theme').book_count, 0)
+        self.assertEqual(models.Tag.intermediary_table_model.objects.filter(
+            content_type__model='fragment').exclude(
+            object_id__in=book.fragments.values_list('pk', flat=True)).count(), 0)
+
+    def test_book_reimport_unchanged(self):
+        BOOK_TEXT = """<utwor>
+        <opowiadanie>
+            <akap><begin id="m01" /><motyw id="m01">Love</motyw>Ala ma kota<end id="m01" /></akap>
+        </opowiadanie></utwor>
+        """
+
+        book = models.Book.from_text_and_meta(ContentFile(BOOK_TEXT), self.book_info)
+        self.assertEqual(book.rebuilt, ['html', 'cover'])
+        book = models.Book.from_text_and_meta(ContentFile(BOOK_TEXT), self.book_info, overwrite=True)
+        self.assertEqual(book.rebuilt, [])
+        self.assertEqual(book.fragments.count(), 1)
 
     def test_multiple_tags(self):
         BOOK_TEXT = """<utwor />"""
@@ -296,6 +331,26 @@ class BookImportGenerateTest(WLTestCase):
         parent = models.Book.objects.get(pk=parent.pk)
         self.assertTrue(path.exists(parent.pdf_file.path))
 
+    def test_build_formats(self):
+        from catalogue.tasks import build_formats
+        self.assertEqual(build_formats(self.book.pk, ['txt']), ['txt'])
+        book = models.Book.objects.get(pk=self.book.pk)
+        self.assertTrue(path.exists(book.txt_file.path))
+        self.assertEqual(book.built_hashes['txt'], book.source_hash())
+        # nothing changed, nothing to build
+        self.assertEqual(build_formats(self.book.pk, ['txt']), [])
+
+    def test_save_format_cleanup(self):
+        from tempfile import mkstemp
+        from catalogue.tasks import save_format
+        fd, file_name = mkstemp()
+        os.write(fd, 'Ala ma kota')
+        os.close(fd)
+        save_format(self.book.pk, 'txt', file_name)
+        self.assertFalse(path.exists(file_name))
+        book = models.Book.objects.get(pk=self.book.pk)
+        self.assertEqual(open(book.txt_file.path).read(), 'Ala ma kota')
+
     def test_custom_pdf(self):
         from catalogue.tasks import build_custom_pdf
         out = models.get_dynamic_path(None, 'test-custom', ext='pdf')
@@ -307,3 +362,45 @@ class BookImportGenerateTest(WLTestCase):
         build_custom_pdf(self.book.id,
             customizations=['nofootnotes', '13pt', 'a4paper'], file_name=out)
         self.assertTrue(path.exists(absoulute_path))
+
+
+class ImportBooksCommandTests(WLTestCase):
+
+    def setUp(self):
+        from django.core.management.color import no_style
+        from catalogue.management.commands.importbooks import Command
+        WLTestCase.setUp(self)
+        self.command = Command()
+        self.command.style = no_style()
+        self.command.files_skipped = 0
+        files = path.join(path.dirname(__file__), 'files')
+        self.parent = path.join(files, 'fraszki.xml')
+        self.part = path.join(files, 'fraszka-do-anusie.xml')
+
+    def test_scan(self):
+        self.assertEqual(self.command.scan([self.parent, self.part]),
+                         {self.parent: set([self.part]), self.part: set()})
+        # parts not being imported must already be in the catalogue
+        self.assertEqual(self.command.scan([self.parent]), {self.parent: set()})
+
+    def test_scan_same_slug(self):
+        import shutil
+        import tempfile
+        copy = path.join(tempfile.mkdtemp(prefix='djangotest_'), 'copy.xml')
+        try:
+            shutil.copy(self.part, copy)
+            self.assertEqual(self.command.scan([self.part, copy]), {self.part: set()})
+            self.assertEqual(self.command.files_skipped, 1)
+        finally:
+            shutil.rmtree(path.dirname(copy))
+
+    def test_topological_order(self):
+        from catalogue.management.commands.importbooks import Command
+        self.assertEqual(Command.topological_order({
+                'a': set(['b', 'c']), 'b': set(['c']), 'c': set(), 'd': set()}),
+            ['c', 'd', 'b', 'a'])
+
+    @raises(CommandError)
+    def test_topological_order_circular(self):
+        from catalogue.management.commands.importbooks import Command
+        Command.topological_order({'a': set(['b']), 'b': set(['a']), 'c': set()})
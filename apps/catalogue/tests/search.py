@@ -69,3 +69,27 @@ class BasicSearchLogicTests(WLTestCase):
     def test_sloppy(self):
         self.assertEqual(views.find_best_matches(u'Żelenski'), (self.unicode_tag,))
         self.assertEqual(views.find_best_matches(u'zelenski'), (self.unicode_tag,))
+
+    def test_index_refreshed(self):
+        """ New tags should be found at once. """
+        self.assertEqual(views.find_best_matches(u'Kochanowski'), ())
+        tag = models.Tag.objects.create(name=u'Jan Kochanowski',
+                                        category=u'author', slug="four")
+        self.assertEqual(views.find_best_matches(u'Kochanowski'), (tag,))
+
+    def test_index_patched(self):
+        """ Changed and deleted tags should be updated in place, without rebuilding. """
+        from catalogue import prefix_index
+
+        self.assertEqual(views.find_best_matches(u'Mickiewicz'), (self.author_tag,))
+        index = prefix_index.get_index()
+        self.author_tag.name = u'Juliusz Słowacki'
+        self.author_tag.save()
+        self.unicode_tag.delete()
+        self.assertEqual(views.find_best_matches(u'Mickiewicz'), ())
+        self.assertEqual(views.find_best_matches(u'Słowacki'), (self.author_tag,))
+        self.assertEqual(views.find_best_matches(u'Żeleński'), ())
+        # other entries are kept as they were
+        key = ('tag', self.polish_tag.pk)
+        self.assertTrue(prefix_index.get_index().entries[index.slots[key]]
+                        is index.entries[index.slots[key]])
@@ -1,7 +1,8 @@
 # -*- coding: utf-8 -*-
 from django.core.files.base import ContentFile
+from django.db.models import Q
 from django.test import Client
-from catalogue import models
+from catalogue import models, tasks
 from catalogue.test_utils import *
 
 
@@ -64,6 +65,64 @@ class BooksByTagTests(WLTestCase):
         self.assertEqual([book.title for book in context['object_list']],
                          ['Child'])
 
+    def test_tag_counts(self):
+        """ Bulk recount should agree with counting tags one by one. """
+        for info in self.gchild_info, self.child_info, self.parent_info:
+            models.Book.from_text_and_meta(self.book_file, info)
+
+        tags = models.Tag.objects.exclude(category='book')
+        counts = models.Tag.get_counts([tag.pk for tag in tags])
+        self.assertEqual(counts, dict((tag.pk, tag.get_count()) for tag in tags))
+        kind = models.Tag.objects.get(slug='kind', category='kind')
+        self.assertEqual(counts[kind.pk], 1)
+        self.assertEqual(kind.book_count, 1)
+
+    def test_recount_outside_request(self):
+        """ Tags touched outside of requests and tasks are recounted right away. """
+        book = models.Book.objects.create(title='Book', slug='book')
+        tag = models.Tag.objects.create(name='Author', slug='author', category='author')
+        book.tags = [tag]
+        self.assertEqual(models.Tag.objects.get(pk=tag.pk).book_count, 1)
+
+        with tasks.deferred_recount():
+            book.tags = []
+            self.assertEqual(models.Tag.objects.get(pk=tag.pk).book_count, 1)
+        self.assertEqual(models.Tag.objects.get(pk=tag.pk).book_count, 0)
+
+    def test_shelf_keeps_catalogue_version(self):
+        """ Editing user shelves doesn't invalidate catalogue caches. """
+        from django.contrib.auth.models import User
+        from catalogue import cache_versions
+        from social.utils import get_set, set_sets
+
+        user = User.objects.create_user('user', 'user@example.com', 'password')
+        book = models.Book.objects.all()[0]
+        version = cache_versions.generation(cache_versions.CATALOGUE)
+        set_sets(user, book, [get_set(user, 'Shelf')])
+        set_sets(user, book, [])
+        self.assertFalse(models.Tag.objects.filter(category='set').exists())
+        self.assertEqual(cache_versions.generation(cache_versions.CATALOGUE), version)
+
+        models.Tag.objects.create(name='New Author', slug='new-author', category='author')
+        self.assertNotEqual(cache_versions.generation(cache_versions.CATALOGUE), version)
+
+    def test_book_list(self):
+        """ book list should show top-level books by author """
+        for info in self.gchild_info, self.child_info, self.parent_info:
+            models.Book.from_text_and_meta(self.book_file, info)
+
+        books_by_author, orphans, books_by_parent = models.Book.book_list()
+        author = models.Tag.objects.get(slug='common-man', category='author')
+        self.assertEqual([book.title for book in books_by_author[author]], ['Parent'])
+        self.assertEqual(orphans, [])
+        parent = models.Book.objects.get(title='Parent')
+        self.assertEqual([book.title for book in books_by_parent[parent.pk]], ['Child'])
+
+        # filtered out parent
+        books_by_author, orphans, books_by_parent = models.Book.book_list(
+            Q(slug__in=['child', 'gchild']))
+        self.assertEqual([book.title for book in books_by_author[author]], ['Child'])
+
 
 class TagRelatedTagsTests(WLTestCase):
     """ tests the /katalog/category/tag/ page for related tags """
@@ -139,6 +198,74 @@ class TagRelatedTagsTests(WLTestCase):
         self.assertFalse('Theme' in [tag.name for tag in cats['theme']],
                          'filtering theme wrongly included in related')
 
+    def test_counters_for(self):
+        """ bulk counters should agree with per-book ones """
+        books = list(models.Book.objects.all())
+        book_ids = [book.pk for book in books]
+        # per-book tag counters, computed without the bulk path's cache entries
+        models.permanent_cache.clear()
+        tag_expected = dict((book.pk, book.tag_counter) for book in books)
+        # themes, counted straight from fragments
+        theme_expected = {}
+        for book in books:
+            family, level = [book.pk], [book.pk]
+            while level:
+                level = list(models.Book.objects.filter(
+                    parent__in=level).values_list('pk', flat=True))
+                family.extend(level)
+            counter = theme_expected[book.pk] = {}
+            for fragment in models.Fragment.objects.filter(book__in=family):
+                for tag in fragment.tags.filter(category='theme'):
+                    counter[tag.pk] = counter.get(tag.pk, 0) + 1
+
+        models.permanent_cache.clear()
+        self.assertEqual(models.Book.tag_counters_for(book_ids), tag_expected)
+        self.assertEqual(models.Book.theme_counters_for(book_ids), theme_expected)
+        # and again, from the cache
+        self.assertEqual(models.Book.tag_counters_for(book_ids), tag_expected)
+        self.assertEqual(models.Book.theme_counters_for(book_ids), theme_expected)
+
+    def test_theme_counter(self):
+        """ theme counter should include descendants' fragments """
+        parent = models.Book.objects.get(title='Parent')
+        counter = dict((models.Tag.objects.get(pk=pk).name, count)
+                       for pk, count in parent.theme_counter.items())
+        self.assertEqual(counter, {'Theme': 4, 'ParentTheme': 1, 'Child1Theme': 1,
+                                   'Child2Theme': 1, 'GChildTheme': 1})
+
+    def test_tag_index(self):
+        """ in-memory tag index should agree with the database """
+        from catalogue.tag_index import TagIndex
+
+        index = TagIndex.build()
+        kind = models.Tag.objects.get(slug='kind', category='kind')
+        self.assertEqual(index.books_tagged_top_level([kind]),
+                         set(book.pk for book in models.Book.tagged_top_level([kind])))
+        theme = models.Tag.objects.get(slug='theme', category='theme')
+        self.assertEqual(index.fragments_with_all([theme]),
+                         set(f.pk for f in models.Fragment.tagged.with_all([theme])))
+        for book in models.Book.objects.all():
+            self.assertEqual(index.tag_counter(book.pk), book.tag_counter)
+            self.assertEqual(index.theme_counter(book.pk), book.theme_counter)
+
+    def test_tag_index_remove_tag(self):
+        """ removing a deleted tag from tag index should match a fresh build """
+        from catalogue.tag_index import TagIndex
+
+        def non_empty(mapping):
+            return dict((key, value) for key, value in mapping.items() if value)
+
+        index = TagIndex.build()
+        for tag in (models.Tag.objects.get(slug='theme', category='theme'),
+                    models.Tag.objects.get(slug='kind', category='kind')):
+            pk = tag.pk
+            tag.delete()
+            index.remove_tag(pk)
+        fresh = TagIndex.build()
+        for attr in ('book_tags', 'fragment_tags', 'tag_books', 'tag_fragments'):
+            self.assertEqual(non_empty(getattr(index, attr)), non_empty(getattr(fresh, attr)))
+        self.assertEqual(index.categories, fresh.categories)
+
     def test_parent_tag_once(self):
         """ if parent and descendants have a common tag, count it only once """
 
@@ -37,6 +37,12 @@ def get_random_hash(seed):
     return urlsafe_b64encode(sha_digest).replace('=', '').replace('_', '-').lower()
 
 
+def chunks(seq, size):
+    """Yields successive `size`-long slices of a list."""
+    for i in xrange(0, len(seq), size):
+        yield seq[i:i + size]
+
+
 def split_tags(tags):
     result = {}
     for tag in tags:
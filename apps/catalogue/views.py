@@ -2,7 +2,6 @@
 # This file is part of Wolnelektury, licensed under GNU Affero GPLv3 or later.
 # Copyright © Fundacja Nowoczesna Polska. See NOTICE for more information.
 #
-import re
 import itertools
 
 from django.conf import settings
@@ -22,6 +21,8 @@ from ajaxable.utils import JSONResponse, AjaxableFormView
 
 from catalogue import models
 from catalogue import forms
+from catalogue import tag_index
+from catalogue import prefix_index
 from catalogue.utils import split_tags, MultiQuerySet
 from pdcounter import models as pdcounter_models
 from pdcounter import views as pdcounter_views
@@ -125,7 +126,26 @@ def tagged_object_list(request, tags=''):
     objects = only_author = None
     categories = {}
 
-    if theme_is_set:
+    index = tag_index.get_index() if tag_index.enabled() else None
+
+    if theme_is_set and index is not None:
+        shelf_tags = [tag for tag in tags if tag.category == 'set']
+        fragment_tags = [tag for tag in tags if tag.category != 'set']
+        fragment_keys = index.fragments_with_all(fragment_tags)
+        if shelf_tags:
+            fragment_keys &= index.fragments_of_books(
+                index.books_with_all(shelf_tags))
+
+        if fragment_keys:
+            related_counts = index.related_fragment_counts(fragment_keys)
+            related_tags = models.Tag.objects.filter(pk__in=related_counts.keys())
+            related_tags = [tag for tag in related_tags if tag not in fragment_tags]
+            for tag in related_tags:
+                tag.count = related_counts[tag.pk]
+            categories = split_tags(related_tags)
+
+            objects = models.Fragment.objects.filter(pk__in=fragment_keys)
+    elif theme_is_set:
         shelf_tags = [tag for tag in tags if tag.category == 'set']
         fragment_tags = [tag for tag in tags if tag.category != 'set']
         fragments = models.Fragment.tagged.with_all(fragment_tags)
@@ -149,19 +169,33 @@ def tagged_object_list(request, tags=''):
 
             objects = fragments
     else:
-        if shelf_is_set:
-            objects = models.Book.tagged.with_all(tags)
-        else:
-            objects = models.Book.tagged_top_level(tags)
-
-        # get related tags from `tag_counter` and `theme_counter`
-        related_counts = {}
         tags_pks = [tag.pk for tag in tags]
-        for book in objects.iterator():
-            for tag_pk, value in itertools.chain(book.tag_counter.iteritems(), book.theme_counter.iteritems()):
-                if tag_pk in tags_pks:
-                    continue
-                related_counts[tag_pk] = related_counts.get(tag_pk, 0) + value
+        if index is not None:
+            if shelf_is_set:
+                book_keys = index.books_with_all(tags)
+            else:
+                book_keys = index.books_tagged_top_level(tags)
+            objects = models.Book.objects.filter(pk__in=book_keys)
+            related_counts = index.related_book_counts(book_keys)
+            for tag_pk in tags_pks:
+                related_counts.pop(tag_pk, None)
+        else:
+            if shelf_is_set:
+                objects = models.Book.tagged.with_all(tags)
+            else:
+                objects = models.Book.tagged_top_level(tags)
+
+            # get related tags from `tag_counter` and `theme_counter`
+            related_counts = {}
+            book_keys = list(objects.values_list('pk', flat=True))
+            tag_counters = models.Book.tag_counters_for(book_keys)
+            theme_counters = models.Book.theme_counters_for(book_keys)
+            for book_pk in book_keys:
+                for tag_pk, value in itertools.chain(tag_counters[book_pk].iteritems(),
+                                                     theme_counters[book_pk].iteritems()):
+                    if tag_pk in tags_pks:
+                        continue
+                    related_counts[tag_pk] = related_counts.get(tag_pk, 0) + value
         related_tags = models.Tag.objects.filter(pk__in=related_counts.keys())
         related_tags = [tag for tag in related_tags if tag not in tags]
         for tag in related_tags:
@@ -273,64 +307,6 @@ def book_text(request, slug):
 # = Search =
 # ==========
 
-def _no_diacritics_regexp(query):
-    """ returns a regexp for searching for a query without diacritics
-
-    should be locale-aware """
-    names = {
-        u'a':u'aąĄ', u'c':u'cćĆ', u'e':u'eęĘ', u'l': u'lłŁ', u'n':u'nńŃ', u'o':u'oóÓ', u's':u'sśŚ', u'z':u'zźżŹŻ',
-        u'ą':u'ąĄ', u'ć':u'ćĆ', u'ę':u'ęĘ', u'ł': u'łŁ', u'ń':u'ńŃ', u'ó':u'óÓ', u'ś':u'śŚ', u'ź':u'źŹ', u'ż':u'żŻ'
-        }
-    def repl(m):
-        l = m.group()
-        return u"(%s)" % '|'.join(names[l])
-    return re.sub(u'[%s]' % (u''.join(names.keys())), repl, query)
-
-def unicode_re_escape(query):
-    """ Unicode-friendly version of re.escape """
-    return re.sub('(?u)(\W)', r'\\\1', query)
-
-def _word_starts_with(name, prefix):
-    """returns a Q object getting models having `name` contain a word
-    starting with `prefix`
-
-    We define word characters as alphanumeric and underscore, like in JS.
-
-    Works for MySQL, PostgreSQL, Oracle.
-    For SQLite, _sqlite* version is substituted for this.
-    """
-    kwargs = {}
-
-    prefix = _no_diacritics_regexp(unicode_re_escape(prefix))
-    # can't use [[:<:]] (word start),
-    # but we want both `xy` and `(xy` to catch `(xyz)`
-    kwargs['%s__iregex' % name] = u"(^|[^[:alnum:]_])%s" % prefix
-
-    return Q(**kwargs)
-
-
-def _word_starts_with_regexp(prefix):
-    prefix = _no_diacritics_regexp(unicode_re_escape(prefix))
-    return ur"(^|(?<=[^\wąćęłńóśźżĄĆĘŁŃÓŚŹŻ]))%s" % prefix
-
-
-def _sqlite_word_starts_with(name, prefix):
-    """ version of _word_starts_with for SQLite
-
-    SQLite in Django uses Python re module
-    """
-    kwargs = {}
-    kwargs['%s__iregex' % name] = _word_starts_with_regexp(prefix)
-    return Q(**kwargs)
-
-
-if hasattr(settings, 'DATABASES'):
-    if settings.DATABASES['default']['ENGINE'] == 'django.db.backends.sqlite3':
-        _word_starts_with = _sqlite_word_starts_with
-elif settings.DATABASE_ENGINE == 'sqlite3':
-    _word_starts_with = _sqlite_word_starts_with
-
-
 class App():
     def __init__(self, name, view):
         self.name = name
@@ -345,21 +321,17 @@ _apps = (
     )
 
 
-def _tags_starting_with(prefix, user=None):
-    prefix = prefix.lower()
-    # PD counter
-    book_stubs = pdcounter_models.BookStub.objects.filter(_word_starts_with('title', prefix))
-    authors = pdcounter_models.Author.objects.filter(_word_starts_with('name', prefix))
-
-    books = models.Book.objects.filter(_word_starts_with('title', prefix))
-    tags = models.Tag.objects.filter(_word_starts_with('name', prefix))
-    if user and user.is_authenticated():
-        tags = tags.filter(~Q(category='book') & (~Q(category='set') | Q(user=user)))
-    else:
-        tags = tags.filter(~Q(category='book') & ~Q(category='set'))
+def _matches_starting_with(prefix, user=None):
+    """ returns prefix index entries and apps with names starting with `prefix` """
+    entries = prefix_index.get_index().starting_with(prefix, user)
+    books_and_tags = [entry for entry in entries if entry.kind in ('book', 'tag')]
+    pdcounter = [entry for entry in entries if entry.kind not in ('book', 'tag')]
+    apps = [app for app in _apps if prefix_index.word_starts_with(app.name, prefix)]
+    return books_and_tags + apps + pdcounter
 
-    prefix_regexp = re.compile(_word_starts_with_regexp(prefix))
-    return list(books) + list(tags) + [app for app in _apps if prefix_regexp.search(app.lower)] + list(book_stubs) + list(authors)
+
+def _tags_starting_with(prefix, user=None):
+    return prefix_index.load_objects(_matches_starting_with(prefix, user))
 
 
 def _get_result_link(match, tag_list):
@@ -382,8 +354,8 @@ def _get_result_type(match):
 
 
 def books_starting_with(prefix):
-    prefix = prefix.lower()
-    return models.Book.objects.filter(_word_starts_with('title', prefix))
+    entries = prefix_index.get_index().starting_with(prefix, kinds=('book',))
+    return prefix_index.load_objects(entries)
 
 
 def find_best_matches(query, user=None):
@@ -454,7 +426,7 @@ def tags_starting_with(request):
         return HttpResponse('')
     tags_list = []
     result = ""
-    for tag in _tags_starting_with(prefix, request.user):
+    for tag in _matches_starting_with(prefix, request.user):
         if not tag.name in tags_list:
             result += "\n" + tag.name
             tags_list.append(tag.name)
@@ -468,7 +440,7 @@ def json_tags_starting_with(request, callback=None):
     if len(prefix) < 2:
         return HttpResponse('')
     tags_list = []
-    for tag in _tags_starting_with(prefix, request.user):
+    for tag in _matches_starting_with(prefix, request.user):
         if not tag.name in tags_list:
             tags_list.append(tag.name)
     if request.GET.get('mozhint', ''):
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+# This file is part of Wolnelektury, licensed under GNU Affero GPLv3 or later.
+# Copyright © Fundacja Nowoczesna Polska. See NOTICE for more information.
+#
+from datetime import timedelta
+from time import mktime
+
+from django.utils.http import http_date
+
+from catalogue.models import Book, Tag
+from catalogue.test_utils import WLTestCase
+from opds.views import PagedFeed
+
+
+class ByTagFeedTests(WLTestCase):
+
+    def setUp(self):
+        super(ByTagFeedTests, self).setUp()
+        self._page_size, PagedFeed.page_size = PagedFeed.page_size, 2
+        self.author = Tag.objects.create(category='author', name='Jan Kowalski', slug='jan-kowalski')
+        for i in range(3):
+            book = Book.objects.create(title='Book %d' % i, slug='book-%d' % i)
+            book.tags = [self.author]
+        self.author = Tag.objects.get(pk=self.author.pk)
+        self.url = '/opds/author/jan-kowalski/'
+
+    def tearDown(self):
+        PagedFeed.page_size = self._page_size
+        super(ByTagFeedTests, self).tearDown()
+
+    def test_paging(self):
+        first = self.client.get(self.url).content
+        self.assertEqual(first.count('<name>Jan Kowalski</name>'), 2,
+                         'Authors missing on the first page')
+        self.assertTrue('rel="next"' in first)
+        self.assertTrue('"http://testserver/opds/author/jan-kowalski/?page=2"' in first,
+                        'No absolute link to the next page')
+        self.assertFalse('rel="previous"' in first)
+
+        second = self.client.get(self.url, {'page': 2}).content
+        self.assertEqual(second.count('<name>Jan Kowalski</name>'), 1,
+                         'Authors missing on the last page')
+        self.assertTrue('rel="first"' in second)
+        self.assertTrue('"http://testserver/opds/author/jan-kowalski/?page=1"' in second)
+        self.assertFalse('rel="next"' in second)
+
+        self.assertEqual(self.client.get(self.url, {'page': 3}).status_code, 404)
+
+    def test_not_modified(self):
+        changed_at = int(mktime(self.author.changed_at.timetuple()))
+        response = self.client.get(self.url,
+            HTTP_IF_MODIFIED_SINCE=http_date(changed_at))
+        self.assertEqual(response.status_code, 304)
+
+        earlier = int(mktime((self.author.changed_at - timedelta(days=1)).timetuple()))
+        response = self.client.get(self.url,
+            HTTP_IF_MODIFIED_SINCE=http_date(earlier))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Last-Modified'], http_date(changed_at))
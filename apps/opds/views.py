@@ -2,15 +2,22 @@
 # This file is part of Wolnelektury, licensed under GNU Affero GPLv3 or later.
 # Copyright © Fundacja Nowoczesna Polska. See NOTICE for more information.
 #
+from copy import copy
 import os.path
+from time import mktime
 from urlparse import urljoin
 
+from django.contrib.contenttypes.models import ContentType
 from django.contrib.syndication.views import Feed
+from django.core.exceptions import ObjectDoesNotExist
+from django.core.paginator import Paginator, InvalidPage
 from django.core.urlresolvers import reverse
+from django.db.models import Max
 from django.shortcuts import get_object_or_404
 from django.utils.feedgenerator import Atom1Feed
+from django.utils.http import http_date, parse_http_date_safe
 from django.conf import settings
-from django.http import Http404
+from django.http import Http404, HttpResponse, HttpResponseNotModified
 from django.contrib.sites.models import Site
 
 from basicauth import logged_in_or_basicauth, factory_decorator
@@ -96,6 +103,11 @@ class OPDSFeed(Atom1Feed):
                                 {u"href": full_url(os.path.join(settings.STATIC_URL, "opensearch.xml")),
                                  u"rel": u"search",
                                  u"type": u"application/opensearchdescription+xml"})
+        for rel, href in self.feed.get('page_links', ()):
+            handler.addQuickElement(u"link", None,
+                                    {u"href": href,
+                                     u"rel": rel,
+                                     u"type": u"application/atom+xml"})
 
 
     def add_item_elements(self, handler, item):
@@ -159,7 +171,81 @@ class OPDSFeed(Atom1Feed):
             handler.addQuickElement(u"rights", item['item_copyright'])
 
 
-class AcquisitionFeed(Feed):
+class PagedFeed(Feed):
+    """Feed served in pages, with links to other pages (as in RFC 5005).
+
+    Subclasses provide `all_items` instead of `items`, and may provide
+    `last_modified` for conditional GET support.
+
+    """
+    page_size = settings.OPDS_PAGE_SIZE
+
+    def __call__(self, request, *args, **kwargs):
+        try:
+            obj = self.get_object(request, *args, **kwargs)
+        except ObjectDoesNotExist:
+            raise Http404('Feed object does not exist.')
+
+        last_modified = self.last_modified(obj)
+        if last_modified is not None:
+            last_modified = int(mktime(last_modified.timetuple()))
+            if_modified_since = parse_http_date_safe(
+                request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+            if if_modified_since is not None and if_modified_since >= last_modified:
+                return HttpResponseNotModified()
+
+        feedgen = self.get_feed(obj, request)
+        response = HttpResponse(content_type=feedgen.mime_type)
+        feedgen.write(response, 'utf-8')
+        if last_modified is not None:
+            response['Last-Modified'] = http_date(last_modified)
+        return response
+
+    def last_modified(self, obj):
+        return None
+
+    def get_feed(self, obj, request):
+        # feeds are shared between requests, keep the page in a copy
+        feed = copy(self)
+        try:
+            number = int(request.GET.get('page', 1))
+            page = Paginator(self.all_items(obj), self.page_size).page(number)
+        except (ValueError, InvalidPage):
+            raise Http404
+        feed.page = page
+        feed.page_links = self.get_page_links(request, page)
+        feed.prefetch(page.object_list)
+        return super(PagedFeed, feed).get_feed(obj, request)
+
+    @staticmethod
+    def get_page_links(request, page):
+        def page_url(number):
+            query = request.GET.copy()
+            query['page'] = number
+            return request.build_absolute_uri(
+                u"%s?%s" % (request.path, query.urlencode()))
+
+        links = []
+        if page.has_previous():
+            links.append((u"first", page_url(1)))
+            links.append((u"previous", page_url(page.previous_page_number())))
+        if page.has_next():
+            links.append((u"next", page_url(page.next_page_number())))
+            links.append((u"last", page_url(page.paginator.num_pages)))
+        return links
+
+    def prefetch(self, items):
+        """Gets related data for all items on the page at once."""
+        pass
+
+    def items(self, obj):
+        return self.page.object_list
+
+    def feed_extra_kwargs(self, obj):
+        return {'page_links': self.page_links}
+
+
+class AcquisitionFeed(PagedFeed):
     feed_type = OPDSFeed
     link = u'http://www.wolnelektury.pl/'
     item_enclosure_mime_type = "application/epub+zip"
@@ -175,17 +261,23 @@ class AcquisitionFeed(Feed):
     def item_link(self, book):
         return book.get_absolute_url()
 
+    def prefetch(self, books):
+        """Gets the first author of every book on the page."""
+        self.authors = {}
+        relations = Tag.intermediary_table_model.objects.filter(
+            content_type=ContentType.objects.get_for_model(Book),
+            object_id__in=[book.pk for book in books],
+            tag__category='author').select_related('tag').order_by('tag__sort_key')
+        for relation in relations.iterator():
+            self.authors.setdefault(relation.object_id, relation.tag)
+
     def item_author_name(self, book):
-        try:
-            return book.tags.filter(category='author')[0].name
-        except KeyError:
-            return u''
+        author = self.authors.get(book.pk)
+        return author.name if author is not None else u''
 
     def item_author_link(self, book):
-        try:
-            return book.tags.filter(category='author')[0].get_absolute_url()
-        except KeyError:
-            return u''
+        author = self.authors.get(book.pk)
+        return author.get_absolute_url() if author is not None else u''
 
     def item_enclosure_url(self, book):
         return full_url(book.epub_file.url) if book.epub_file else None
@@ -215,7 +307,7 @@ class RootFeed(Feed):
         return item['description']
 
 @piwik_track
-class ByCategoryFeed(Feed):
+class ByCategoryFeed(PagedFeed):
     feed_type = OPDSFeed
     link = u'http://wolnelektury.pl/'
     description = u"Spis utworów na stronie http://WolneLektury.pl"
@@ -234,9 +326,13 @@ class ByCategoryFeed(Feed):
     def title(self, feed):
         return feed['title']
 
-    def items(self, feed):
+    def all_items(self, feed):
         return Tag.objects.filter(category=feed['category']).exclude(book_count=0)
 
+    def last_modified(self, feed):
+        return Tag.objects.filter(category=feed['category']).aggregate(
+            Max('changed_at'))['changed_at__max']
+
     def item_title(self, item):
         return item.name
 
@@ -260,14 +356,11 @@ class ByTagFeed(AcquisitionFeed):
     def get_object(self, request, category, slug):
         return get_object_or_404(Tag, category=category, slug=slug)
 
-    def items(self, tag):
-        books = Book.tagged.with_any([tag])
-        l_tags = Tag.objects.filter(category='book', slug__in=[book.book_tag_slug() for book in books.iterator()])
-        descendants_keys = [book.pk for book in Book.tagged.with_any(l_tags)]
-        if descendants_keys:
-            books = books.exclude(pk__in=descendants_keys)
+    def all_items(self, tag):
+        return Book.tagged_top_level([tag])
 
-        return books
+    def last_modified(self, tag):
+        return tag.changed_at
 
 
 @factory_decorator(logged_in_or_basicauth())
@@ -316,9 +409,12 @@ class UserSetFeed(AcquisitionFeed):
     def get_object(self, request, slug):
         return get_object_or_404(Tag, category='set', slug=slug, user=request.user)
 
-    def items(self, tag):
+    def all_items(self, tag):
         return Book.tagged.with_any([tag])
 
+    def last_modified(self, tag):
+        return tag.changed_at
+
 # no class decorators in python 2.5
 #UserSetFeed = factory_decorator(logged_in_or_basicauth())(UserSetFeed)
 
@@ -416,14 +512,12 @@ class SearchFeed(AcquisitionFeed):
                 srch.search_perfect_parts(toks, fuzzy=fuzzy, hint=hint),
                 srch.search_everywhere(toks, fuzzy=fuzzy, hint=hint))
             results.sort(reverse=True)
-            books = []
+            book_ids = []
             for r in results:
-                try:
-                    books.append(r.book)
-                except Book.DoesNotExist:
-                    pass
-            log.info("books: %s" % books)
-            return books
+                if r.book_id not in book_ids:
+                    book_ids.append(r.book_id)
+            log.info("books: %s" % book_ids)
+            return book_ids
         else:
             # Scenario 2: since we no longer have to figure out what the query term means to the user,
             # we can just use filters and not the Hint class.
@@ -442,14 +536,19 @@ class SearchFeed(AcquisitionFeed):
 
             flt = srch.chain_filters(filters)
             books = srch.search_books(TermQuery(Term('is_book', 'true')), filt=flt)
-            return books
+            return [book.pk for book in books]
 
     def get_link(self, query):
         return "%s?q=%s" % (reverse('search'), query)
 
-    def items(self, books):
-        try:
-            return books
-        except ValueError:
-            # too short a query
-            return []
+    def all_items(self, book_ids):
+        return book_ids
+
+    def prefetch(self, book_ids):
+        """Loads only the books on the page, all at once."""
+        books = Book.objects.in_bulk(book_ids)
+        self.books = [books[pk] for pk in book_ids if pk in books]
+        super(SearchFeed, self).prefetch(self.books)
+
+    def items(self, book_ids):
+        return self.books
@@ -88,6 +88,16 @@ class BookStub(models.Model):
         return ', '.join((self.author, self.title))
 
 
+def update_prefix_index(sender, instance, **kwargs):
+    from catalogue import prefix_index
+    prefix_index.object_changed('pd_author' if sender is Author else 'pd_book', instance.pk)
+
+post_delete.connect(update_prefix_index, Author)
+post_delete.connect(update_prefix_index, BookStub)
+post_save.connect(update_prefix_index, Author)
+post_save.connect(update_prefix_index, BookStub)
+
+
 if not settings.NO_SEARCH_INDEX:
     def update_index(sender, instance, **kwargs):
         import search
@@ -6,7 +6,7 @@ from django.conf import settings
 from django.core.files.storage import FileSystemStorage
 from django.utils.datastructures import SortedDict
 from django.template.loader import render_to_string
-from django.core.cache import get_cache
+from catalogue import cache_versions
 from catalogue.utils import split_tags
 from django.utils.safestring import mark_safe
 from slughifi import slughifi
@@ -171,13 +171,13 @@ class Picture(models.Model):
         if self.id is None:
             return
 
-        cache_key = "Picture.short_html/%d" % (self.id)
-        get_cache('permanent').delete(cache_key)
+        cache_versions.bump(('picture', self.id))
 
     def short_html(self):
         if self.id:
             cache_key = "Picture.short_html/%d" % (self.id)
-            short_html = get_cache('permanent').get(cache_key)
+            cache_deps = [('picture', self.id)]
+            short_html = cache_versions.get_cached(cache_key, cache_deps)
         else:
             short_html = None
 
@@ -191,5 +191,5 @@ class Picture(models.Model):
                 {'picture': self, 'tags': tags}))
 
             if self.id:
-                get_cache('permanent').set(cache_key, short_html)
+                cache_versions.set_cached(cache_key, short_html, cache_deps)
             return mark_safe(short_html)
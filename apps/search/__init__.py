@@ -1,3 +1,5 @@
 import lucene
 
-from index import Index, Search, ReusableIndex, SearchResult, JVM, IndexChecker, IndexStore
+from index import Index, Search, ReusableIndex, SearchResult, JVM, IndexChecker, IndexStore, \
+    ParallelSearch, SearcherManager, ResultCache, \
+    Vocabulary
@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 
 from django.conf import settings
+from django.core.cache import get_cache
+from django.db import connection
 from django.dispatch import Signal
 from lucene import SimpleFSDirectory, NIOFSDirectory, IndexWriter, IndexReader, IndexWriterConfig, CheckIndex, \
     File, Field, Integer, \
@@ -24,14 +26,19 @@ import sys
 import os
 import re
 import errno
+from time import time
+import mmap
 from librarian import dcparser
 from librarian.parser import WLDocument
 from lxml import etree
 import catalogue.models
 from pdcounter.models import Author as PDCounterAuthor, BookStub as PDCounterBook
 from multiprocessing.pool import ThreadPool
-from threading import current_thread
+from threading import current_thread, RLock, Thread
 from itertools import chain
+from collections import OrderedDict
+from hashlib import md5
+from uuid import uuid4
 import atexit
 import traceback
 import logging
@@ -77,23 +84,69 @@ class WLAnalyzer(PerFieldAnalyzerWrapper):
         self.addAnalyzer("POLISH", polish)
 
 
+def index_id(path=None):
+    """
+    Identity of the index: a random id made when the index directory
+    is created, so it changes whenever the index is built from scratch.
+    """
+    path = path or settings.SEARCH_INDEX
+    id_path = os.path.join(path, IndexStore.ID_FILE)
+    try:
+        with open(id_path) as f:
+            return f.read().strip()
+    except IOError as exc:
+        if exc.errno != errno.ENOENT:
+            raise
+    new_id = uuid4().hex
+    try:
+        os.makedirs(path)
+    except OSError as exc:
+        if exc.errno != errno.EEXIST:
+            raise
+    tmp_path = "%s.%d" % (id_path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        f.write(new_id)
+    try:
+        # fails if another process was first
+        os.link(tmp_path, id_path)
+    except OSError as exc:
+        if exc.errno != errno.EEXIST:
+            raise
+        with open(id_path) as f:
+            new_id = f.read().strip()
+    finally:
+        os.unlink(tmp_path)
+    return new_id
+
+
 class IndexStore(object):
     """
     Provides access to search index.
 
     self.store - lucene index directory
     """
-    def __init__(self):
+    ID_FILE = 'index.id'
+
+    def __init__(self, path=None):
+        self.path = path or settings.SEARCH_INDEX
         self.make_index_dir()
-        self.store = NIOFSDirectory(File(settings.SEARCH_INDEX))
+        self.store = NIOFSDirectory(File(self.path))
 
     def make_index_dir(self):
         try:
-            os.makedirs(settings.SEARCH_INDEX)
+            os.makedirs(self.path)
         except OSError as exc:
             if exc.errno == errno.EEXIST:
                 pass
             else: raise
+        index_id(self.path)
+
+    def snippet_store(self):
+        if self.path == settings.SEARCH_INDEX:
+            return SnippetStore.instance()
+        if getattr(self, '_snippet_store', None) is None:
+            self._snippet_store = SnippetStore(os.path.join(self.path, SnippetStore.SNIPPET_DIR))
+        return self._snippet_store
 
     def close(self):
         self.store.close()
@@ -109,48 +162,214 @@ class IndexChecker(IndexStore):
         return status
 
 
-class Snippets(object):
+class SnippetStore(object):
     """
-    This class manages snippet files for indexed object (book)
-    the snippets are concatenated together, and their positions and
-    lengths are kept in lucene index fields.
+    Keeps snippets of all indexed books in append-only segment files.
+
+    Snippets of one indexed revision of a book are stored contiguously,
+    and their positions stored in lucene index are relative to the start
+    of that span. The offset table (an append-only text file with lines of
+    `book_id revision segment offset length`) maps (book id, revision)
+    to the span, so segments can be compacted without touching the index.
+    A line with segment -1 marks the book as removed.
+
+    Segments are memory-mapped and kept open, so reading a snippet needs
+    no syscalls. Writes and compaction must be done while holding
+    the index write lock.
     """
     SNIPPET_DIR = "snippets"
+    TABLE = "table"
+    SEGMENT = "segment.%d"
 
-    def __init__(self, book_id, revision=None):
+    def __init__(self, path=None):
+        if path is None:
+            path = os.path.join(settings.SEARCH_INDEX, self.SNIPPET_DIR)
         try:
-            os.makedirs(os.path.join(settings.SEARCH_INDEX, self.SNIPPET_DIR))
+            os.makedirs(path)
         except OSError as exc:
             if exc.errno == errno.EEXIST:
                 pass
             else: raise
-        self.book_id = book_id
-        self.revision = revision
-        self.file = None
+        self.path = path
+        self.lock = RLock()
+        self.maps = {}
+        self.spans = {}
+        self.revisions = {}
+        self.removed = set()
+        self.segment = 0
+        self.table_stat = None
+
+    def segment_path(self, segment):
+        return os.path.join(self.path, self.SEGMENT % segment)
 
     @property
-    def path(self):
-        if self.revision: fn = "%d.%d" % (self.book_id, self.revision)
-        else: fn = "%d" % self.book_id
+    def table_path(self):
+        return os.path.join(self.path, self.TABLE)
+
+    def load(self, force=False):
+        """Reads the offset table, if it changed."""
+        with self.lock:
+            try:
+                st = os.stat(self.table_path)
+                stat = (st.st_ino, st.st_size, st.st_mtime)
+            except OSError:
+                stat = None
+            if stat == self.table_stat and not force:
+                return
+            if stat is None or self.table_stat is None or stat[0] != self.table_stat[0]:
+                # table replaced by compaction or a whole new index,
+                # segment numbers might mean different files now
+                self.maps = {}
+            spans, revisions, removed, segment = {}, {}, set(), 0
+            if stat is not None:
+                with open(self.table_path, 'rb') as f:
+                    for line in f:
+                        fields = line.split()
+                        if len(fields) != 5 or not line.endswith('\n'):
+                            continue  # unfinished write
+                        book_id, revision, seg, offset, length = map(int, fields)
+                        revisions[book_id] = max(revision, revisions.get(book_id, 0))
+                        if seg < 0:
+                            removed.add(book_id)
+                        else:
+                            removed.discard(book_id)
+                            spans[book_id, revision] = (seg, offset, length)
+                            segment = max(segment, seg)
+            self.spans, self.revisions, self.removed = spans, revisions, removed
+            self.segment = segment
+            self.table_stat = stat
+
+    def append_table(self, *lines):
+        with open(self.table_path, 'ab') as f:
+            for line in lines:
+                f.write("%d %d %d %d %d\n" % line)
+
+    def next_revision(self, book_id):
+        self.load()
+        return self.revisions.get(book_id, 0) + 1
+
+    def skip_revisions(self, revisions):
+        """
+        Makes next revisions of books go above given ones (a dict of
+        book id to revision), so that they don't clash with revisions
+        in another store. Books are marked as removed until reindexed.
+        """
+        with self.lock:
+            self.load()
+            self.append_table(*[(book_id, revision, -1, 0, 0)
+                for book_id, revision in sorted(revisions.iteritems())
+                if revision > self.revisions.get(book_id, 0)])
+
+    def remove(self, book_id):
+        with self.lock:
+            self.append_table((book_id, self.next_revision(book_id), -1, 0, 0))
+
+    def map(self, segment, size):
+        """Returns a mapping of a segment, covering at least `size` bytes."""
+        m = self.maps.get(segment)
+        if m is None or len(m) < size:
+            with self.lock:
+                with open(self.segment_path(segment), 'rb') as f:
+                    m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                self.maps[segment] = m
+        return m
+
+    def get(self, book_id, revision, position, length):
+        """Returns a snippet as unicode, or None if it's gone."""
+        key = (book_id, revision)
+        span = self.spans.get(key)
+        if span is None:
+            self.load()
+            span = self.spans.get(key)
+            if span is None:
+                return None
+        segment, offset, span_length = span
+        start = offset + position
+        try:
+            m = self.map(segment, start + length)
+        except (IOError, OSError):
+            # compacted in the meantime
+            self.load(force=True)
+            if self.spans.get(key) == span:
+                raise
+            return self.get(book_id, revision, position, length)
+        return m[start:start + length].decode('utf-8')
+
+    def compact(self):
+        """
+        Copies snippets of current revisions of books into a new segment
+        and removes all the old segments.
+        """
+        with self.lock:
+            self.load(force=True)
+            old_segments = set(seg for seg, offset, length in self.spans.values())
+            segment = self.segment + 1
+            lines = []
+            with open(self.segment_path(segment), 'wb') as out:
+                for book_id, revision in sorted(self.revisions.iteritems()):
+                    if book_id in self.removed:
+                        continue
+                    span = self.spans.get((book_id, revision))
+                    if span is None:
+                        continue
+                    seg, offset, length = span
+                    m = self.map(seg, offset + length)
+                    lines.append((book_id, revision, segment, out.tell(), length))
+                    out.write(m[offset:offset + length])
+                out.flush()
+                os.fsync(out.fileno())
+            new_table = self.table_path + '.new'
+            with open(new_table, 'wb') as f:
+                for line in lines:
+                    f.write("%d %d %d %d %d\n" % line)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(new_table, self.table_path)
+            for seg in old_segments:
+                self.maps.pop(seg, None)
+                try:
+                    os.unlink(self.segment_path(seg))
+                except OSError:
+                    pass
+            self.load(force=True)
+
+    _instance = None
+
+    @classmethod
+    def instance(cls):
+        """Returns the store shared by the whole process."""
+        with _snippet_store_lock:
+            if cls._instance is None or cls._instance.path != os.path.join(
+                    settings.SEARCH_INDEX, cls.SNIPPET_DIR):
+                cls._instance = cls()
+            return cls._instance
+
+
+_snippet_store_lock = RLock()
 
-        return os.path.join(settings.SEARCH_INDEX, self.SNIPPET_DIR, fn)
+
+class Snippets(object):
+    """
+    This class writes snippets for indexed object (book)
+    the snippets are concatenated together, and their positions and
+    lengths are kept in lucene index fields.
+    """
+    def __init__(self, book_id, revision=None, store=None):
+        self.store = store or SnippetStore.instance()
+        self.book_id = book_id
+        self.revision = revision
+        self.file = None
 
     def open(self, mode='r'):
         """
-        Open the snippet file. Call .close() afterwards.
+        Open the snippets for writing ('w'). Call .close() afterwards.
         """
-        if not 'b' in mode:
-            mode += 'b'
-
         if 'w' in mode:
-            if os.path.exists(self.path):
-                self.revision = 1
-                while True:
-                    if not os.path.exists(self.path):
-                        break
-                    self.revision += 1
-
-        self.file = open(self.path, mode)
+            self.revision = self.store.next_revision(self.book_id)
+            self.segment = self.store.segment
+            self.file = open(self.store.segment_path(self.segment), 'ab')
+            self.file.seek(0, 2)
+            self.offset = self.file.tell()
         self.position = 0
         return self
 
@@ -171,24 +390,19 @@ class Snippets(object):
         Given a tuple of (position, length) return an unicode
         of the snippet stored there.
         """
-        self.file.seek(pos[0], 0)
-        txt = self.file.read(pos[1]).decode('utf-8')
-        return txt
+        return self.store.get(self.book_id, self.revision or 0, pos[0], pos[1])
 
     def close(self):
-        """Close snippet file"""
+        """Close snippet file and record the snippets in offset table"""
+        if self.file is None:
+            return
         self.file.close()
+        self.file = None
+        self.store.append_table((self.book_id, self.revision,
+                                 self.segment, self.offset, self.position))
 
     def remove(self):
-        self.revision = None
-        try:
-            os.unlink(self.path)
-            self.revision = 0
-            while True:
-                self.revision += 1
-                os.unlink(self.path)
-        except OSError:
-            pass
+        self.store.remove(self.book_id)
 
 
 class BaseIndex(IndexStore):
@@ -196,8 +410,8 @@ class BaseIndex(IndexStore):
     Base index class.
     Provides basic operations on index: opening, closing, optimizing.
     """
-    def __init__(self, analyzer=None):
-        super(BaseIndex, self).__init__()
+    def __init__(self, analyzer=None, path=None):
+        super(BaseIndex, self).__init__(path)
         self.index = None
         if not analyzer:
             analyzer = WLAnalyzer()
@@ -213,14 +427,14 @@ class BaseIndex(IndexStore):
         return self.index
 
     def optimize(self):
+        """Merges the index and compacts snippets. Takes a while, so it's
+        only done by the optimizeindex command."""
         self.index.optimize()
+        self.snippet_store().compact()
 
     def close(self):
-        try:
-            self.index.optimize()
-        except JavaError, je:
-            log.error("Error during optimize phase, check index: %s" % je)
-
+        """Commits changes and closes the writer, leaving segment merges
+        to the merge policy."""
         self.index.close()
         self.index = None
 
@@ -243,13 +457,13 @@ class Index(BaseIndex):
     """
     Class indexing books.
     """
-    def __init__(self, analyzer=None):
-        super(Index, self).__init__(analyzer)
+    def __init__(self, analyzer=None, path=None):
+        super(Index, self).__init__(analyzer, path)
 
     def index_tags(self, *tags, **kw):
         """
-        Re-index global tag list.
-        Removes all tags from index, then index them again.
+        Re-index global tag list, or just the given tags.
+        Removes tags from index, then index them again.
         Indexed fields include: id, name (with and without polish stems), category
         """
         remove_only = kw.get('remove_only', False)
@@ -273,7 +487,7 @@ class Index(BaseIndex):
                 q.add(b_id_cat, BooleanClause.Occur.SHOULD)
         else:  # all
             q = NumericRangeQuery.newIntRange("tag_id", 0, Integer.MAX_VALUE, True, True)
-            self.index.deleteDocuments(q)
+        self.index.deleteDocuments(q)
 
         if not remove_only:
             # then add them [all or just one passed]
@@ -313,8 +527,8 @@ class Index(BaseIndex):
         """
         doc = Document()
         doc.add(NumericField("book_id", Field.Store.YES, True).setIntValue(int(book.id)))
-        if book.parent is not None:
-            doc.add(NumericField("parent_id", Field.Store.YES, True).setIntValue(int(book.parent.id)))
+        if book.parent_id is not None:
+            doc.add(NumericField("parent_id", Field.Store.YES, True).setIntValue(int(book.parent_id)))
         return doc
 
     def remove_book(self, book_or_id, remove_snippets=True):
@@ -329,22 +543,27 @@ class Index(BaseIndex):
         self.index.deleteDocuments(q)
 
         if remove_snippets:
-            snippets = Snippets(book_id)
+            snippets = Snippets(book_id, store=self.snippet_store())
             snippets.remove()
 
-    def index_book(self, book, book_info=None, overwrite=True):
+    indexed_metadata = ['source_name', 'authors', 'title']
+
+    def index_book(self, book, book_info=None, overwrite=True, wldoc=None, extracted=None):
         """
         Indexes the book.
         Creates a lucene document for extracted metadata
         and calls self.index_content() to index the contents of the book.
+        Data already extracted with `extract_book` may be passed as `extracted`.
         """
         if overwrite:
             # we don't remove snippets, since they might be still needed by
             # threads using not reopened index
             self.remove_book(book, remove_snippets=False)
 
+        values, parts = extracted or (None, None)
         book_doc = self.create_book_doc(book)
-        meta_fields = self.extract_metadata(book, book_info, dc_only=['source_name', 'authors', 'title'])
+        meta_fields = self.extract_metadata(book, book_info, dc_only=self.indexed_metadata,
+                                            values=values)
         # let's not index it - it's only used for extracting publish date
         if 'source_name' in meta_fields:
             del meta_fields['source_name']
@@ -358,7 +577,18 @@ class Index(BaseIndex):
         self.index.addDocument(book_doc)
         del book_doc
 
-        self.index_content(book, book_fields=[meta_fields['title'], meta_fields['authors'], meta_fields['published_date']])
+        self.index_content(book, book_fields=[meta_fields['title'], meta_fields['authors'], meta_fields['published_date']],
+                           wldoc=wldoc, parts=parts)
+
+    @classmethod
+    def extract_book(cls, xml_path):
+        """
+        Parses the book and extracts all data needed to index it,
+        as plain values. Doesn't need JVM nor database access.
+        """
+        wldoc = WLDocument.from_file(xml_path)
+        return (cls.metadata_values(wldoc.book_info, dc_only=cls.indexed_metadata),
+                list(cls.extract_content(wldoc)))
 
     master_tags = [
         'opowiadanie',
@@ -382,19 +612,41 @@ class Index(BaseIndex):
 
     published_date_re = re.compile("([0-9]+)[\]. ]*$")
 
-    def extract_metadata(self, book, book_info=None, dc_only=None):
+    def extract_metadata(self, book, book_info=None, dc_only=None, values=None):
         """
         Extract metadata from book and returns a map of fields keyed by fieldname
+        Already extracted `values` (see `metadata_values`) may be passed.
         """
         fields = {}
 
-        if book_info is None:
-            book_info = dcparser.parse(open(book.xml_file.path))
+        if values is None:
+            if book_info is None:
+                book_info = dcparser.parse(open(book.xml_file.path))
+            values = self.metadata_values(book_info, dc_only)
 
         fields['slug'] = Field("slug", book.slug, Field.Store.NO, Field.Index.ANALYZED_NO_NORMS)
         fields['tags'] = self.add_gaps([Field("tags", t.name, Field.Store.NO, Field.Index.ANALYZED) for t in book.tags], 'tags')
         fields['is_book'] = Field("is_book", 'true', Field.Store.NO, Field.Index.NOT_ANALYZED)
 
+        for name, (value, analyzed) in values.items():
+            if name == 'published_date':
+                fields[name] = Field(name, value, Field.Store.YES, Field.Index.NOT_ANALYZED)
+                continue
+            try:
+                fields[name] = Field(name, value, Field.Store.NO,
+                        Field.Index.ANALYZED if analyzed else Field.Index.NOT_ANALYZED)
+            except JavaError as je:
+                raise Exception("failed to add field: %s = '%s', %s(%s)" % (name, value, je.message, je.args))
+
+        return fields
+
+    @classmethod
+    def metadata_values(cls, book_info, dc_only=None):
+        """
+        Returns a map of (value, analyzed) pairs of metadata fields keyed by fieldname.
+        """
+        values = {}
+
         # validator, name
         for field in dcparser.BookInfo.FIELDS:
             if dc_only and field.name not in dc_only:
@@ -408,32 +660,28 @@ class Index(BaseIndex):
                     s = getattr(book_info, field.name)
                     if field.multiple:
                         s = ', '.join(s)
-                    try:
-                        fields[field.name] = Field(field.name, s, Field.Store.NO, Field.Index.ANALYZED)
-                    except JavaError as je:
-                        raise Exception("failed to add field: %s = '%s', %s(%s)" % (field.name, s, je.message, je.args))
+                    values[field.name] = (s, True)
                 elif type_indicator == dcparser.as_person:
                     p = getattr(book_info, field.name)
                     if isinstance(p, dcparser.Person):
                         persons = unicode(p)
                     else:
                         persons = ', '.join(map(unicode, p))
-                    fields[field.name] = Field(field.name, persons, Field.Store.NO, Field.Index.ANALYZED)
+                    values[field.name] = (persons, True)
                 elif type_indicator == dcparser.as_date:
                     dt = getattr(book_info, field.name)
-                    fields[field.name] = Field(field.name, "%04d%02d%02d" %\
-                                               (dt.year, dt.month, dt.day), Field.Store.NO, Field.Index.NOT_ANALYZED)
+                    values[field.name] = ("%04d%02d%02d" % (dt.year, dt.month, dt.day), False)
 
         # get published date
         pd = None
         if hasattr(book_info, 'source_name') and book_info.source_name:
-            match = self.published_date_re.search(book_info.source_name)
+            match = cls.published_date_re.search(book_info.source_name)
             if match is not None:
                 pd = str(match.groups()[0])
         if not pd: pd = ""
-        fields["published_date"] = Field("published_date", pd, Field.Store.YES, Field.Index.NOT_ANALYZED)
+        values["published_date"] = (pd, False)
 
-        return fields
+        return values
 
     def add_gaps(self, fields, fieldname):
         """
@@ -445,54 +693,26 @@ class Index(BaseIndex):
                 yield Field(fieldname, ' ', Field.Store.NO, Field.Index.NOT_ANALYZED)
         return reduce(lambda a, b: a + b, zip(fields, gap()))[0:-1]
 
-    def get_master(self, root):
+    @classmethod
+    def get_master(cls, root):
         """
         Returns the first master tag from an etree.
         """
         for master in root.iter():
-            if master.tag in self.master_tags:
+            if master.tag in cls.master_tags:
                 return master
 
-    def index_content(self, book, book_fields=[]):
+    def index_content(self, book, book_fields=[], wldoc=None, parts=None):
         """
         Walks the book XML and extract content from it.
         Adds parts for each header tag and for each fragment.
+        An already parsed document may be passed as `wldoc`,
+        or already extracted parts (see `extract_content`) as `parts`.
         """
-        wld = WLDocument.from_file(book.xml_file.path, parse_dublincore=False)
-        root = wld.edoc.getroot()
-
-        master = self.get_master(root)
-        if master is None:
-            return []
-
-        def walker(node, ignore_tags=[]):
-
-            if node.tag not in ignore_tags:
-                yield node, None, None
-                if node.text is not None:
-                    yield None, node.text, None
-                for child in list(node):
-                    for b, t, e in walker(child):
-                        yield b, t, e
-                yield None, None, node
-
-            if node.tail is not None:
-                yield None, node.tail, None
-            return
-
-        def fix_format(text):
-            #            separator = [u" ", u"\t", u".", u";", u","]
-            if isinstance(text, list):
-                # need to join it first
-                text = filter(lambda s: s is not None, content)
-                text = u' '.join(text)
-                # for i in range(len(text)):
-                #     if i > 0:
-                #         if text[i][0] not in separator\
-                #             and text[i - 1][-1] not in separator:
-                #          text.insert(i, u" ")
-
-            return re.sub("(?m)/$", "", text)
+        if parts is None:
+            if wldoc is None:
+                wldoc = WLDocument.from_file(book.xml_file.path, parse_dublincore=False)
+            parts = self.extract_content(wldoc)
 
         def add_part(snippets, **fields):
             doc = self.create_book_doc(book)
@@ -533,99 +753,140 @@ class Index(BaseIndex):
 
             return doc
 
+        snippets = Snippets(book.id, store=self.snippet_store()).open('w')
+        try:
+            for part in parts:
+                self.index.addDocument(add_part(snippets, **part))
+        finally:
+            snippets.close()
+
+    @staticmethod
+    def walk(node):
+        """
+        Yields (start, text, end) events for the node and its descendants,
+        in document order: element starts, texts and tails, element ends.
+        """
+        yield node, None, None
+        if node.text is not None:
+            yield None, node.text, None
+        stack = [(node, iter(node))]
+        while stack:
+            parent, children = stack[-1]
+            for child in children:
+                yield child, None, None
+                if child.text is not None:
+                    yield None, child.text, None
+                stack.append((child, iter(child)))
+                break
+            else:
+                stack.pop()
+                yield None, None, parent
+                if parent.tail is not None:
+                    yield None, parent.tail, None
+
+    @classmethod
+    def extract_content(cls, wldoc):
+        """
+        Extracts parts of the book to be indexed: sections, fragments
+        and footnotes. Yields dicts of plain values, so this can run
+        without JVM, e.g. in another process.
+
+        Text of the book goes into a single buffer; sections and fragments
+        only remember where they start in it. Text no longer needed by any
+        open fragment is dropped after each section.
+        """
+        root = wldoc.edoc.getroot()
+
+        master = cls.get_master(root)
+        if master is None:
+            return
+
+        def fix_format(texts):
+            return re.sub("(?m)/$", "", u' '.join(texts))
+
         def give_me_utf8(s):
             if isinstance(s, unicode):
                 return s.encode('utf-8')
             else:
                 return s
 
+        CONTENT, FOOTNOTE, SKIP = range(3)
+
+        text_buffer = []
+        buffer_start = 0   # position of text_buffer[0] in the book
         fragments = {}
-        snippets = Snippets(book.id).open('w')
-        try:
-            for header, position in zip(list(master), range(len(master))):
+        for position, header in enumerate(master):
 
-                if header.tag in self.skip_header_tags:
-                    continue
-                if header.tag is etree.Comment:
-                    continue
+            if header.tag in cls.skip_header_tags:
+                continue
+            if header.tag is etree.Comment:
+                continue
 
-                # section content
-                content = []
-                footnote = []
-
-                def all_content(text):
-                    for frag in fragments.values():
-                        frag['content'].append(text)
-                    content.append(text)
-                handle_text = [all_content]
-
-
-                for start, text, end in walker(header, ignore_tags=self.ignore_content_tags):
-                    # handle footnotes
-                    if start is not None and start.tag in self.footnote_tags:
-                        footnote = []
-                        def collect_footnote(t):
-                            footnote.append(t)
-                        handle_text.append(collect_footnote)
-                    elif end is not None and footnote is not [] and end.tag in self.footnote_tags:
-                        handle_text.pop()
-                        doc = add_part(snippets, header_index=position, header_type=header.tag,
-                                       content=u''.join(footnote),
-                                       is_footnote=Field("is_footnote", 'true', Field.Store.NO, Field.Index.NOT_ANALYZED))
-                
-                        self.index.addDocument(doc)
-                        #print "@ footnote text: %s" % footnote
-                        footnote = []
-                    
-                    # handle fragments and themes.
-                    if start is not None and start.tag == 'begin':
-                        fid = start.attrib['id'][1:]
-                        fragments[fid] = {'content': [], 'themes': [], 'start_section': position, 'start_header': header.tag}
-
-                    # themes for this fragment
-                    elif start is not None and start.tag == 'motyw':
-                        fid = start.attrib['id'][1:]
-                        handle_text.append(None)
-                        if start.text is not None:
-                            fragments[fid]['themes'] += map(str.strip, map(give_me_utf8, start.text.split(',')))
-                    elif end is not None and end.tag == 'motyw':
-                        handle_text.pop()
-
-                    elif start is not None and start.tag == 'end':
-                        fid = start.attrib['id'][1:]
-                        if fid not in fragments:
-                            continue  # a broken <end> node, skip it
-                        frag = fragments[fid]
-                        if frag['themes'] == []:
-                            continue  # empty themes list.
-                        del fragments[fid]
-
-                        doc = add_part(snippets,
-                                       header_type=frag['start_header'],
-                                       header_index=frag['start_section'],
-                                       header_span=position - frag['start_section'] + 1,
-                                       fragment_anchor=fid,
-                                       content=fix_format(frag['content']),
-                                       themes=frag['themes'])
-                        #print '@ FRAG %s' % frag['content']
-                        self.index.addDocument(doc)
-
-                        # Collect content.
-
-                    if text is not None and handle_text is not []:
-                        hdl = handle_text[-1]
-                        if hdl is not None:
-                            hdl(text)
-
-                        # in the end, add a section text.
-                doc = add_part(snippets, header_index=position, header_type=header.tag,
-                               content=fix_format(content))
-                #print '@ CONTENT: %s' % fix_format(content)
-
-                self.index.addDocument(doc)
+            section_start = buffer_start + len(text_buffer)
+            footnote = []
+            handle_text = [CONTENT]
 
-        finally:
-            snippets.close()
+            if header.tag in cls.ignore_content_tags:
+                events = [(None, header.tail, None)]
+            else:
+                events = cls.walk(header)
+
+            for start, text, end in events:
+                # handle footnotes
+                if start is not None and start.tag in cls.footnote_tags:
+                    footnote = []
+                    handle_text.append(FOOTNOTE)
+                elif end is not None and end.tag in cls.footnote_tags:
+                    handle_text.pop()
+                    yield dict(header_index=position, header_type=header.tag,
+                               content=u''.join(footnote), is_footnote=True)
+                    footnote = []
+
+                # handle fragments and themes.
+                if start is not None and start.tag == 'begin':
+                    fid = start.attrib['id'][1:]
+                    fragments[fid] = {'start': buffer_start + len(text_buffer), 'themes': [],
+                                      'start_section': position, 'start_header': header.tag}
+
+                # themes for this fragment
+                elif start is not None and start.tag == 'motyw':
+                    fid = start.attrib['id'][1:]
+                    handle_text.append(SKIP)
+                    if start.text is not None:
+                        fragments[fid]['themes'] += map(str.strip, map(give_me_utf8, start.text.split(',')))
+                elif end is not None and end.tag == 'motyw':
+                    handle_text.pop()
+
+                elif start is not None and start.tag == 'end':
+                    fid = start.attrib['id'][1:]
+                    frag = fragments.pop(fid, None)
+                    if frag is None:
+                        continue  # a broken <end> node, skip it
+                    if frag['themes'] == []:
+                        continue  # empty themes list.
+
+                    yield dict(header_type=frag['start_header'],
+                               header_index=frag['start_section'],
+                               header_span=position - frag['start_section'] + 1,
+                               fragment_anchor=fid,
+                               content=fix_format(text_buffer[frag['start'] - buffer_start:]),
+                               themes=frag['themes'])
+
+                if text is not None:
+                    if handle_text[-1] == CONTENT:
+                        text_buffer.append(text)
+                    elif handle_text[-1] == FOOTNOTE:
+                        footnote.append(text)
+
+            # in the end, add a section text.
+            yield dict(header_index=position, header_type=header.tag,
+                       content=fix_format(text_buffer[section_start - buffer_start:]))
+
+            # forget the text not needed by open fragments
+            keep = min([frag['start'] for frag in fragments.values()] +
+                       [buffer_start + len(text_buffer)])
+            del text_buffer[:keep - buffer_start]
+            buffer_start = keep
 
 
 def log_exception_wrapper(f):
@@ -664,7 +925,6 @@ class ReusableIndex(Index):
     @staticmethod
     def close_reusable():
         if ReusableIndex.index:
-            ReusableIndex.index.optimize()
             ReusableIndex.index.close()
             ReusableIndex.index = None
 
@@ -774,11 +1034,65 @@ class SearchResult(object):
 
     def get_book(self):
         if hasattr(self, '_book'):
+            if self._book is None:
+                raise catalogue.models.Book.DoesNotExist
             return self._book
         return catalogue.models.Book.objects.get(id=self.book_id)
 
     book = property(get_book)
 
+    def to_cache(self):
+        """Returns plain data the result can be rebuilt from, see `from_cache`."""
+        return (self.book_id, self._score, self.published_date, list(self._hits))
+
+    @classmethod
+    def from_cache(cls, search, data, searched=None, tokens_cache=None):
+        """Rebuilds a result from `to_cache` data without touching the index."""
+        if tokens_cache is None: tokens_cache = {}
+        self = cls.__new__(cls)
+        self.book_id, self._score, self.published_date, hits = data
+        self._hits = list(hits)
+        self._processed_hits = None
+        self.boost = 1.0
+        self.search = search
+        self.searched = searched
+        self.tokens_cache = tokens_cache
+        return self
+
+    @staticmethod
+    def hydrate(results):
+        """
+        Loads books, hit fragments and their themes for many results at once,
+        so that accessing `book` and `hits` doesn't query the database.
+        """
+        from django.contrib.contenttypes.models import ContentType
+        Book, Fragment, Tag = catalogue.models.Book, catalogue.models.Fragment, catalogue.models.Tag
+
+        book_ids = set(r.book_id for r in results)
+        anchors = set(hit[1] for r in results for hit in r._hits if hit[1] is not None)
+        books = Book.objects.in_bulk(book_ids)
+
+        fragments = {}
+        by_id = {}
+        if anchors:
+            for frag in Fragment.objects.filter(book__in=book_ids, anchor__in=anchors):
+                book_fragments = fragments.setdefault(frag.book_id, {})
+                if frag.anchor in book_fragments:
+                    continue
+                frag.book = books[frag.book_id]
+                frag.theme_tags = []
+                book_fragments[frag.anchor] = by_id[frag.pk] = frag
+        if by_id:
+            for rel in Tag.intermediary_table_model.objects.filter(
+                    content_type=ContentType.objects.get_for_model(Fragment),
+                    object_id__in=by_id.keys(), tag__category='theme'
+                    ).select_related('tag').order_by('tag__sort_key'):
+                by_id[rel.object_id].theme_tags.append(rel.tag)
+
+        for r in results:
+            r._book = books.get(r.book_id)
+            r._fragments = fragments.get(r.book_id, {})
+
     @property
     def hits(self):
         if self._processed_hits is not None:
@@ -837,20 +1151,28 @@ class SearchResult(object):
 
         hits = sections.values()
 
+        fragments = getattr(self, '_fragments', None)
         for f in frags:
-            try:
-                frag = catalogue.models.Fragment.objects.get(anchor=f[FRAGMENT], book__id=self.book_id)
-            except catalogue.models.Fragment.DoesNotExist:
-                # stale index
-                continue
+            if fragments is not None:
+                frag = fragments.get(f[FRAGMENT])
+                if frag is None:
+                    # stale index
+                    continue
+                themes = frag.theme_tags
+            else:
+                try:
+                    frag = catalogue.models.Fragment.objects.get(anchor=f[FRAGMENT], book__id=self.book_id)
+                except catalogue.models.Fragment.DoesNotExist:
+                    # stale index
+                    continue
+                themes = frag.tags.filter(category='theme')
 
             # Figure out if we were searching for a token matching some word in theme name.
-            themes = frag.tags.filter(category='theme')
             themes_hit = []
             if self.searched is not None:
                 tokens = self.search.get_tokens(self.searched, 'POLISH', cached=self.tokens_cache)
                 for theme in themes:
-                    name_tokens = self.search.get_tokens(theme.name, 'POLISH')
+                    name_tokens = self.search.name_tokens(theme.name)
                     for t in tokens:
                         if t in name_tokens:
                             if not theme in themes_hit:
@@ -990,29 +1312,92 @@ class Hint(object):
         return some
 
 
+def _timed(f, args, kwargs):
+    start = time()
+    try:
+        result = f(*args, **kwargs)
+    finally:
+        # strategies shouldn't use the database, but if one does,
+        # don't leave the connection open in the pool thread
+        connection.close()
+    return result, time() - start
+
+
+class ParallelSearch(object):
+    """
+    Runs independent search strategies concurrently.
+
+    Strategies are run in a process-wide pool of threads attached to JVM;
+    Lucene searchers and analyzers are safe to share between them. Time
+    spent in each strategy is recorded in `timings`.
+
+    Strategies should only read the index: each pool thread would open
+    its own database connection, so objects are loaded by the caller.
+    """
+    _pool = None
+    _pool_lock = RLock()
+
+    def __init__(self):
+        self.jobs = {}
+        self.timings = {}
+
+    @classmethod
+    def pool(cls):
+        with cls._pool_lock:
+            if cls._pool is None:
+                cls._pool = ThreadPool(getattr(settings, 'SEARCH_THREADS', 8),
+                                       JVM.attachCurrentThread)
+            return cls._pool
+
+    def add(self, name, f, *args, **kwargs):
+        """Starts running f(*args, **kwargs) as strategy `name`."""
+        self.jobs[name] = self.pool().apply_async(_timed, (f, args, kwargs))
+
+    def result(self, name):
+        """Waits for the strategy to finish and returns its result."""
+        result, self.timings[name] = self.jobs[name].get()
+        return result
+
+    def aggregate(self, *names):
+        """Returns results of many strategies, merged by book."""
+        return SearchResult.aggregate(*[self.result(name) for name in names])
+
+
 class Search(IndexStore):
     """
     Search facilities.
+
+    If a `reader` is given, it's managed by the caller (see SearcherManager),
+    otherwise Search opens its own and reopens it on `index_changed`.
     """
-    def __init__(self, default_field="content"):
+    def __init__(self, default_field="content", reader=None, analyzer=None):
         IndexStore.__init__(self)
-        self.analyzer = WLAnalyzer()  # PolishAnalyzer(Version.LUCENE_34)
-        # self.analyzer = WLAnalyzer()
-        reader = IndexReader.open(self.store, True)
+        if analyzer is None:
+            analyzer = WLAnalyzer()  # PolishAnalyzer(Version.LUCENE_34)
+        self.analyzer = analyzer
+        self.managed = reader is not None
+        if reader is None:
+            reader = IndexReader.open(self.store, True)
         self.searcher = IndexSearcher(reader)
         self.parser = QueryParser(Version.LUCENE_34, default_field,
                                   self.analyzer)
 
         self.parent_filter = TermsFilter()
         self.parent_filter.addTerm(Term("is_book", "true"))
-        index_changed.connect(self.reopen)
+        if not self.managed:
+            index_changed.connect(self.reopen)
+
+    def version(self):
+        """Version of the index snapshot being searched."""
+        return self.searcher.getIndexReader().getVersion()
 
     def close(self):
         reader = self.searcher.getIndexReader()
         self.searcher.close()
-        reader.close()
+        if not self.managed:
+            reader.close()
+            index_changed.disconnect(self.reopen)
         super(Search, self).close()
-        index_changed.disconnect(self.reopen)
 
     def reopen(self, **unused):
         reader = self.searcher.getIndexReader()
@@ -1066,6 +1451,16 @@ class Search(IndexStore):
 
         return toks
 
+    _name_tokens = {}
+
+    def name_tokens(self, name):
+        """Same as get_tokens(name, 'POLISH'), cached process-wide."""
+        try:
+            return Search._name_tokens[name]
+        except KeyError:
+            tokens = Search._name_tokens[name] = self.get_tokens(name, 'POLISH')
+            return tokens
+
     @staticmethod
     def fuzziness(fuzzy):
         """Helper method to sanitize fuzziness"""
@@ -1340,20 +1735,13 @@ class Search(IndexStore):
 
         # locate content.
         book_id = int(stored.get('book_id'))
-        snippets = Snippets(book_id, revision=revision)
 
         try:
-            snippets.open()
-        except IOError, e:
-            log.error("Cannot open snippet file for book id = %d [rev=%d], %s" % (book_id, revision, e))
-            return []
-
-        try:
-            try:
-                text = snippets.get((int(position),
-                                     int(length)))
-            finally:
-                snippets.close()
+            text = SnippetStore.instance().get(book_id, revision or 0,
+                                               int(position), int(length))
+            if text is None:
+                log.error("No snippets for book id = %d [rev=%d]" % (book_id, revision or 0))
+                return []
 
             tokenStream = TokenSources.getAnyTokenStream(self.searcher.getIndexReader(), scoreDoc.doc, field, self.analyzer)
             #  highlighter.getBestTextFragments(tokenStream, text, False, 10)
@@ -1384,39 +1772,73 @@ class Search(IndexStore):
         if terms:
             return JArray('object')(terms, Term)
 
-    def search_tags(self, query, filt=None, max_results=40, pdcounter=False):
+    def search_tag_refs(self, query, filt=None, max_results=40, pdcounter=False):
         """
-        Search for Tag objects using query.
+        Search for tags using query. Only reads the index,
+        returns references to tags as `tag_refs` does.
         """
         if not pdcounter:
             filters = self.chain_filters([filt, self.term_filter(Term('is_pdcounter', 'true'), inverse=True)])
         tops = self.searcher.search(query, filt, max_results)
 
-        tags = []
+        refs = []
         for found in tops.scoreDocs:
             doc = self.searcher.doc(found.doc)
-            is_pdcounter = doc.get('is_pdcounter')
-            category = doc.get('tag_category')
-            try:
-                if is_pdcounter == 'true':
-                    if category == 'pd_author':
-                        tag = PDCounterAuthor.objects.get(id=doc.get('tag_id'))
-                    elif category == 'pd_book':
-                        tag = PDCounterBook.objects.get(id=doc.get('tag_id'))
-                        tag.category = 'pd_book'  # make it look more lik a tag.
-                    else:
-                        print "Warning. cannot get pdcounter tag_id=%d from db; cat=%s" % (int(doc.get('tag_id')), category)
+            tag_id = int(doc.get('tag_id'))
+            if doc.get('is_pdcounter') == 'true':
+                category = doc.get('tag_category')
+                if category in ('pd_author', 'pd_book'):
+                    refs.append((category, tag_id))
                 else:
-                    tag = catalogue.models.Tag.objects.get(id=doc.get("tag_id"))
-                    # don't add the pdcounter tag if same tag already exists
-                if not (is_pdcounter and filter(lambda t: tag.slug == t.slug, tags)):
-                    tags.append(tag)
-            except catalogue.models.Tag.DoesNotExist: pass
-            except PDCounterAuthor.DoesNotExist: pass
-            except PDCounterBook.DoesNotExist: pass
+                    log.warning("cannot get pdcounter tag_id=%d from db; cat=%s" % (tag_id, category))
+            else:
+                refs.append(('tag', tag_id))
+        return refs
 
+    def search_tags(self, query, filt=None, max_results=40, pdcounter=False):
+        """
+        Search for Tag objects using query.
+        """
+        tags = self.tags_from_refs(self.search_tag_refs(query, filt, max_results, pdcounter))
         log.debug('search_tags: %s' % tags)
+        return tags
 
+    @staticmethod
+    def tag_refs(tags):
+        """Returns plain references to tags returned by search_tags."""
+        refs = []
+        for tag in tags:
+            if isinstance(tag, PDCounterAuthor):
+                refs.append(('pd_author', tag.id))
+            elif isinstance(tag, PDCounterBook):
+                refs.append(('pd_book', tag.id))
+            else:
+                refs.append(('tag', tag.id))
+        return refs
+
+    @staticmethod
+    def tags_from_refs(refs):
+        """Loads tags referenced by `tag_refs`, skipping removed ones."""
+        models = {
+            'tag': catalogue.models.Tag,
+            'pd_author': PDCounterAuthor,
+            'pd_book': PDCounterBook,
+            }
+        loaded = {}
+        for kind, model in models.items():
+            ids = [tag_id for k, tag_id in refs if k == kind]
+            if ids:
+                loaded[kind] = model.objects.in_bulk(ids)
+        tags = []
+        for kind, tag_id in refs:
+            tag = loaded[kind].get(tag_id)
+            if tag is not None:
+                if kind == 'pd_book':
+                    tag.category = 'pd_book'  # make it look more lik a tag.
+                # don't add the pdcounter tag if same tag already exists
+                if kind != 'tag' and filter(lambda t: tag.slug == t.slug, tags):
+                    continue
+                tags.append(tag)
         return tags
 
     def search_books(self, query, filt=None, max_results=10):
@@ -1463,6 +1885,14 @@ class Search(IndexStore):
         Return auto-complete hints for tags
         using prefix search.
         """
+        return self.tags_from_refs(self.hint_tag_refs(
+            string, max_results=max_results, pdcounter=pdcounter, prefix=prefix, fuzzy=fuzzy))
+
+    def hint_tag_refs(self, string, max_results=50, pdcounter=True, prefix=True, fuzzy=False):
+        """
+        Same as `hint_tags`, but only reads the index,
+        returns references to tags as `tag_refs` does.
+        """
         toks = self.get_tokens(string, field='SIMPLE')
         top = BooleanQuery()
 
@@ -1475,7 +1905,7 @@ class Search(IndexStore):
 
         no_book_cat = self.term_filter(Term("tag_category", "book"), inverse=True)
 
-        return self.search_tags(top, no_book_cat, max_results=max_results, pdcounter=pdcounter)
+        return self.search_tag_refs(top, no_book_cat, max_results=max_results, pdcounter=pdcounter)
 
     def hint_books(self, string, max_results=50, prefix=True, fuzzy=False):
         """
@@ -1514,3 +1944,291 @@ class Search(IndexStore):
 
     def hint(self):
         return Hint(self)
+
+
+class SearcherManager(object):
+    """
+    Shares a Search over one snapshot of the index between threads.
+
+    Every `refresh_interval` seconds, the first thread to acquire a search
+    checks if the index changed (possibly in another process) and reopens
+    the reader, while other threads go on with the old one. Readers are
+    reference-counted, so an old reader is closed only after all searches
+    in progress release it. In this process, `index_changed` forces the
+    check at once. If the whole index directory was replaced (see the
+    reindex command), a new reader is opened instead of reopening.
+    """
+    def __init__(self, refresh_interval=None):
+        if refresh_interval is None:
+            refresh_interval = getattr(settings, 'SEARCH_REFRESH_INTERVAL', 10)
+        self.refresh_interval = refresh_interval
+        self.lock = RLock()
+        self.refresh_lock = RLock()
+        self.current = None
+        self.analyzer = None
+        self.store = None
+        self.last_check = 0
+        index_changed.connect(self.index_changed)
+
+    @staticmethod
+    def index_dir_id():
+        return os.stat(settings.SEARCH_INDEX).st_ino
+
+    def open(self):
+        """Opens the index, unless it's already opened."""
+        with self.lock:
+            if self.current is None:
+                if self.analyzer is None:
+                    self.analyzer = WLAnalyzer()
+                self.store = IndexStore()
+                self.dir_id = self.index_dir_id()
+                reader = IndexReader.open(self.store.store, True)
+                self.current = Search(reader=reader, analyzer=self.analyzer)
+                self.last_check = time()
+            return self.current
+
+    def acquire(self):
+        """Returns a Search. Call release() when done with it."""
+        if time() - self.last_check > self.refresh_interval:
+            self.maybe_refresh()
+        with self.lock:
+            search = self.open()
+            search.searcher.getIndexReader().incRef()
+            return search
+
+    def release(self, search):
+        search.searcher.getIndexReader().decRef()
+
+    def maybe_refresh(self, block=False):
+        """Reopens the reader if the index changed."""
+        if not self.refresh_lock.acquire(block):
+            # someone else is refreshing, use the current one meanwhile
+            return
+        try:
+            self.last_check = time()
+            current = self.current
+            if current is None:
+                return
+            reader = current.searcher.getIndexReader()
+            if self.index_dir_id() != self.dir_id:
+                log.debug('Opening replaced index')
+                store = IndexStore()
+                new_reader = IndexReader.open(store.store, True)
+                self.store, self.dir_id = store, self.index_dir_id()
+            else:
+                if reader.isCurrent():
+                    return
+                new_reader = reader.reopen()
+                if new_reader.equals(reader):
+                    return
+                log.debug('Reopening index')
+            with self.lock:
+                self.current = Search(reader=new_reader, analyzer=self.analyzer)
+            # closes the old reader when searches in progress are done with it
+            reader.decRef()
+        finally:
+            self.refresh_lock.release()
+
+    def index_changed(self, **kwargs):
+        self.maybe_refresh(block=True)
+
+
+class ResultCache(object):
+    """
+    LRU cache for search results, in process memory and optionally in
+    a shared Django cache (see SEARCH_RESULT_CACHE).
+
+    Keys include the version of the searched index snapshot, so after
+    the index changes, entries for the old version are never read again.
+    Values should be plain data: ids, scores and snippets -- not models
+    or Lucene objects.
+    """
+    def __init__(self, size=None, cache=None):
+        if size is None:
+            size = getattr(settings, 'SEARCH_RESULT_CACHE_SIZE', 1000)
+        if cache is None:
+            cache = getattr(settings, 'SEARCH_RESULT_CACHE', None)
+        self.size = size
+        self.shared = cache and get_cache(cache) or None
+        self.lock = RLock()
+        self.entries = OrderedDict()
+        self.version = None
+
+    @staticmethod
+    def normalize(query):
+        return u" ".join(query.lower().split())
+
+    def key(self, search, kind, *parts):
+        """Makes a key for a `kind` of search on `search` with given parameters."""
+        digest = md5(repr(parts)).hexdigest()
+        return "search/%s/%s/%s" % (search.version(), kind, digest)
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.pop(key, None)
+            if value is not None:
+                self.entries[key] = value
+                return value
+        if self.shared is not None:
+            value = self.shared.get(key)
+            if value is not None:
+                self.set(key, value, shared=False)
+        return value
+
+    def set(self, key, value, shared=True):
+        version = key.split('/', 2)[1]
+        with self.lock:
+            if version != self.version:
+                # the index changed, older entries are of no use
+                self.entries.clear()
+                self.version = version
+            self.entries.pop(key, None)
+            self.entries[key] = value
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        if shared and self.shared is not None:
+            self.shared.set(key, value)
+
+
+def edit_distance(a, b):
+    """Levenshtein distance, counting transpositions as single edits."""
+    prev2, prev = None, range(len(b) + 1)
+    for i in range(1, len(a) + 1):
+        cur = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cur[j] = min(prev[j] + 1, cur[j - 1] + 1,
+                         prev[j - 1] + (a[i - 1] != b[j - 1]))
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                cur[j] = min(cur[j], prev2[j - 2] + 1)
+        prev2, prev = prev, cur
+    return prev[len(b)]
+
+
+class Vocabulary(object):
+    """
+    Words occurring in the library, for spelling suggestions.
+
+    Words are terms of the index fields analyzed without stemming (authors,
+    titles, tags, themes), with their document frequencies. For every word,
+    its diacritic-folded form and the forms with one letter deleted are
+    kept in a map, so candidates for a misspelled token are found by looking
+    up its own one-deletion neighbourhood. This finds words differing by
+    a single edit, as well as by a substitution or a transposition, plus
+    any missing diacritics.
+    """
+    FIELDS = ('authors', 'title', 'tags', 'themes', 'tag_name')
+    # tokens shorter than that get no suggestions
+    MIN_LENGTH = 4
+    MAX_DISTANCE = 2
+    MEMO_SIZE = 10000
+
+    _lock = RLock()
+    _current = None
+    _building = False
+
+    def __init__(self, words):
+        from catalogue.prefix_index import fold
+        self.fold = fold
+        self.version = None
+        self.words = words
+        self.neighbours = {}
+        for word in words:
+            for key in self.deletions(fold(word)):
+                self.neighbours.setdefault(key, []).append(word)
+        self.memo = {}
+
+    @classmethod
+    def from_reader(cls, reader):
+        words = {}
+        for field in cls.FIELDS:
+            terms = reader.terms(Term(field, ''))
+            try:
+                while True:
+                    t = terms.term()
+                    if t is None or t.field() != field:
+                        break
+                    word = t.text()
+                    words[word] = words.get(word, 0) + terms.docFreq()
+                    if not terms.next():
+                        break
+            finally:
+                terms.close()
+        return cls(words)
+
+    @classmethod
+    def get(cls, search):
+        """Returns the vocabulary for the index snapshot searched by `search`.
+
+        Only the first call in a process waits for the vocabulary to be
+        built. When the index changes, the new one is built in a background
+        thread and the previous one is returned meanwhile.
+        """
+        version = search.version()
+        with cls._lock:
+            current = cls._current
+            if current is None:
+                current = cls.from_reader(search.searcher.getIndexReader())
+                current.version = version
+                cls._current = current
+            elif current.version < version and not cls._building:
+                cls._building = True
+                reader = search.searcher.getIndexReader()
+                # keep the reader open until the build is done with it
+                reader.incRef()
+                thread = Thread(target=cls._build, args=(reader, version),
+                                name='vocabulary')
+                thread.daemon = True
+                thread.start()
+            return current
+
+    @classmethod
+    def _build(cls, reader, version):
+        JVM.attachCurrentThread()
+        try:
+            vocabulary = cls.from_reader(reader)
+            vocabulary.version = version
+            with cls._lock:
+                if cls._current is None or cls._current.version < version:
+                    cls._current = vocabulary
+        except Exception:
+            log.exception("Can't build the vocabulary.")
+        finally:
+            reader.decRef()
+            with cls._lock:
+                cls._building = False
+
+    @staticmethod
+    def deletions(word):
+        yield word
+        for i in range(len(word)):
+            yield word[:i] + word[i + 1:]
+
+    def __contains__(self, word):
+        return word in self.words
+
+    def suggest(self, token):
+        """Returns the most frequent of the closest words, or None."""
+        try:
+            return self.memo[token]
+        except KeyError:
+            pass
+
+        best = None
+        if len(token) >= self.MIN_LENGTH and token not in self.words:
+            folded = self.fold(token)
+            candidates = set()
+            for key in self.deletions(folded):
+                candidates.update(self.neighbours.get(key, ()))
+            best_rank = None
+            for word in candidates:
+                distance = edit_distance(folded, self.fold(word))
+                if distance > self.MAX_DISTANCE:
+                    continue
+                rank = (distance, edit_distance(token, word), -self.words[word])
+                if best_rank is None or rank < best_rank:
+                    best, best_rank = word, rank
+
+        if len(self.memo) >= self.MEMO_SIZE:
+            self.memo.clear()
+        self.memo[token] = best
+        return best
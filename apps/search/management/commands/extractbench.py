@@ -0,0 +1,65 @@
+import os
+import resource
+from multiprocessing import Pool
+from optparse import make_option
+from time import time
+
+from django.core.management.base import BaseCommand
+
+
+def _measure(xml_path):
+    """Extracts indexed content of a book, in a fresh process."""
+    from librarian.parser import WLDocument
+    from search.index import Index
+
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time()
+    wldoc = WLDocument.from_file(xml_path, parse_dublincore=False)
+    parsed = time()
+    parts = length = 0
+    for part in Index.extract_content(wldoc):
+        parts += 1
+        length += len(part['content'])
+    extracted = time()
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline
+    return parsed - start, extracted - parsed, peak, parts, length
+
+
+class Command(BaseCommand):
+    help = 'Measures time and peak memory of extracting content for the search index.'
+    args = '[slug ...]'
+
+    option_list = BaseCommand.option_list + (
+        make_option('-n', '--number', type='int', dest='number', default=10,
+            help='number of largest books to measure, if no slugs given'),
+    )
+
+    def handle(self, *args, **opts):
+        from catalogue.models import Book
+
+        if args:
+            books = Book.objects.filter(slug__in=args)
+        else:
+            books = sorted((book for book in Book.objects.all() if book.xml_file),
+                           key=lambda book: os.path.getsize(book.xml_file.path),
+                           reverse=True)[:opts['number']]
+
+        # every book in a new process, so that peak memory is per book
+        pool = Pool(1, maxtasksperchild=1)
+        try:
+            print "%-40s %8s %8s %8s %6s %10s %9s" % (
+                'book', 'XML kB', 'parse s', 'walk s', 'parts', 'content kB', 'peak MB')
+            total_parse = total_walk = 0
+            for book in books:
+                path = book.xml_file.path
+                parse, walk, peak, parts, length = pool.apply(_measure, (path,))
+                total_parse += parse
+                total_walk += walk
+                # ru_maxrss is in kilobytes
+                print "%-40s %8d %8.3f %8.3f %6d %10d %9.1f" % (
+                    book.slug[:40], os.path.getsize(path) / 1024, parse, walk,
+                    parts, length / 1024, peak / 1024.)
+            print "total: parsing %.3fs, walking %.3fs" % (total_parse, total_walk)
+        finally:
+            pool.close()
+            pool.join()
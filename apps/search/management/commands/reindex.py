@@ -1,19 +1,57 @@
-from django.core.management.base import BaseCommand
+from datetime import datetime
+import os
+import shutil
+import sys
+from multiprocessing import Pool, cpu_count
+from time import time
+from traceback import format_exc
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
 
 from optparse import make_option
+
+
+def _extract_worker(args):
+    """Parses a book in a worker process, returns data to be indexed."""
+    from search.index import Index
+
+    book_id, xml_path = args
+    try:
+        return book_id, Index.extract_book(xml_path), None
+    except Exception:
+        return book_id, None, format_exc()
+
+
 class Command(BaseCommand):
     help = 'Reindex everything.'
     args = ''
-    
+
     option_list = BaseCommand.option_list + (
         make_option('-n', '--book-id', action='store_true', dest='book_id', default=False,
             help='book id instead of slugs'),
         make_option('-t', '--just-tags', action='store_true', dest='just_tags', default=False,
             help='just reindex tags'),
+        make_option('-F', '--fresh', action='store_true', dest='fresh', default=False,
+            help='build a fresh index in a separate directory and swap it in when done'),
+        make_option('-j', '--jobs', type='int', dest='jobs', default=None,
+            help='number of processes parsing books for a fresh index (default: number of CPUs)'),
+        make_option('-r', '--resume', action='store_true', dest='resume', default=False,
+            help='resume an interrupted fresh reindex'),
     )
+
+    # commit and record progress every that many books
+    COMMIT_EVERY = 50
+
     def handle(self, *args, **opts):
         from catalogue.models import Book
         import search
+
+        if opts['fresh'] or opts['resume']:
+            if args or opts['just_tags']:
+                raise CommandError("--fresh always reindexes everything.")
+            return self.reindex_fresh(Book.objects.all(), opts['jobs'] or cpu_count(), opts['resume'])
+
         idx = search.ReusableIndex()
         idx.open()
 
@@ -27,10 +65,167 @@ class Command(BaseCommand):
                         books += Book.objects.filter(slug=a).all()
             else:
                 books = Book.objects.all()
-                
+
             for b in books:
                 print b.title
                 idx.index_book(b)
         print 'Reindexing tags.'
         idx.index_tags()
         idx.close()
+
+    def report_progress(self, done, total, start):
+        elapsed = time() - start
+        eta = elapsed / done * (total - done)
+        sys.stdout.write("\r%d / %d books, %d:%02d elapsed, ETA %d:%02d " % (
+            done, total, elapsed // 60, elapsed % 60, eta // 60, eta % 60))
+        sys.stdout.flush()
+
+    def reindex_fresh(self, books, jobs, resume):
+        """
+        Parses books in a pool of processes, feeding a single index writer
+        with the extracted data. The new index is built next to the current
+        one and replaces it when complete. Indexed books are recorded after
+        every commit, so an interrupted run can be resumed.
+
+        Books changed or removed while the index was being built are
+        reindexed or removed at the end, just before the swap.
+        """
+        import search
+
+        target = settings.SEARCH_INDEX.rstrip('/')
+        path = target + '.new'
+        done_path = os.path.join(path, 'reindex.done')
+        started_path = os.path.join(path, 'reindex.started')
+
+        if not resume and os.path.exists(path):
+            shutil.rmtree(path)
+        done = set()
+        if resume and os.path.exists(done_path):
+            done = set(int(line) for line in open(done_path) if line.strip())
+            print "Resuming, %d books already indexed." % len(done)
+
+        books = dict((book.pk, book) for book in books
+                     if book.pk not in done)
+        total = len(books)
+        failed = 0
+
+        idx = search.Index(path=path)
+        idx.open()
+        if not os.path.exists(started_path):
+            # processes still using the current index look snippets up
+            # by its revisions in the new store once it's swapped in
+            self.skip_revisions(idx, target)
+            with open(started_path, 'w') as f:
+                f.write("%d\n" % time())
+        started = datetime.fromtimestamp(int(open(started_path).read()))
+        indexed = done | set(books)
+
+        done_file = open(done_path, 'a')
+        pool = Pool(jobs)
+        try:
+            start = time()
+            pending = []
+            results = pool.imap_unordered(_extract_worker,
+                [(book.pk, book.xml_file.path) for book in books.values()])
+            for i, (book_id, extracted, error) in enumerate(results):
+                if error is not None:
+                    failed += 1
+                    print "\nError indexing %s:\n%s" % (books[book_id].slug, error)
+                else:
+                    idx.index_book(books[book_id], overwrite=False, extracted=extracted)
+                    pending.append(book_id)
+                if len(pending) >= self.COMMIT_EVERY:
+                    idx.index.commit()
+                    done_file.writelines("%d\n" % pk for pk in pending)
+                    done_file.flush()
+                    pending = []
+                self.report_progress(i + 1, total, start)
+            print
+            idx.index.commit()
+            done_file.writelines("%d\n" % pk for pk in pending)
+            done_file.flush()
+
+            failed += self.catch_up(idx, started, indexed)
+
+            print 'Reindexing tags.'
+            idx.index_tags()
+        finally:
+            pool.close()
+            pool.join()
+            done_file.close()
+            idx.close()
+
+        if failed:
+            print "%d books failed, fix them and run with --resume." % failed
+            return
+
+        os.unlink(done_path)
+        os.unlink(started_path)
+        self.swap_in(path, target)
+        print 'New index in place.'
+
+    def catch_up(self, idx, started, indexed):
+        """Updates the new index with changes made since it was started."""
+        from catalogue.models import Book
+
+        failed = 0
+        changed = list(Book.objects.filter(changed_at__gte=started))
+        self.skip_revisions(idx, settings.SEARCH_INDEX.rstrip('/'),
+                            set(book.pk for book in changed))
+        for book in changed:
+            print "Changed during reindexing: %s" % book.slug
+            try:
+                idx.index_book(book)
+            except Exception:
+                failed += 1
+                print "Error indexing %s:\n%s" % (book.slug, format_exc())
+        for book_id in indexed - set(Book.objects.values_list('pk', flat=True)):
+            idx.remove_book(book_id)
+        idx.index.commit()
+        return failed
+
+    def skip_revisions(self, idx, target, book_ids=None):
+        """
+        Makes snippet revisions in the new index go above the ones
+        in the current index at `target` (for given books, or all of them).
+        """
+        from search.index import SnippetStore
+
+        old_path = os.path.join(target, SnippetStore.SNIPPET_DIR)
+        if not os.path.isdir(old_path):
+            return
+        old_store = SnippetStore(old_path)
+        old_store.load()
+        revisions = old_store.revisions
+        if book_ids is not None:
+            revisions = dict((book_id, revision) for book_id, revision in revisions.iteritems()
+                             if book_id in book_ids)
+        idx.snippet_store().skip_revisions(revisions)
+
+    def swap_in(self, path, target):
+        """
+        Makes `target` a symlink to the new index, replacing it atomically,
+        so that the index directory is never missing for running processes.
+        """
+        versioned = "%s.%d" % (target, time())
+        os.rename(path, versioned)
+        if os.path.isdir(target) and not os.path.islink(target):
+            # a plain directory can't be atomically replaced with a link,
+            # move it out of the way the first time
+            print "Replacing %s directory with a symlink." % target
+            old = target + '.old'
+            if os.path.exists(old):
+                shutil.rmtree(old)
+            os.rename(target, old)
+        elif os.path.lexists(target):
+            old = os.path.realpath(target)
+        else:
+            old = None
+
+        link = target + '.link'
+        if os.path.lexists(link):
+            os.unlink(link)
+        os.symlink(os.path.basename(versioned), link)
+        os.rename(link, target)
+        if old is not None:
+            shutil.rmtree(old, ignore_errors=True)
@@ -1,8 +1,6 @@
 from django.core.management.base import BaseCommand
 
-from glob import glob
 from optparse import make_option
-from os import path
 from sys import stdout
 from django.conf import settings
 
@@ -23,17 +21,14 @@ class Command(BaseCommand):
         import search
 
         if opts['check']:
-            sfn = glob(settings.SEARCH_INDEX+'snippets/*')
-            print sfn
-            for fn in sfn:
-                print fn
-                bkid = int(path.basename(fn))
-                with open(fn) as f:
-                    cont = f.read()
-                    try:
-                        uc = cont.decode('utf-8')
-                    except UnicodeDecodeError, ude:
-                        print "error in snippets %d" % bkid
+            store = search.index.SnippetStore.instance()
+            store.load(force=True)
+            for (bkid, revision), (segment, offset, length) in sorted(store.spans.items()):
+                print bkid, revision
+                try:
+                    store.get(bkid, revision, 0, length)
+                except UnicodeDecodeError, ude:
+                    print "error in snippets %d" % bkid
         if opts['check2']:
             s = search.Search()
             reader = s.searcher.getIndexReader()
@@ -45,13 +40,14 @@ class Command(BaseCommand):
                     #import pdb; pdb.set_trace()
                     stdout.write("\r%d / %d" % (did, numdocs))
                     stdout.flush()
-                    ss  = doc.get('snippet_position')
-                    sl  = doc.get('snippet_length')
+                    ss  = doc.get('snippets_position')
+                    sl  = doc.get('snippets_length')
+                    rev = doc.get('snippets_revision')
                     if ss and sl:
-                        snips = Snippets(bkid)
+                        snips = search.index.Snippets(bkid, revision=rev and int(rev))
                         try:
-                            txt = snips.get((ss,sl))
-                            assert len(txt) == sl
+                            txt = snips.get((int(ss), int(sl)))
+                            assert txt is not None
                         except UnicodeDecodeError, ude:
                             stdout.write("\nerror in snippets %d\n" % bkid)
                             raise ude
@@ -3,10 +3,13 @@
 from __future__ import with_statement
 
 from django.conf import settings
-from search import Index, Search, IndexStore, JVM, SearchResult
+from search import Index, Search, IndexStore, JVM, SearchResult, ParallelSearch, SearcherManager, \
+    ResultCache, Vocabulary
+from search.index import Snippets, SnippetStore
 from catalogue import models
 from catalogue.test_utils import WLTestCase
 from lucene import PolishAnalyzer, Version
+from librarian.parser import WLDocument
 #from nose.tools import raises
 from os import path
 
@@ -50,6 +53,13 @@ class BookSearchTests(WLTestCase):
         assert len(filter(lambda x: x[1], a[0].hits)) == 1
         print a[0].process_hits()
 
+    def test_hydrate(self):
+        books = self.search.search_perfect_parts("Jakoż hamować")
+        a = SearchResult.aggregate(books)
+        SearchResult.hydrate(a)
+        self.assertNumQueries(0, lambda: (a[0].book, a[0].hits))
+        assert a[0].book == self.book
+
     def test_search_perfect_author_title(self):
         books = self.search.search_perfect_book("szarzyński anusie")
         assert books == []
@@ -76,3 +86,85 @@ class BookSearchTests(WLTestCase):
 
         books = self.search.search_everywhere("anusie płynęły zdroje")
         print 'anusie płynęły zdroje %s' % [b.hits for b in books]
+
+    def test_parallel_search(self):
+        strategies = ParallelSearch()
+        strategies.add('book', self.search.search_perfect_book, "sęp szarzyński")
+        strategies.add('parts', self.search.search_perfect_parts, "Jakoż hamować")
+        books = strategies.result('book')
+        assert len(books) == 1
+        assert books[0].book_id == self.book.id
+        assert len(strategies.aggregate('parts')) == 1
+        assert set(strategies.timings) == set(['book', 'parts'])
+
+    def test_searcher_manager(self):
+        manager = SearcherManager(refresh_interval=0)
+        search = manager.acquire()
+        try:
+            index = Index()
+            index.open()
+            try:
+                index.remove_book(self.book)
+            finally:
+                index.close()
+            # still usable after reopening
+            assert len(search.search_perfect_book("sęp szarzyński")) == 1
+            fresh = manager.acquire()
+            assert fresh is not search
+            assert fresh.search_perfect_book("sęp szarzyński") == []
+            manager.release(fresh)
+        finally:
+            manager.release(search)
+
+    def test_result_cache(self):
+        cache = ResultCache(size=1, cache=False)
+        books = self.search.search_perfect_parts("Jakoż hamować")
+        key = cache.key(self.search, 'parts', cache.normalize(u"Jakoż  Hamować"))
+        assert key == cache.key(self.search, 'parts', cache.normalize(u"jakoż hamować"))
+        cache.set(key, [b.to_cache() for b in books])
+        cached = [SearchResult.from_cache(self.search, data) for data in cache.get(key)]
+        assert [b.book_id for b in cached] == [b.book_id for b in books]
+        assert [b.score for b in cached] == [b.score for b in books]
+
+        cache.set(cache.key(self.search, 'other'), [])
+        assert cache.get(key) is None
+
+    def test_extract_content(self):
+        wldoc = WLDocument.from_file(self.book.xml_file.path, parse_dublincore=False)
+        parts = list(Index.extract_content(wldoc))
+        fragments = [p for p in parts if 'fragment_anchor' in p]
+        assert len(fragments) == 1
+        content = fragments[0]['content']
+        # fragment spans many sections, without its themes
+        assert content.startswith(u'Jeśli oczu hamować')
+        assert u'Jakoż ja mam hamować' in content
+        assert u'Kochanek' not in content
+        assert 'Kochanek' in fragments[0]['themes']
+
+    def test_vocabulary(self):
+        vocabulary = Vocabulary.from_reader(self.search.searcher.getIndexReader())
+        assert u'szarzyński' in vocabulary
+        assert vocabulary.suggest(u'szarzynski') == u'szarzyński'
+        assert vocabulary.suggest(u'szarzyńki') == u'szarzyński'
+        assert vocabulary.suggest(u'kalafior') is None
+
+    def test_snippet_store(self):
+        snippets = Snippets(self.book.id).open('w')
+        try:
+            pos = snippets.add(u"Zażółć gęślą jaźń")
+        finally:
+            snippets.close()
+        store = SnippetStore.instance()
+        assert store.get(self.book.id, snippets.revision, *pos) == u"Zażółć gęślą jaźń"
+
+        # compaction keeps only the current revision
+        store.compact()
+        assert store.get(self.book.id, snippets.revision, *pos) == u"Zażółć gęślą jaźń"
+        assert store.get(self.book.id, snippets.revision - 1, 0, 1) is None
+
+    def test_snippet_store_skip_revisions(self):
+        store = SnippetStore(path.join(settings.SEARCH_INDEX + '.new', SnippetStore.SNIPPET_DIR))
+        store.skip_revisions({self.book.id: 5})
+        snippets = Snippets(self.book.id, store=store).open('w')
+        snippets.close()
+        assert snippets.revision == 6
@@ -7,41 +7,37 @@ from django.contrib.auth.decorators import login_required
 from django.views.decorators import cache
 from django.http import HttpResponse, HttpResponseRedirect, Http404, HttpResponsePermanentRedirect
 from django.utils.translation import ugettext as _
+from django.core.signals import request_finished
+from django.dispatch import receiver
 
 from catalogue.utils import split_tags
 from catalogue.models import Book, Tag, Fragment
 from catalogue.views import JSONResponse
-from search import Search, JVM, SearchResult
+from catalogue import prefix_index
+from search import Search, JVM, SearchResult, ParallelSearch, SearcherManager, ResultCache, \
+    Vocabulary
 from lucene import StringReader
 from suggest.forms import PublishingSuggestForm
-from time import sleep
+from threading import local
 import re
 import enchant
+import logging
 
-dictionary = enchant.Dict('pl_PL')
-
+log = logging.getLogger('search')
 
-def match_word_re(word):
-    if 'sqlite' in settings.DATABASES['default']['ENGINE']:
-        return r"\b%s\b" % word
-    elif 'mysql' in settings.DATABASES['default']['ENGINE']:
-        return "[[:<:]]%s[[:>:]]" % word
+dictionary = enchant.Dict('pl_PL')
 
 
-def did_you_mean(query, tokens):
+def did_you_mean(query, tokens, search):
+    vocabulary = Vocabulary.get(search)
     change = {}
     for t in tokens:
-        authors = Tag.objects.filter(category='author', name__iregex=match_word_re(t))
-        if len(authors) > 0:
+        # Words from the library, or correct ones, are left alone.
+        if t in vocabulary or dictionary.check(t):
             continue
-
-        if not dictionary.check(t):
-            try:
-                change_to = dictionary.suggest(t)[0].lower()
-                if change_to != t.lower():
-                    change[t] = change_to
-            except IndexError:
-                pass
+        change_to = vocabulary.suggest(t)
+        if change_to is not None and change_to != t:
+            change[t] = change_to
 
     if change == {}:
         return None
@@ -53,42 +49,48 @@ def did_you_mean(query, tokens):
 
 
 JVM.attachCurrentThread()
-_search = None
+search_manager = SearcherManager()
+try:
+    search_manager.open()
+except Exception, e:
+    # no index yet, we'll retry on first search
+    log.warning("Cannot open search index: %s" % e)
+_request_search = local()
+result_cache = ResultCache()
 
 
 def get_search():
-    global _search
+    """Returns a Search over a current snapshot of the index.
+
+    The snapshot is held by the current thread until the request is finished.
+    """
+    search = getattr(_request_search, 'search', None)
+    if search is None:
+        search = _request_search.search = search_manager.acquire()
+    return search
 
-    while _search is False:
-        sleep(1)
 
-    if _search is None:
-        _search = False
-        _search = Search()
-    return _search
+@receiver(request_finished)
+def _release_search(sender, **kwargs):
+    search = getattr(_request_search, 'search', None)
+    if search is not None:
+        del _request_search.search
+        search_manager.release(search)
 
 
 def hint(request):
     prefix = request.GET.get('term', '')
     if len(prefix) < 2:
         return JSONResponse([])
-    JVM.attachCurrentThread()
-
-    search = get_search()
-    hint = search.hint()
-    try:
-        tags = request.GET.get('tags', '')
-        hint.tags(Tag.get_tag_list(tags))
-    except:
-        pass
-
-    # tagi beda ograniczac tutaj
-    # ale tagi moga byc na ksiazce i na fragmentach
-    # jezeli tagi dot tylko ksiazki, to wazne zeby te nowe byly w tej samej ksiazce
-    # jesli zas dotycza themes, to wazne, zeby byly w tym samym fragmencie.
 
-    tags = search.hint_tags(prefix, pdcounter=True)
-    books = search.hint_books(prefix)
+    # Served from memory, without touching the search index nor database.
+    index = prefix_index.get_index()
+    tags = index.starting_with(prefix, kinds=('tag', 'pd_author', 'pd_book'), limit=50)
+    books = index.starting_with(prefix, kinds=('book',), limit=50)
+    # don't add the pdcounter entries if same tag or book already exists
+    slugs = set(t.slug for t in tags if t.kind == 'tag')
+    slugs.update(b.slug for b in books)
+    tags = [t for t in tags if t.kind == 'tag' or t.slug not in slugs]
 
     def category_name(c):
         if c.startswith('pd_'):
@@ -98,12 +100,12 @@ def hint(request):
     return JSONResponse(
         [{'label': t.name,
           'category': category_name(t.category),
-          'id': t.id,
+          'id': t.pk,
           'url': t.get_absolute_url()}
           for t in tags] + \
-          [{'label': b.title,
+          [{'label': b.name,
             'category': _('book'),
-            'id': b.id,
+            'id': b.pk,
             'url': b.get_absolute_url()}
             for b in books])
 
@@ -136,18 +138,61 @@ def main(request):
     # hint.tags(tag_list)
     # if book:
     #     hint.books(book)
-    tags = search.hint_tags(query, pdcounter=True, prefix=False, fuzzy=fuzzy)
-    tags = split_tags(tags)
 
     toks = StringReader(query)
     tokens_cache = {}
-
-    author_results = search.search_phrase(toks, 'authors', fuzzy=fuzzy, tokens_cache=tokens_cache)
-    title_results = search.search_phrase(toks, 'title', fuzzy=fuzzy, tokens_cache=tokens_cache)
+    # Analyze the query up front, so that strategies running
+    # concurrently only read the tokens cache.
+    for field in 'authors', 'title', 'tags', 'content', 'SIMPLE':
+        search.get_tokens(toks, field=field, cached=tokens_cache)
+
+    key = result_cache.key(search, 'main', result_cache.normalize(query), fuzzy)
+    cached = result_cache.get(key)
+    if cached is None:
+        strategies = ParallelSearch()
+        strategies.add('tags', search.hint_tag_refs, query, pdcounter=True, prefix=False, fuzzy=fuzzy)
+        strategies.add('author', search.search_phrase, toks, 'authors', fuzzy=fuzzy, tokens_cache=tokens_cache)
+        strategies.add('title', search.search_phrase, toks, 'title', fuzzy=fuzzy, tokens_cache=tokens_cache)
+        strategies.add('author_title', search.search_some, toks, ['authors', 'title', 'tags'],
+                       fuzzy=fuzzy, tokens_cache=tokens_cache)
+        # Do a phrase search but a term search as well - this can give us better snippets then search_everywhere,
+        # Because the query is using only one field.
+        strategies.add('text_phrase', search.search_phrase, toks, 'content', fuzzy=fuzzy,
+                       tokens_cache=tokens_cache, snippets=True, book=False, slop=4)
+        strategies.add('text_terms', search.search_some, toks, ['content'],
+                       tokens_cache=tokens_cache, snippets=True, book=False)
+        strategies.add('everywhere', search.search_everywhere, toks, fuzzy=fuzzy, tokens_cache=tokens_cache)
+
+    suggestion = did_you_mean(query, tokens_cache['SIMPLE'], search)
+
+    if cached is None:
+        tag_refs = strategies.result('tags')
+        found = {
+            'author': strategies.result('author'),
+            'title': strategies.result('title'),
+            'author_title': strategies.result('author_title'),
+            'text_phrase': strategies.aggregate('text_phrase', 'text_terms'),
+            'everywhere': strategies.result('everywhere'),
+            }
+        log.debug("Search timings for %r: %s" % (query, ", ".join(
+            "%s %.3fs" % item for item in sorted(strategies.timings.items()))))
+        result_cache.set(key, {
+            'tags': tag_refs,
+            'found': dict((name, [r.to_cache() for r in results])
+                          for name, results in found.items()),
+            })
+    else:
+        tag_refs = cached['tags']
+        found = dict((name, [SearchResult.from_cache(search, data, toks, tokens_cache) for data in results])
+                     for name, results in cached['found'].items())
+
+    tags = split_tags(search.tags_from_refs(tag_refs))
+    author_results = found['author']
+    title_results = found['title']
 
     # Boost main author/title results with mixed search, and save some of its results for end of list.
     # boost author, title results
-    author_title_mixed = search.search_some(toks, ['authors', 'title', 'tags'], fuzzy=fuzzy, tokens_cache=tokens_cache)
+    author_title_mixed = found['author_title']
     author_title_rest = []
     for b in author_title_mixed:
         bks = filter(lambda ba: ba.book_id == b.book_id, author_results + title_results)
@@ -156,13 +201,8 @@ def main(request):
         if bks is []:
             author_title_rest.append(b)
 
-    # Do a phrase search but a term search as well - this can give us better snippets then search_everywhere,
-    # Because the query is using only one field.
-    text_phrase = SearchResult.aggregate(
-        search.search_phrase(toks, 'content', fuzzy=fuzzy, tokens_cache=tokens_cache, snippets=True, book=False, slop=4),
-        search.search_some(toks, ['content'], tokens_cache=tokens_cache, snippets=True, book=False))
-
-    everywhere = search.search_everywhere(toks, fuzzy=fuzzy, tokens_cache=tokens_cache)
+    text_phrase = found['text_phrase']
+    everywhere = found['everywhere']
 
     def already_found(results):
         def f(e):
@@ -181,6 +221,8 @@ def main(request):
 
     everywhere = SearchResult.aggregate(everywhere, author_title_rest)
 
+    SearchResult.hydrate(author_results + title_results + text_phrase + everywhere)
+
     for res in [author_results, title_results, text_phrase, everywhere]:
         res.sort(reverse=True)
         for r in res:
@@ -189,8 +231,6 @@ def main(request):
                                     re.subn(r"(^[ \t\n]+|[ \t\n]+$)", u"",
                                             re.subn(r"[ \t\n]*\n[ \t\n]*", u"\n", s)[0])[0], h['snippets'])
 
-    suggestion = did_you_mean(query, search.get_tokens(toks, field="SIMPLE"))
-
     def ensure_exists(r):
         try:
             return r.book
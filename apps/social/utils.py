@@ -1,7 +1,7 @@
 from django.db.models import Q
 from catalogue.models import Book, Tag
 from catalogue import utils
-from catalogue.tasks import touch_tag
+from catalogue.tasks import touch_tag, flush_dirty_tags
 from social.models import Cite
 
 
@@ -33,6 +33,7 @@ def set_sets(user, work, sets):
         touch_tag(shelf)
 
     # delete empty tags
+    flush_dirty_tags(delay=False)
     Tag.objects.filter(category='set', user=user, book_count=0).delete()
 
 
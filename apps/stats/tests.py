@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+# This file is part of Wolnelektury, licensed under GNU Affero GPLv3 or later.
+# Copyright © Fundacja Nowoczesna Polska. See NOTICE for more information.
+#
+import os
+import Queue
+import tempfile
+import threading
+
+from django.conf import settings
+from django.test import TestCase
+from django.test.client import RequestFactory
+
+from stats import utils
+
+
+class PiwikTests(TestCase):
+
+    def setUp(self):
+        self.sent = []
+        self.failing = False
+        self._send, utils.send = utils.send, self.send
+        self._work, utils.work = utils.work, self.work
+        self.stop = threading.Event()
+        fd, self.spool = tempfile.mkstemp(prefix='piwik_spool_')
+        os.close(fd)
+        self._settings = (settings.STATS_PIWIK_SPOOL, settings.STATS_PIWIK_QUEUE_SIZE,
+            settings.STATS_PIWIK_BATCH_SIZE, settings.STATS_PIWIK_FLUSH_INTERVAL)
+        settings.STATS_PIWIK_SPOOL = self.spool
+        settings.STATS_PIWIK_QUEUE_SIZE = 3
+        settings.STATS_PIWIK_BATCH_SIZE = 2
+        settings.STATS_PIWIK_FLUSH_INTERVAL = 0.01
+        utils._processes.clear()
+
+    def tearDown(self):
+        self.stop.set()
+        utils._processes.clear()
+        utils.send, utils.work = self._send, self._work
+        (settings.STATS_PIWIK_SPOOL, settings.STATS_PIWIK_QUEUE_SIZE,
+            settings.STATS_PIWIK_BATCH_SIZE, settings.STATS_PIWIK_FLUSH_INTERVAL) = self._settings
+        os.unlink(self.spool)
+
+    def send(self, events):
+        if self.failing:
+            raise IOError("Piwik is down.")
+        self.sent.append(events)
+        utils.count('sent', len(events))
+
+    def work(self):
+        # keeps the queue as it is
+        self.stop.wait()
+
+    def test_batches(self):
+        queue = Queue.Queue()
+        for event in 'abcde':
+            queue.put(event)
+        self.assertEqual([utils.next_batch(queue) for i in range(3)],
+                         [['a', 'b'], ['c', 'd'], ['e']])
+
+    def test_drop_when_full(self):
+        request = RequestFactory().get('/api/books/')
+        for i in range(5):
+            utils.track(request)
+        process = utils.current()
+        self.assertEqual(process.queue.qsize(), 3)
+        self.assertEqual(process.counters['queued'], 3)
+        self.assertEqual(process.counters['dropped'], 2)
+
+    def test_spool(self):
+        self.failing = True
+        utils.flush(['a', 'b'])
+        self.assertEqual(self.sent, [])
+        self.assertEqual(open(self.spool).read(), 'a\nb\n')
+
+        self.failing = False
+        utils.flush(['c'])
+        self.assertEqual(self.sent, [['c'], ['a', 'b']])
+        self.assertEqual(open(self.spool).read(), '')
+        self.assertEqual(utils.current().counters['spooled'], 0)
+
+    def test_fork(self):
+        process = utils.current()
+        # as seen by a forked child
+        process.pid = -1
+        utils._processes[-1] = utils._processes.pop(os.getpid())
+        self.assertFalse(utils.current() is process)
@@ -2,12 +2,29 @@
 # This file is part of Wolnelektury, licensed under GNU Affero GPLv3 or later.
 # Copyright © Fundacja Nowoczesna Polska. See NOTICE for more information.
 #
+"""Tracking API and OPDS requests in Piwik.
+
+Tracking doesn't make requests wait for Piwik: events are put on a bounded
+in-memory queue and sent in batches, using Piwik's bulk tracking, by
+a background thread. When the queue is full, events are dropped. Events
+which couldn't be sent are appended to a spool file (STATS_PIWIK_SPOOL),
+shared by all processes and locked with flock, and sent again after
+the next successful batch.
+
+"""
 from django.contrib.sites.models import Site
 from piwik.django.models import PiwikSite
 from django.conf import settings
+import atexit
+import fcntl
 import logging
 from functools import update_wrapper
 import httplib
+import json
+import os
+import Queue
+import threading
+from time import time
 import urlparse
 import urllib
 from random import random
@@ -16,12 +33,6 @@ from inspect import isclass
 logger = logging.getLogger(__name__)
 
 
-def piwik_url(**kw):
-    url = settings.PIWIK_URL + u"/piwik.php?"
-    url += u'&'.join([k + u"=" + str(v) for k, v in kw.items()])
-    logger.info("piwik url: %s" % url)
-    return url
-
 PIWIK_API_VERSION = 1
 
 
@@ -33,6 +44,204 @@ except PiwikSite.DoesNotExist:
     logger.debug("No PiwikSite is configured.")
     _id_piwik = None
 
+
+class _Process(object):
+    """Queue, sending thread and counters of one process.
+
+    A forked child must not use its parent's: it would inherit queued
+    events and possibly held locks, but not the thread.
+
+    """
+    def __init__(self):
+        self.pid = os.getpid()
+        self.queue = Queue.Queue(settings.STATS_PIWIK_QUEUE_SIZE)
+        self.worker = None
+        self.worker_lock = threading.Lock()
+        # numbers of events, by what happened to them
+        self.counters = {
+            'queued': 0,
+            'sent': 0,
+            'dropped': 0,
+            'spooled': 0,
+        }
+        self.counters_lock = threading.Lock()
+
+    def ensure_worker(self):
+        """Starts the sending thread, unless it's running."""
+        if self.worker is not None and self.worker.is_alive():
+            return
+        with self.worker_lock:
+            if self.worker is None or not self.worker.is_alive():
+                self.worker = threading.Thread(target=work, name='piwik')
+                self.worker.daemon = True
+                self.worker.start()
+
+
+# by pid
+_processes = {}
+
+
+def current():
+    """Returns the tracking state of the current process."""
+    pid = os.getpid()
+    process = _processes.get(pid)
+    if process is None:
+        for other in _processes.keys():
+            if other != pid:
+                _processes.pop(other, None)
+        # setdefault is atomic, so all threads get the same one
+        process = _processes.setdefault(pid, _Process())
+    return process
+
+
+def count(name, n=1):
+    process = current()
+    with process.counters_lock:
+        process.counters[name] += n
+
+
+def event_query(request):
+    """Query string of a Piwik tracking request for a request."""
+    params = dict(
+        rec=1,
+        apiv=PIWIK_API_VERSION,
+        rand=int(random() * 0x10000),
+        # events may be sent a while later
+        cdt=int(time()),
+        cip=request.META['REMOTE_ADDR'],
+        url='http://' + request.META['HTTP_HOST'] + request.path,
+        urlref=request.META.get('HTTP_REFERER', ''),
+        idsite=_id_piwik)
+    return urllib.urlencode([(k, unicode(v).encode('utf-8')) for k, v in params.items()])
+
+
+def send(events):
+    """Sends events to Piwik in one bulk request."""
+    conn = httplib.HTTPConnection(_host, timeout=settings.STATS_PIWIK_TIMEOUT)
+    try:
+        conn.request('POST', settings.PIWIK_URL + "/piwik.php", json.dumps({
+                'requests': ['?' + event for event in events],
+                'token_auth': settings.PIWIK_TOKEN,
+            }), {'Content-Type': 'application/json'})
+        response = conn.getresponse()
+        response.read()
+    finally:
+        conn.close()
+    if response.status != 200:
+        raise IOError("Piwik responded with %d." % response.status)
+    count('sent', len(events))
+
+
+def spool(events):
+    """Keeps events for sending later, or drops them if there's no spool."""
+    if not settings.STATS_PIWIK_SPOOL:
+        count('dropped', len(events))
+        return
+    try:
+        with open(settings.STATS_PIWIK_SPOOL, 'a') as f:
+            # the spool is shared by all processes
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.writelines(event + '\n' for event in events)
+    except IOError:
+        logger.exception("Can't spool Piwik events.")
+        count('dropped', len(events))
+    else:
+        count('spooled', len(events))
+
+
+def take_spooled():
+    """Empties the spool file and returns events which were in it."""
+    path = settings.STATS_PIWIK_SPOOL
+    if not path or not os.path.exists(path):
+        return []
+    try:
+        with open(path, 'r+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            events = [line.rstrip('\n') for line in f if line.strip()]
+            f.truncate(0)
+    except IOError:
+        logger.exception("Can't read spooled Piwik events.")
+        return []
+    count('spooled', -len(events))
+    return events
+
+
+def send_spooled():
+    """Sends events from the spool file, if there are any."""
+    events = take_spooled()
+    batch_size = settings.STATS_PIWIK_BATCH_SIZE
+    for start in range(0, len(events), batch_size):
+        try:
+            send(events[start:start + batch_size])
+        except Exception:
+            logger.exception("Can't send spooled Piwik events.")
+            spool(events[start:])
+            return
+
+
+def flush(events):
+    try:
+        send(events)
+    except Exception:
+        logger.exception("Can't send Piwik events.")
+        spool(events)
+    else:
+        send_spooled()
+
+
+def next_batch(queue):
+    """Waits for events and returns them, up to a batch."""
+    batch_size = settings.STATS_PIWIK_BATCH_SIZE
+    events = [queue.get()]
+    # wait for the batch to fill, but not too long
+    deadline = time() + settings.STATS_PIWIK_FLUSH_INTERVAL
+    while len(events) < batch_size:
+        timeout = deadline - time()
+        if timeout <= 0:
+            break
+        try:
+            events.append(queue.get(timeout=timeout))
+        except Queue.Empty:
+            break
+    return events
+
+
+def work():
+    """Sends queued events in batches, forever."""
+    process = current()
+    while True:
+        flush(next_batch(process.queue))
+        logger.debug("Piwik events: %r" % process.counters)
+
+
+def track(request):
+    """Queues a tracking event for a request. Never blocks."""
+    process = current()
+    process.ensure_worker()
+    try:
+        process.queue.put_nowait(event_query(request))
+    except Queue.Full:
+        count('dropped')
+    else:
+        count('queued')
+
+
+@atexit.register
+def _spool_queued():
+    # the sending thread dies with the process, keep what it didn't send
+    process = _processes.get(os.getpid())
+    if process is None:
+        return
+    events = []
+    while True:
+        try:
+            events.append(process.queue.get_nowait())
+        except Queue.Empty:
+            break
+    if events:
+        spool(events)
+
+
 def piwik_track(klass_or_method):
     """Track decorated class or method using Piwik (according to configuration in settings and django-piwik)
     Works for handler classes (executed by __call__) or handler methods. Expects request to be the first parameter
@@ -48,18 +257,7 @@ def piwik_track(klass_or_method):
         call_func = klass_or_method
 
     def wrap(self, request, *args, **kw):
-        conn = httplib.HTTPConnection(_host)
-        conn.request('GET', piwik_url(
-            rec=1,
-            apiv=PIWIK_API_VERSION,
-            rand=int(random() * 0x10000),
-            token_auth=urllib.quote(settings.PIWIK_TOKEN),
-            cip=urllib.quote(request.META['REMOTE_ADDR']),
-            url=urllib.quote('http://' + request.META['HTTP_HOST'] + request.path),
-            urlref=urllib.quote(request.META['HTTP_REFERER']) if 'HTTP_REFERER' in request.META else '',
-            idsite=_id_piwik))
-
-        conn.close()
+        track(request)
         return call_func(self, request, *args, **kw)
 
     # and wrap it
@@ -31,3 +31,32 @@ CATALOGUE_CUSTOMPDF_RATE_LIMIT = '1/m'
 # set to 'new' or 'old' to skip time-consuming test
 # for TeX morefloats library version
 LIBRARIAN_PDF_MOREFLOATS = None
+
+# keep book and fragment tagging in memory for tagged_object_list
+CATALOGUE_TAG_INDEX = True
+
+# recount touched tags in a celery task instead of at the end of request
+CATALOGUE_RECOUNT_TAGS_DELAY = False
+
+# threads running search strategies concurrently, per process
+SEARCH_THREADS = 8
+
+# how often (in seconds) web processes check for search index changes
+SEARCH_REFRESH_INTERVAL = 10
+
+# search and hint results cached per process, keyed by index version
+SEARCH_RESULT_CACHE_SIZE = 1000
+# name of a cache (from CACHES) to share cached search results between processes
+SEARCH_RESULT_CACHE = 'default'
+
+# Piwik tracking events waiting to be sent, per process; more are dropped
+STATS_PIWIK_QUEUE_SIZE = 1000
+# events sent to Piwik in a single bulk request
+STATS_PIWIK_BATCH_SIZE = 50
+# how long (in seconds) to wait for a batch of events to fill up
+STATS_PIWIK_FLUSH_INTERVAL = 5
+# timeout (in seconds) for requests to Piwik
+STATS_PIWIK_TIMEOUT = 10
+
+# number of entries on a page of an OPDS feed
+OPDS_PAGE_SIZE = 50
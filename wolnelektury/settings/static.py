@@ -5,7 +5,10 @@ from settings.paths import PROJECT_DIR
 # Example: "/home/media/media.lawrence.com/"
 MEDIA_ROOT = path.join(PROJECT_DIR, '../media/')
 STATIC_ROOT = path.join(PROJECT_DIR, '../static/')
+# `reindex --fresh` replaces it with a symlink to the current index directory
 SEARCH_INDEX = path.join(PROJECT_DIR, '../search_index/')
+# Piwik tracking events which couldn't be sent yet; None to drop them
+STATS_PIWIK_SPOOL = path.join(PROJECT_DIR, '../piwik.spool')
 
 # URL that handles the media served from MEDIA_ROOT. Make sure to use a
 # trailing slash if there is a path component (optional in other cases).